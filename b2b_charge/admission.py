@@ -0,0 +1,247 @@
+"""
+Admission control for the charge endpoints.
+
+Two checks run before a charge touches the database, and each answers 429 right away
+when it fails:
+
+* a per-merchant rate limit. It is a token bucket refilled at ``rate`` charges per
+  second up to ``burst`` tokens, kept in process memory. When
+  ``B2B_CHARGE_RATE_LIMIT_BACKEND`` names a Django cache alias, the limit is shared
+  between processes instead, counted in one-second windows of ``rate`` charges with
+  an atomic ``incr``. When it is empty, no merchant is limited and the limits are
+  not even looked up.
+* a cap on the charges running at once in this process
+  (``B2B_CHARGE_MAX_CONCURRENT_CHARGES``). It keeps a flood from taking every
+  database connection and from queueing on the merchant's row lock.
+
+The limits come from ``Merchant.rate_limit`` and ``Merchant.rate_burst``, falling back
+to ``B2B_CHARGE_RATE_LIMIT`` and ``B2B_CHARGE_RATE_BURST``. They are cached in process
+for ``B2B_CHARGE_RATE_LIMIT_TTL`` seconds, for at most
+``B2B_CHARGE_RATE_LIMIT_CACHE_SIZE`` merchants, which also bounds the token buckets,
+so a limit check rarely queries the database. A rate of 0 means no limit.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .cache import LRUCache
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a charge is not admitted. ``retry_after`` is in seconds.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """
+    Thread-safe in-process token buckets, one per key, the least recently used dropped
+    beyond ``max_size``.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token. Returns 0 on success, or the seconds until one is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedWindows:
+    """
+    Per-key counters of one-second windows in a Django cache, shared by every process.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        window = int(now)
+        cache = caches[self.alias]
+        cache_key = "b2b_charge:rate:%s:%d" % (key, window)
+        cache.add(cache_key, 0, timeout=2)
+        try:
+            count = cache.incr(cache_key)
+        except ValueError:
+            # The window expired between add and incr.
+            return 0
+        if count <= rate:
+            return 0
+        return window + 1 - now
+
+    def clear(self):
+        pass
+
+
+class ChargeAdmission:
+    """
+    The rate limits and the concurrency cap of this process.
+    """
+
+    # The ``(rate, burst)`` of every merchant while rate limiting is disabled.
+    NO_LIMIT = (0, 1)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limits = None
+        self._buckets = None
+        self._slots = None
+        self._slots_size = None
+        self.rejected = 0
+
+    def _limit_cache(self):
+        if self._limits is None:
+            self._limits = LRUCache(
+                max_size=settings.B2B_CHARGE_RATE_LIMIT_CACHE_SIZE,
+                ttl=settings.B2B_CHARGE_RATE_LIMIT_TTL,
+            )
+        return self._limits
+
+    def _limiter(self):
+        alias = settings.B2B_CHARGE_RATE_LIMIT_BACKEND
+        if self._buckets is None or getattr(self._buckets, "alias", "local") != alias:
+            if alias == "local":
+                self._buckets = TokenBuckets(settings.B2B_CHARGE_RATE_LIMIT_CACHE_SIZE)
+            else:
+                self._buckets = SharedWindows(alias)
+        return self._buckets
+
+    def limits(self, merchant_id):
+        """
+        Returns the merchant's ``(rate, burst)``.
+        """
+        if not settings.B2B_CHARGE_RATE_LIMIT_BACKEND:
+            return self.NO_LIMIT
+        cache = self._limit_cache()
+        limits = cache.get(merchant_id)
+        if limits is None:
+            # Imported here so that models can import this module.
+            from .models import Merchant
+
+            row = (
+                Merchant.objects.filter(id=merchant_id)
+                .values_list("rate_limit", "rate_burst")
+                .first()
+            )
+            rate, burst = row or (None, None)
+            if rate is None:
+                rate = settings.B2B_CHARGE_RATE_LIMIT
+            if burst is None:
+                burst = settings.B2B_CHARGE_RATE_BURST or rate
+            limits = (rate, max(burst, 1))
+            # Unknown merchants are cached too, so a flood of them stays off the database.
+            cache.set(merchant_id, limits)
+        return limits
+
+    def cached_limits(self, merchant_id):
+        """
+        Returns the merchant's ``(rate, burst)`` if they are cached, otherwise None.
+        """
+        if not settings.B2B_CHARGE_RATE_LIMIT_BACKEND:
+            return self.NO_LIMIT
+        return self._limit_cache().get(merchant_id)
+
+    def check_rate(self, merchant_id):
+        """
+        Takes a token from the merchant's bucket or raises AdmissionRejected.
+        """
+        rate, burst = self.limits(merchant_id)
+        if not rate:
+            return
+        wait = self._limiter().take(merchant_id, rate, burst)
+        if wait:
+            self._reject()
+            raise AdmissionRejected(
+                "Rate limit of %s charges per second exceeded for merchant %s."
+                % (rate, merchant_id),
+                retry_after=math.ceil(wait),
+            )
+
+    def _semaphore(self):
+        size = settings.B2B_CHARGE_MAX_CONCURRENT_CHARGES
+        if self._slots_size != size:
+            with self._lock:
+                if self._slots_size != size:
+                    self._slots = threading.BoundedSemaphore(size) if size else None
+                    self._slots_size = size
+        return self._slots
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds one of the process's charge slots, or raises AdmissionRejected when they
+        are all taken.
+        """
+        slots = self._semaphore()
+        if slots is None:
+            yield
+            return
+        if not slots.acquire(blocking=False):
+            self._reject()
+            raise AdmissionRejected("Too many charges in progress.", retry_after=1)
+        try:
+            yield
+        finally:
+            slots.release()
+
+    @contextmanager
+    def admit(self, merchant_id):
+        """
+        Checks the merchant's rate limit and holds a charge slot.
+        """
+        try:
+            merchant_id = int(merchant_id)
+        except (TypeError, ValueError):
+            # Not a merchant id, the view answers 404.
+            merchant_id = None
+        if merchant_id is not None:
+            self.check_rate(merchant_id)
+        with self.slot():
+            yield
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def clear(self):
+        if self._limits is not None:
+            self._limits.clear()
+        if self._buckets is not None:
+            self._buckets.clear()
+        with self._lock:
+            self.rejected = 0
+
+
+charge_admission = ChargeAdmission()
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class B2BChargeConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "b2b_charge"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .metrics import install_query_instrumentation
+
+        connection_created.connect(install_query_instrumentation)
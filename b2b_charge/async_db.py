@@ -0,0 +1,49 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.B2B_CHARGE_ASYNC_DB_POOL_SIZE,
+            thread_name_prefix="b2b-charge-db",
+        )
+    return _executor
+
+
+def _call(func, args, kwargs):
+    """
+    Runs ``func`` on a pool thread. Every pool thread keeps its own database connection
+    between calls, so the threads act as a fixed-size connection pool. Connections that
+    are older than ``CONN_MAX_AGE`` or unusable are dropped before the call.
+    """
+    close_old_connections()
+    return func(*args, **kwargs)
+
+
+async def run_in_pool(func, *args, **kwargs):
+    """
+    Runs the synchronous database function ``func`` without blocking the event loop.
+
+    Django 4.2 cannot run ``atomic`` blocks from async code, so the transactional parts of
+    the async views still run synchronously, but on a bounded pool of threads with
+    persistent connections instead of a new thread and connection per request.
+    Setting ``B2B_CHARGE_ASYNC_DB_POOL_SIZE`` to 0 falls back to ``sync_to_async``.
+    """
+    if not settings.B2B_CHARGE_ASYNC_DB_POOL_SIZE:
+        return await sync_to_async(func)(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context so that request metrics follow the call.
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(context.run, _call, func, args, kwargs)
+    )
@@ -0,0 +1,195 @@
+import json
+
+from django.conf import settings
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from rest_framework.serializers import ValidationError
+
+from .admission import AdmissionRejected, charge_admission
+from .async_db import run_in_pool
+from .combiner import charge_combiner
+from .idempotency import HEADER, run_idempotent
+from .models import Merchant
+from .routers import replica_reads
+from .sharding import merchant_shard
+from .serializers import validate_charge, validate_credit
+from .velocity import velocity_checks
+from .views import json_response
+
+
+def csrf_exempt(view):
+    """
+    Django 4.2's ``csrf_exempt`` turns coroutine views into sync ones, so mark the view
+    directly instead.
+    """
+    view.csrf_exempt = True
+    return view
+
+
+def _request_data(request):
+    if request.content_type == "application/json":
+        try:
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            return None
+    return request.POST
+
+
+def _bad_request(message):
+    return JsonResponse(
+        {"message": "Cannot execute transaction due to : %s" % (message)},
+        status=400,
+    )
+
+
+def _too_many_requests(error):
+    response = JsonResponse({"detail": str(error)}, status=429)
+    if error.retry_after is not None:
+        response["Retry-After"] = "%d" % (error.retry_after)
+    return response
+
+
+def _transaction(request, pk, action, phone, amount):
+    """
+    Runs the transaction under the request's Idempotency-Key, like the DRF views, and
+    returns the response.
+    """
+
+    def execute():
+        merchant = get_object_or_404(Merchant, id=pk)
+        try:
+            if action == "add_credit":
+                merchant.transaction(action=action, phone=None, amount=amount)
+                return json_response({"message": "Successfully added credits."})
+            with velocity_checks.admit(merchant.id, phone, amount):
+                merchant_credit = merchant.transaction(
+                    action="subtract_credit", phone=phone, amount=amount
+                )
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            return _bad_request(e)
+        return json_response(
+            {
+                "message": "Successfully bought charge.",
+                "amount": amount,
+                "merchant_credit": merchant_credit,
+            }
+        )
+
+    if action == "add_credit":
+        params = {"credit": amount}
+    else:
+        params = {"phone": phone, "amount": amount}
+    with merchant_shard(pk):
+        response = run_idempotent(request, pk, action, params, execute)
+    if isinstance(response, JsonResponse):
+        return response
+    # A replayed or rejected key comes back as a DRF Response.
+    rendered = JsonResponse(response.data, status=response.status_code)
+    if response.has_header("Idempotent-Replayed"):
+        rendered["Idempotent-Replayed"] = response["Idempotent-Replayed"]
+    return rendered
+
+
+def _reserve(pk, phone, amount):
+    with merchant_shard(pk):
+        merchant = get_object_or_404(Merchant, id=pk)
+    return merchant, velocity_checks.reserve(merchant.id, phone, amount)
+
+
+async def _combined_charge(pk, phone, amount):
+    """
+    Buys charge through the write combiner. The charge waits for its batch on the event
+    loop, so only the batch's debit takes a thread of the database pool.
+    """
+    merchant, reservation = await run_in_pool(_reserve, pk, phone, amount)
+    try:
+        merchant_credit = await charge_combiner.acharge(merchant, phone, amount)
+    except Exception:
+        # Not on cancellation: the charge stays in its batch and is still applied.
+        velocity_checks.cancel(reservation)
+        raise
+    return json_response(
+        {
+            "message": "Successfully bought charge.",
+            "amount": amount,
+            "merchant_credit": merchant_credit,
+        }
+    )
+
+
+def _limits(pk):
+    with merchant_shard(pk):
+        return charge_admission.limits(pk)
+
+
+@replica_reads()
+def _get_credit(pk):
+    credit = Merchant.get_cached_credit(pk)
+    if credit is None:
+        raise Http404
+    return credit
+
+
+@csrf_exempt
+async def add_credit(request, pk):
+    """
+    The async view that adds credit to merchant.
+    """
+    if request.method != "POST":
+        return JsonResponse({"detail": "Method not allowed."}, status=405)
+    try:
+        credit = validate_credit(_request_data(request))
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    if credit < 0:
+        return _bad_request("Cannot accept Negative credit amount.")
+    try:
+        return await run_in_pool(_transaction, request, pk, "add_credit", None, credit)
+    except Http404:
+        raise
+    except Exception as e:
+        return _bad_request(e)
+
+
+@csrf_exempt
+async def buy_charge(request, pk):
+    """
+    The async view that buys charge for a particular phonenumber using a particular merchant.
+    """
+    if request.method != "POST":
+        return JsonResponse({"detail": "Method not allowed."}, status=405)
+    try:
+        phone, amount = validate_charge(_request_data(request))
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    if charge_admission.cached_limits(pk) is None:
+        # Loading the limits queries the database.
+        await run_in_pool(_limits, pk)
+    # The combiner commits in another thread's transaction, which cannot include the
+    # idempotency key.
+    combine = settings.B2B_CHARGE_WRITE_COMBINING and HEADER not in request.META
+    try:
+        with charge_admission.admit(pk):
+            if combine:
+                return await _combined_charge(pk, phone, amount)
+            return await run_in_pool(
+                _transaction, request, pk, "buy_charge", phone, amount
+            )
+    except AdmissionRejected as e:
+        return _too_many_requests(e)
+    except Http404:
+        raise
+    except Exception as e:
+        return _bad_request(e)
+
+
+async def get_credit(request, pk):
+    """
+    The async view that returns overall credit for a particular merchant.
+    """
+    if request.method != "GET":
+        return JsonResponse({"detail": "Method not allowed."}, status=405)
+    credit = await run_in_pool(_get_credit, pk)
+    return JsonResponse({"merchant_id": pk, "credit": credit})
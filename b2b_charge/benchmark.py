@@ -0,0 +1,275 @@
+"""
+Load generator for the charge endpoints.
+
+Requests are driven either in-process through Django's test ``Client`` (the whole
+middleware and view stack, no network) or over HTTP against a running server, from
+several threads and optionally several processes. The merchant picked for each request
+follows a configurable skew, from a single hot merchant to a uniform spread.
+
+The report is a JSON-serialisable dict with per-endpoint latency percentiles, overall
+throughput, SQL queries per request (in-process only) and a consistency check that
+every merchant's credit equals the sum of its transaction logs.
+"""
+
+import http.client
+import json
+import multiprocessing
+import random
+import threading
+import time
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass, field
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+
+from .models import Merchant, TransactionLog
+
+ENDPOINTS = ("add-credit", "buy-charge", "get-credit")
+SKEWS = ("hot", "uniform", "zipf")
+
+
+@dataclass
+class BenchmarkConfig:
+    requests: int = 1000
+    threads: int = 8
+    processes: int = 1
+    merchants: int = 10
+    skew: str = "uniform"
+    initial_credit: int = 10**9
+    # Relative weights of the endpoints in the mix.
+    mix: dict = field(
+        default_factory=lambda: {"add-credit": 1, "buy-charge": 8, "get-credit": 1}
+    )
+    transport: str = "inprocess"
+    base_url: str = "http://127.0.0.1:8000"
+    api_prefix: str = "/api/v1/"
+    seed: int = 0
+
+
+def percentile(values, p):
+    """
+    Returns the ``p``-th percentile (0-100) of ``values`` by linear interpolation.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def pick_merchant(rng, merchant_ids, skew):
+    if skew == "hot":
+        return merchant_ids[0]
+    if skew == "zipf":
+        weights = [1 / (rank + 1) for rank in range(len(merchant_ids))]
+        return rng.choices(merchant_ids, weights=weights)[0]
+    return rng.choice(merchant_ids)
+
+
+def setup_merchants(config):
+    """
+    Creates fresh merchants funded through a logged transaction, so that their credit
+    equals the sum of their logs from the start.
+    """
+    merchant_ids = []
+    for _ in range(config.merchants):
+        merchant = Merchant.create_merchant()
+        merchant.transaction(
+            action="add_credit", phone=None, amount=config.initial_credit
+        )
+        merchant_ids.append(merchant.id)
+    return merchant_ids
+
+
+class _InProcessTransport:
+    def __init__(self, config):
+        # "testserver" is only allowed under the test runner.
+        self.client = Client(SERVER_NAME=(settings.ALLOWED_HOSTS or ["localhost"])[0])
+        self.prefix = config.api_prefix
+
+    def request(self, endpoint, merchant_id, data):
+        url = "%smerchant/%d/%s/" % (self.prefix, merchant_id, endpoint)
+        if endpoint == "get-credit":
+            return self.client.get(url).status_code
+        return self.client.post(url, data=data).status_code
+
+
+class _HTTPTransport:
+    def __init__(self, config):
+        parts = urlsplit(config.base_url)
+        connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.connection = connection_class(parts.netloc, timeout=30)
+        self.prefix = parts.path.rstrip("/") + config.api_prefix
+
+    def request(self, endpoint, merchant_id, data):
+        url = "%smerchant/%d/%s/" % (self.prefix, merchant_id, endpoint)
+        if endpoint == "get-credit":
+            self.connection.request("GET", url)
+        else:
+            self.connection.request(
+                "POST",
+                url,
+                body=json.dumps(data),
+                headers={"Content-Type": "application/json"},
+            )
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+
+def _worker(config, merchant_ids, count, seed):
+    """
+    Sends ``count`` requests and returns ``{endpoint: [(latency, status, queries)]}``.
+    """
+    rng = random.Random(seed)
+    endpoints = list(config.mix)
+    weights = [config.mix[endpoint] for endpoint in endpoints]
+    transport = (
+        _HTTPTransport(config)
+        if config.transport == "http"
+        else _InProcessTransport(config)
+    )
+    samples = {endpoint: [] for endpoint in endpoints}
+    queries = [0]
+
+    def count_queries(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        # Replica reads and sharded merchants run their queries on other aliases.
+        for alias_connection in connections.all():
+            stack.enter_context(alias_connection.execute_wrapper(count_queries))
+        for _ in range(count):
+            endpoint = rng.choices(endpoints, weights=weights)[0]
+            merchant_id = pick_merchant(rng, merchant_ids, config.skew)
+            if endpoint == "add-credit":
+                data = {"credit": rng.choice([1000, 5000, 10000])}
+            else:
+                data = {
+                    "phone": rng.randint(9000000000, 9999999999),
+                    "amount": rng.choice([1000, 2000, 5000, 10000, 20000]),
+                }
+            queries[0] = 0
+            started = time.perf_counter()
+            response_status = transport.request(endpoint, merchant_id, data)
+            samples[endpoint].append(
+                (time.perf_counter() - started, response_status, queries[0])
+            )
+    if threading.current_thread() is not threading.main_thread():
+        connections.close_all()
+    return samples
+
+
+def _run_threads(config, merchant_ids, count, seed):
+    if config.threads == 1:
+        return _worker(config, merchant_ids, count, seed)
+    results = [None] * config.threads
+    share, extra = divmod(count, config.threads)
+
+    def run(index):
+        results[index] = _worker(
+            config, merchant_ids, share + (index < extra), seed * 1000 + index
+        )
+
+    threads = [
+        threading.Thread(target=run, args=(index,)) for index in range(config.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return _merge(results)
+
+
+def _run_process(args):
+    config, merchant_ids, count, seed = args
+    return _run_threads(config, merchant_ids, count, seed)
+
+
+def _merge(results):
+    merged = {}
+    for samples in results:
+        for endpoint, values in samples.items():
+            merged.setdefault(endpoint, []).extend(values)
+    return merged
+
+
+def check_consistency(merchant_ids):
+    """
+    Returns the merchants whose credit differs from the sum of their logs.
+    """
+    mismatches = []
+    for merchant in Merchant.objects.filter(id__in=merchant_ids):
+        credit = merchant.get_ledger_credit()
+        logged = TransactionLog.get_merchant_credit_sum(merchant) or 0
+        if credit != logged or credit < 0:
+            mismatches.append(
+                {"merchant_id": merchant.id, "credit": credit, "logs": logged}
+            )
+    return mismatches
+
+
+def run_benchmark(config, merchant_ids=None):
+    """
+    Runs the benchmark described by ``config`` and returns the report.
+    """
+    if merchant_ids is None:
+        merchant_ids = setup_merchants(config)
+
+    started = time.perf_counter()
+    if config.processes > 1:
+        # Forked children must not share the parent's database connections.
+        connections.close_all()
+        share, extra = divmod(config.requests, config.processes)
+        jobs = [
+            (config, merchant_ids, share + (index < extra), config.seed + index + 1)
+            for index in range(config.processes)
+        ]
+        with multiprocessing.get_context("fork").Pool(config.processes) as pool:
+            samples = _merge(pool.map(_run_process, jobs))
+    else:
+        samples = _run_threads(config, merchant_ids, config.requests, config.seed)
+    elapsed = time.perf_counter() - started
+
+    endpoints = {}
+    for endpoint, values in samples.items():
+        latencies = [latency for latency, _, _ in values]
+        ok = [value for value in values if value[1] == 200]
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "ok": len(ok),
+            "errors": len(values) - len(ok),
+            "p50_ms": _ms(percentile(latencies, 50)),
+            "p95_ms": _ms(percentile(latencies, 95)),
+            "p99_ms": _ms(percentile(latencies, 99)),
+            "queries_per_request": (
+                sum(queries for _, _, queries in values) / len(values)
+                if values and config.transport != "http"
+                else None
+            ),
+        }
+    total = sum(len(values) for values in samples.values())
+    charges = endpoints.get("buy-charge", {}).get("ok", 0)
+    mismatches = check_consistency(merchant_ids)
+    return {
+        "config": asdict(config),
+        "elapsed_s": elapsed,
+        "requests_per_s": total / elapsed if elapsed else None,
+        "charges_per_s": charges / elapsed if elapsed else None,
+        "endpoints": endpoints,
+        "consistency": {"ok": not mismatches, "mismatches": mismatches},
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
@@ -0,0 +1,255 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class LRUCache:
+    """
+    A thread-safe, in-process LRU cache whose entries expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def add(self, key, value):
+        """
+        Sets ``key`` only if it is not cached yet. Returns True if it was set.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                return False
+            self._set(key, value)
+            return True
+
+    def _set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class BalanceCache:
+    """
+    Caches merchant credits for the <get-credit> reads.
+
+    Every change of a merchant or balance shard row bumps its ``version`` in the same
+    UPDATE. Writers publish the rows they changed after commit, readers the rows they
+    read along with their versions, and a row is only replaced by a newer version, so
+    neither callbacks that run out of order nor slow readers ever bring an older balance
+    back.
+
+    Entries are ``(version, credit, balance_shards, parts)`` for the merchant row, where
+    ``parts`` maps the number of each balance shard to its ``(version, credit)``. Shards
+    are published one at a time, and the entry is a miss until every shard is known.
+    When the merchant row skips a version, the shards are dropped until published again,
+    as the missed change may have been a rebalance.
+
+    ``invalidate`` leaves a tombstone instead of deleting the entry, so a reader that read
+    the old credit cannot fill it in after. Until it expires, the tombstone is a miss
+    that neither readers nor writers replace.
+
+    The backend is the in-process LRU by default. ``B2B_CHARGE_BALANCE_CACHE_BACKEND`` can
+    name a Django cache alias instead, or be empty to disable caching. In process the
+    compare-and-set holds a lock. With a shared alias it holds a lock key taken with
+    ``cache.add`` instead, which writers wait for and readers skip filling on, so other
+    processes cannot slip an older row in between.
+    """
+
+    # Nothing is known of the merchant row yet.
+    EMPTY = (None, None, 1, {})
+    # Newer than every version, so only its expiry removes it.
+    TOMBSTONE = (float("inf"), None, 1, {})
+    # Seconds the lock key of a shared alias outlives a process that died holding it.
+    LOCK_TIMEOUT = 5
+
+    def __init__(self):
+        self._local = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(settings.B2B_CHARGE_BALANCE_CACHE_BACKEND)
+
+    def _backend(self):
+        alias = settings.B2B_CHARGE_BALANCE_CACHE_BACKEND
+        if alias == "local":
+            if self._local is None:
+                self._local = LRUCache(
+                    max_size=settings.B2B_CHARGE_BALANCE_CACHE_MAX_SIZE,
+                    ttl=settings.B2B_CHARGE_BALANCE_CACHE_TTL,
+                )
+            return self._local
+        return caches[alias]
+
+    @staticmethod
+    def _key(merchant_id):
+        return "b2b_charge:credit:%d" % merchant_id
+
+    @staticmethod
+    def _credit(entry):
+        if entry is None:
+            return None
+        _, credit, balance_shards, parts = entry
+        if credit is None or balance_shards == 1:
+            return credit
+        if any(number not in parts for number in range(balance_shards)):
+            return None
+        return credit + sum(parts[number][1] for number in range(balance_shards))
+
+    def get(self, merchant_id):
+        """
+        Returns the cached credit of the merchant, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        credit = self._credit(self._backend().get(self._key(merchant_id)))
+        with self._lock:
+            if credit is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return credit
+
+    def publish(self, merchant_id, credit, version, balance_shards=1, parts=None):
+        """
+        Caches a committed merchant row, unless a newer one is already cached, along
+        with the ``(version, credit)`` of its shards by number when they are known.
+        """
+        self._merge(merchant_id, (version, credit, balance_shards), parts or {})
+
+    def fill(self, merchant_id, credit, version, balance_shards=1, parts=None):
+        """
+        Caches a merchant row read by a reader, the same way as ``publish``, but skips
+        it while another process is merging the entry instead of waiting.
+        """
+        self._merge(
+            merchant_id, (version, credit, balance_shards), parts or {}, wait=False
+        )
+
+    def publish_shard(self, merchant_id, number, credit, version):
+        """
+        Caches a committed balance shard, unless a newer one is already cached.
+        """
+        self._merge(merchant_id, None, {number: (version, credit)})
+
+    def _merge(self, merchant_id, row, parts, wait=True):
+        if not self.enabled:
+            return
+        backend = self._backend()
+        key = self._key(merchant_id)
+        with self._locked(backend, key, wait) as locked:
+            if not locked:
+                return
+            entry = backend.get(key) or self.EMPTY
+            if entry == self.TOMBSTONE:
+                return
+            version, credit, balance_shards, cached = entry
+            cached = dict(cached)
+            if row is not None and (version is None or row[0] > version):
+                if version is not None and row[0] > version + 1:
+                    cached = {}
+                version, credit, balance_shards = row
+            for number, part in parts.items():
+                if number not in cached or cached[number][0] < part[0]:
+                    cached[number] = part
+            backend.set(
+                key,
+                (version, credit, balance_shards, cached),
+                **self._timeout_kwargs(),
+            )
+
+    def invalidate(self, merchant_id):
+        """
+        Replaces the cached credit with a tombstone, for changes without a version.
+        """
+        if not self.enabled:
+            return
+        backend = self._backend()
+        key = self._key(merchant_id)
+        with self._locked(backend, key, wait=True):
+            # Set even when the lock could not be taken, as a tombstone is never stale.
+            backend.set(key, self.TOMBSTONE, **self._timeout_kwargs())
+
+    @contextmanager
+    def _locked(self, backend, key, wait):
+        """
+        Makes the compare-and-set on ``key`` atomic. Yields False when ``wait`` is off
+        and the key is busy, or when the lock key of a shared alias is still taken after
+        ``LOCK_TIMEOUT`` seconds.
+        """
+        if backend is self._local:
+            with self._lock:
+                yield True
+            return
+        lock = key + ":lock"
+        deadline = time.monotonic() + self.LOCK_TIMEOUT
+        while not backend.add(lock, 1, timeout=self.LOCK_TIMEOUT):
+            if not wait or time.monotonic() > deadline:
+                yield False
+                return
+            time.sleep(0.001)
+        try:
+            yield True
+        finally:
+            backend.delete(lock)
+
+    def clear(self):
+        if self._local is not None:
+            self._local.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def _timeout_kwargs(self):
+        if settings.B2B_CHARGE_BALANCE_CACHE_BACKEND == "local":
+            return {}
+        return {"timeout": settings.B2B_CHARGE_BALANCE_CACHE_TTL}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._local) if self._local is not None else None,
+            }
+
+
+balance_cache = BalanceCache()
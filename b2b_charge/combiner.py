@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+from .async_db import run_in_pool
+
+
+class _Batch:
+    """
+    The charges collected for one merchant during one combining window.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.accepted = None
+        self.credit = None
+        self.error = None
+        self.done = threading.Event()
+        # Futures of the async callers waiting for the batch, each on its own loop.
+        self.waiters = []
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ChargeCombiner:
+    """
+    Coalesces concurrent charges for the same merchant into a single debit.
+
+    The first charge for a merchant becomes the leader of a batch. It waits for the
+    combining window, takes every charge that arrived in the meantime and runs them with
+    one ``Merchant.batch_transaction`` (one conditional UPDATE and a ``bulk_create`` of the
+    logs). The other callers just wait for the leader to publish their result.
+    Charges that would overdraw the merchant still fail individually.
+
+    Async callers use ``acharge``, which waits on the event loop: only the leader's
+    debit takes a thread of the database pool, however many charges wait on it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queue_depth = 0
+        self._batches = 0
+        self._charges = 0
+        self._max_batch_size = 0
+
+    def _join(self, merchant, phone, amount):
+        """
+        Adds the charge to the merchant's open batch, or opens one. Returns the batch,
+        the charge's index in it and whether the caller leads the batch.
+        """
+        with self._lock:
+            batch = self._pending.get(merchant.id)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._pending[merchant.id] = _Batch()
+            index = len(batch.items)
+            batch.items.append((phone, amount))
+            if len(batch.items) >= settings.B2B_CHARGE_WRITE_COMBINING_MAX_BATCH:
+                # Full. Later charges start a new batch.
+                del self._pending[merchant.id]
+            self._queue_depth += 1
+        return batch, index, is_leader
+
+    def _result(self, merchant, batch, index):
+        if batch.error is not None:
+            raise batch.error
+        if not batch.accepted[index]:
+            raise Exception(
+                "subtract_credit: Negative Credits happened. Cannot Continue. merchant_id: %d"
+                % (merchant.id)
+            )
+        return batch.credit
+
+    def charge(self, merchant, phone, amount):
+        """
+        Buys charge through the combining queue and returns the merchant's credit after
+        the batch. Raises an Exception if this charge could not be applied.
+        """
+        batch, index, is_leader = self._join(merchant, phone, amount)
+        if is_leader:
+            time.sleep(settings.B2B_CHARGE_WRITE_COMBINING_WINDOW_MS / 1000)
+            self._apply(merchant, batch)
+        else:
+            batch.done.wait()
+        return self._result(merchant, batch, index)
+
+    async def acharge(self, merchant, phone, amount):
+        """
+        Like ``charge``, without holding a thread while the batch fills or runs.
+        """
+        batch, index, is_leader = self._join(merchant, phone, amount)
+        if is_leader:
+            # The batch runs even if the leader's request is cancelled, as the other
+            # callers wait on it.
+            await asyncio.shield(self._lead(merchant, batch))
+        else:
+            future = asyncio.get_running_loop().create_future()
+            with self._lock:
+                if not batch.done.is_set():
+                    batch.waiters.append(future)
+                else:
+                    future.set_result(None)
+            await future
+        return self._result(merchant, batch, index)
+
+    async def _lead(self, merchant, batch):
+        await asyncio.sleep(settings.B2B_CHARGE_WRITE_COMBINING_WINDOW_MS / 1000)
+        await run_in_pool(self._apply, merchant, batch)
+
+    def _apply(self, merchant, batch):
+        """
+        Closes the batch and applies it, then wakes its waiting callers.
+        """
+        with self._lock:
+            if self._pending.get(merchant.id) is batch:
+                del self._pending[merchant.id]
+            items = list(batch.items)
+        try:
+            batch.accepted = merchant.batch_transaction(items)
+            batch.credit = merchant.get_credit()
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                self._queue_depth -= len(items)
+                self._batches += 1
+                self._charges += len(items)
+                self._max_batch_size = max(self._max_batch_size, len(items))
+                batch.done.set()
+            for future in batch.waiters:
+                future.get_loop().call_soon_threadsafe(_wake, future)
+
+    def stats(self):
+        """
+        Returns the current queue depth and the batch size statistics.
+        """
+        with self._lock:
+            return {
+                "queue_depth": self._queue_depth,
+                "batches": self._batches,
+                "charges": self._charges,
+                "max_batch_size": self._max_batch_size,
+                "mean_batch_size": (
+                    self._charges / self._batches if self._batches else 0.0
+                ),
+            }
+
+
+charge_combiner = ChargeCombiner()
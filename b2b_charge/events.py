@@ -0,0 +1,358 @@
+"""
+Change feed of the committed transactions, for downstream consumers.
+
+With ``B2B_CHARGE_EVENTS`` enabled, ``TransactionLog.log`` and ``bulk_log`` also write a
+``TransactionEvent`` for every entry, in the same transaction as the credit change, so
+an event exists if and only if its transaction committed. ``relay_events`` publishes
+the events to a sink in batches and deletes them from the outbox in the same
+transaction. A relay that dies after publishing and before committing publishes the
+batch again, so delivery is at least once: consumers drop duplicates by
+``(source, event_id)``, or by ``log_id`` when it is set. Events are published in the
+order of their ids within a shard. Only one relay per shard runs at a time, behind a
+transaction-level advisory lock on PostgreSQL.
+
+The sink is named by ``B2B_CHARGE_EVENT_SINK``:
+
+* ``file:<path>`` appends JSON lines to a file. Offsets are byte positions in it.
+* ``unix:<path>`` writes JSON lines to a Unix socket. It cannot be read back.
+* ``cache:<alias>`` keeps a numbered stream in a Django cache, e.g. a Redis one, for
+  ``B2B_CHARGE_EVENT_RETENTION`` seconds.
+
+``EventConsumer`` reads a sink from the offset it committed last. ``replay_logs``
+rebuilds the events of the transaction log from a log id, for consumers that start
+from scratch or fell behind the retention of the sink.
+"""
+
+import fcntl
+import json
+import os
+import socket
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.transaction import atomic
+
+from .models import ConsumerOffset, TransactionEvent, TransactionLog
+from .sharding import merchant_shard, shard_aliases
+
+LOCK_KEY = zlib.crc32(b"b2b_charge_event_relay")
+
+EVENT_FIELDS = (
+    "merchant_id",
+    "phone",
+    "amount",
+    "balance_after",
+    "shard",
+    "is_transfer",
+    "created_time",
+)
+
+
+def _event(row, source, event_id, log_id):
+    event = dict(zip(EVENT_FIELDS, row))
+    if event["is_transfer"]:
+        kind = "transfer"
+    elif event["amount"] < 0:
+        kind = "charge"
+    else:
+        kind = "credit"
+    event.update(
+        type=kind,
+        source=source,
+        event_id=event_id,
+        log_id=log_id,
+        created_time=event["created_time"].isoformat(),
+    )
+    return event
+
+
+def _encode(events):
+    return "".join(
+        json.dumps(event, separators=(",", ":")) + "\n" for event in events
+    ).encode()
+
+
+class FileSink:
+    """
+    Appends events to a file as JSON lines. The offset of an event is the position
+    right after its line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, events):
+        data = _encode(events)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Relays of different shards may append at the same time.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            while data:
+                data = data[os.write(fd, data) :]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self, offset, limit):
+        """
+        Returns up to ``limit`` ``(offset, event)`` pairs after ``offset``.
+        """
+        try:
+            stream = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        events = []
+        with stream:
+            stream.seek(offset)
+            for line in stream:
+                # A batch that is still being written.
+                if not line.endswith(b"\n") or len(events) >= limit:
+                    break
+                offset += len(line)
+                events.append((offset, json.loads(line)))
+        return events
+
+
+class SocketSink:
+    """
+    Writes events as JSON lines to a Unix stream socket, one connection per batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, events):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall(_encode(events))
+
+    def read(self, offset, limit):
+        raise Exception("SocketSink: A socket cannot be read back. Replay the log.")
+
+
+class CacheSink:
+    """
+    Keeps events under consecutive numbers in a Django cache. The head, the number of
+    the latest event, only moves once the events below it are stored, so readers never
+    see a gap that is later filled. Gaps below the head are events that expired.
+    """
+
+    PREFIX = "b2b_charge:events"
+    LOCK_TIMEOUT = 30
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def _key(self, offset):
+        return "%s:%d" % (self.PREFIX, offset)
+
+    def head(self):
+        return caches[self.alias].get(self._key(0), 0)
+
+    def publish(self, events):
+        cache = caches[self.alias]
+        lock = self.PREFIX + ":lock"
+        while not cache.add(lock, 1, timeout=self.LOCK_TIMEOUT):
+            time.sleep(0.01)
+        try:
+            head = self.head()
+            cache.set_many(
+                {
+                    self._key(head + index): event
+                    for index, event in enumerate(events, 1)
+                },
+                timeout=settings.B2B_CHARGE_EVENT_RETENTION,
+            )
+            cache.set(self._key(0), head + len(events), timeout=None)
+        finally:
+            cache.delete(lock)
+
+    def read(self, offset, limit):
+        numbers = range(offset + 1, min(self.head(), offset + limit) + 1)
+        found = caches[self.alias].get_many([self._key(number) for number in numbers])
+        return [
+            (number, found[self._key(number)])
+            for number in numbers
+            if self._key(number) in found
+        ]
+
+
+SINKS = {"file": FileSink, "unix": SocketSink, "cache": CacheSink}
+
+
+def get_sink(name=None):
+    """
+    Returns the sink named like ``B2B_CHARGE_EVENT_SINK``, which is the default.
+    """
+    kind, _, target = (name or settings.B2B_CHARGE_EVENT_SINK).partition(":")
+    if kind not in SINKS:
+        raise Exception("get_sink: Unknown event sink %s." % (kind))
+    return SINKS[kind](target)
+
+
+def _relay_batch(connection, sink, batch_size, wait):
+    """
+    Publishes up to ``batch_size`` of the oldest events and deletes them. Returns how
+    many were published, or None if another relay holds the lock.
+    """
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                (
+                    "SELECT pg_advisory_xact_lock(%s), true"
+                    if wait
+                    else "SELECT pg_try_advisory_xact_lock(%s)"
+                ),
+                [LOCK_KEY],
+            )
+            if not cursor.fetchone()[-1]:
+                return None
+    events = TransactionEvent.objects.using(connection.alias)
+    rows = list(
+        events.order_by("id").values_list("id", "log_id", *EVENT_FIELDS)[:batch_size]
+    )
+    if rows:
+        sink.publish(
+            [
+                _event(row[2:], connection.alias, event_id=row[0], log_id=row[1])
+                for row in rows
+            ]
+        )
+        events.filter(id__in=[row[0] for row in rows]).delete()
+    return len(rows)
+
+
+def relay_events(sink=None, batch_size=None, using=None, wait=True):
+    """
+    Publishes every event of the outbox, one transaction per batch, and returns the
+    number published. With ``wait=False`` it gives up, returning 0, when another relay
+    is running. Every shard's outbox is relayed unless ``using`` names one.
+    """
+    sink = sink or get_sink()
+    batch_size = batch_size or settings.B2B_CHARGE_EVENT_BATCH_SIZE
+    if using is None:
+        return sum(
+            relay_events(sink, batch_size, alias, wait) for alias in shard_aliases()
+        )
+    connection = connections[using]
+    published = 0
+    while True:
+        with atomic(using=using):
+            count = _relay_batch(connection, sink, batch_size, wait)
+        if count is None:
+            return published
+        published += count
+        if count < batch_size:
+            return published
+
+
+def run_relay(interval, sink=None, batch_size=None, callback=None):
+    """
+    Relays the outbox every ``interval`` seconds until interrupted. ``callback`` is
+    called with the number of events published by each pass.
+    """
+    sink = sink or get_sink()
+    while True:
+        started = time.monotonic()
+        published = relay_events(sink, batch_size, wait=False)
+        if callback is not None:
+            callback(published)
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+def replay_logs(after_log_id=0, merchant_id=None, batch_size=None):
+    """
+    Yields the events of the transaction log rows above ``after_log_id``, in id order
+    within each shard, optionally only for one merchant. Entries still in the log
+    outbox are not replayed. Their ``event_id`` is None.
+    """
+    batch_size = batch_size or settings.B2B_CHARGE_EVENT_BATCH_SIZE
+    if merchant_id is None:
+        aliases = shard_aliases()
+    else:
+        with merchant_shard(merchant_id) as alias:
+            aliases = [alias]
+    for alias in aliases:
+        logs = TransactionLog.objects.using(alias)
+        if merchant_id is not None:
+            logs = logs.filter(merchant_id=merchant_id)
+        last_id = after_log_id
+        while True:
+            rows = list(
+                logs.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", *EVENT_FIELDS)[:batch_size]
+            )
+            for row in rows:
+                yield _event(row[1:], alias, event_id=None, log_id=row[0])
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+
+class EventConsumer:
+    """
+    Reads the events of a sink after the offset last committed under ``name``. Events
+    returned by ``poll`` come again after a restart until ``commit`` stores an offset
+    past them.
+    """
+
+    def __init__(self, name, sink=None):
+        self.name = name
+        self.sink = sink or get_sink()
+        self.position = self.committed()
+
+    def committed(self):
+        """
+        Returns the offset last committed by the consumer, 0 for a new one.
+        """
+        offset = (
+            ConsumerOffset.objects.using(DEFAULT_DB_ALIAS)
+            .filter(name=self.name)
+            .values_list("offset", flat=True)
+            .first()
+        )
+        return offset or 0
+
+    def poll(self, limit=None):
+        """
+        Returns up to ``limit`` events after the current position, each with its
+        ``offset``, and moves the position past them.
+        """
+        limit = limit or settings.B2B_CHARGE_EVENT_BATCH_SIZE
+        events = self.sink.read(self.position, limit)
+        if events:
+            self.position = events[-1][0]
+        return [dict(event, offset=offset) for offset, event in events]
+
+    def seek(self, offset):
+        """
+        Moves the position, to replay events or skip them. Only ``commit`` stores it.
+        """
+        self.position = offset
+
+    def commit(self, offset=None):
+        """
+        Stores the current position, or ``offset``, as processed.
+        """
+        if offset is not None:
+            self.position = offset
+        ConsumerOffset.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+            name=self.name, defaults={"offset": self.position}
+        )
+
+    def run(self, handler, interval=1.0, limit=None):
+        """
+        Hands every batch of events to ``handler`` and commits it once the handler
+        returns, until interrupted. Waits ``interval`` seconds when there is nothing new.
+        """
+        while True:
+            events = self.poll(limit)
+            if not events:
+                time.sleep(interval)
+                continue
+            handler(events)
+            self.commit()
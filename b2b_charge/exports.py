@@ -0,0 +1,58 @@
+import csv
+import json
+
+from django.conf import settings
+
+EXPORT_FIELDS = ("id", "created_time", "phone", "amount", "balance_after")
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+class _Echo:
+    """
+    A file-like object whose ``write`` returns the value, so ``csv.writer`` can be
+    used to format one row at a time.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _rows(logs, chunk_size):
+    """
+    Yields the export fields of ``logs`` in id order through a server-side cursor,
+    so only ``chunk_size`` rows are held in memory at a time.
+    """
+    chunk_size = chunk_size or settings.B2B_CHARGE_EXPORT_CHUNK_SIZE
+    return (
+        logs.order_by("id").values_list(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    )
+
+
+def iter_csv(logs, chunk_size=None):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for log_id, created_time, phone, amount, balance_after in _rows(logs, chunk_size):
+        yield writer.writerow(
+            (log_id, created_time.isoformat(), phone, amount, balance_after)
+        )
+
+
+def iter_ndjson(logs, chunk_size=None):
+    for row in _rows(logs, chunk_size):
+        record = dict(zip(EXPORT_FIELDS, row))
+        record["created_time"] = record["created_time"].isoformat()
+        yield json.dumps(record) + "\n"
+
+
+def iter_export(logs, output, chunk_size=None):
+    """
+    Returns an iterator of text chunks exporting ``logs`` as ``output`` (csv or ndjson).
+    """
+    if output == "csv":
+        return iter_csv(logs, chunk_size)
+    if output == "ndjson":
+        return iter_ndjson(logs, chunk_size)
+    raise ValueError("Unknown export format: %s" % (output))
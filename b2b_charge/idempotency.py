@@ -0,0 +1,101 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.transaction import atomic, on_commit
+from rest_framework import status
+from rest_framework.response import Response
+
+from .cache import LRUCache
+from .models import IdempotencyKey
+from .sharding import current_shard
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field("key").max_length
+
+# Fast path for retries hitting the same process: (merchant_id, key) -> stored response.
+_recent = LRUCache(max_size=50000, ttl=settings.B2B_CHARGE_IDEMPOTENCY_TTL)
+
+
+def request_hash(action, params):
+    """
+    Returns a fingerprint of the request, to detect a key reused for another request.
+    """
+    payload = json.dumps([action, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _lookup(merchant_id, key):
+    stored = _recent.get((merchant_id, key))
+    if stored is None:
+        stored = (
+            IdempotencyKey.objects.filter(merchant_id=merchant_id, key=key)
+            .values_list("request_hash", "response_status", "response_body")
+            .first()
+        )
+        if stored is not None:
+            _recent.set((merchant_id, key), stored)
+    return stored
+
+
+def _replay(stored, fingerprint):
+    stored_hash, response_status, response_body = stored
+    if stored_hash != fingerprint:
+        return Response(
+            {"message": "Idempotency-Key was already used for a different request."},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    response = Response(response_body, status=response_status)
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def run_idempotent(request, merchant_id, action, params, execute):
+    """
+    Runs ``execute()`` (which returns a Response) at most once per Idempotency-Key.
+
+    Without the header this is just ``execute()``. With it, a repeat returns the stored
+    response without touching the merchant. Otherwise the key is stored in the same
+    atomic block as the transaction, so a concurrent duplicate fails on the unique
+    index, its transaction rolls back and it returns the winner's response instead.
+    Only successful responses are stored, so a failed request can be retried.
+    Expired keys are deleted by the ``prune_idempotency_keys`` command.
+    """
+    key = request.META.get(HEADER)
+    if key is None:
+        return execute()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return Response(
+            {"message": "Invalid Idempotency-Key header."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    fingerprint = request_hash(action, params)
+    stored = _lookup(merchant_id, key)
+    if stored is not None:
+        return _replay(stored, fingerprint)
+
+    try:
+        with atomic(using=current_shard()):
+            response = execute()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            IdempotencyKey.objects.create(
+                merchant_id=merchant_id,
+                key=key,
+                action=action,
+                request_hash=fingerprint,
+                response_status=response.status_code,
+                response_body=response.data,
+            )
+            stored = (fingerprint, response.status_code, response.data)
+            on_commit(
+                lambda: _recent.set((merchant_id, key), stored), using=current_shard()
+            )
+    except IntegrityError:
+        stored = _lookup(merchant_id, key)
+        if stored is None:
+            raise
+        return _replay(stored, fingerprint)
+    return response
@@ -0,0 +1,110 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Sum
+from django.db.transaction import atomic
+
+from b2b_charge.models import (
+    Merchant,
+    MerchantBalanceShard,
+    PendingTransactionLog,
+    TransactionLog,
+)
+from b2b_charge.sharding import current_shard, shard_aliases, using_shard
+
+
+class Command(BaseCommand):
+    help = "Fills TransactionLog.balance_after for history written before the column existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Number of log rows read and updated at a time.",
+        )
+        parser.add_argument(
+            "--merchant",
+            type=int,
+            action="append",
+            dest="merchants",
+            help="Only backfill this merchant. Can be repeated.",
+        )
+
+    def handle(self, *args, **options):
+        for alias in shard_aliases():
+            with using_shard(alias):
+                self.backfill_shard(options)
+
+    def backfill_shard(self, options):
+        merchant_ids = (
+            TransactionLog.objects.filter(balance_after__isnull=True)
+            .values_list("merchant_id", flat=True)
+            .distinct()
+        )
+        if options["merchants"]:
+            merchant_ids = merchant_ids.filter(merchant_id__in=options["merchants"])
+
+        for merchant_id in list(merchant_ids):
+            updated = self.backfill_merchant(merchant_id, options["chunk_size"])
+            self.stdout.write("merchant %d: %d rows updated" % (merchant_id, updated))
+
+    def backfill_merchant(self, merchant_id, chunk_size):
+        """
+        Walks the merchant's log in id order, keeping a running balance for
+        Merchant.credit and for each balance shard.
+        """
+        # Every transaction updates the merchant row or one of its shards first, so
+        # while they are locked all of its logs up to the latest id are committed and no
+        # older ones can appear. Entries still in the outbox are already counted in the
+        # credits but not in the log.
+        with atomic(using=current_shard()):
+            credit, held = (
+                Merchant.objects.select_for_update()
+                .values_list("credit", "held_credit")
+                .get(id=merchant_id)
+            )
+            # The held credit belongs to the ledger of Merchant.credit.
+            balances = {None: credit + held}
+            balances.update(
+                MerchantBalanceShard.objects.select_for_update()
+                .filter(merchant_id=merchant_id)
+                .order_by("number")
+                .values_list("number", "credit")
+            )
+            last_id = TransactionLog.objects.filter(merchant_id=merchant_id).aggregate(
+                Max("id")
+            )["id__max"]
+            pending = list(
+                PendingTransactionLog.objects.filter(merchant_id=merchant_id)
+                .values("shard")
+                .annotate(logged=Sum("amount"))
+                .values_list("shard", "logged")
+            )
+        logged = (
+            TransactionLog.objects.filter(merchant_id=merchant_id, id__lte=last_id)
+            .values("shard")
+            .annotate(logged=Sum("amount"))
+            .values_list("shard", "logged")
+        )
+        # Credit that never went through a transaction (e.g. the initial credit).
+        for shard, amount in pending + list(logged):
+            balances[shard] = balances.get(shard, 0) - amount
+
+        updated = 0
+        cursor = 0
+        while True:
+            chunk = list(
+                TransactionLog.objects.filter(merchant_id=merchant_id, id__gt=cursor)
+                .order_by("id")
+                .only("id", "shard", "amount", "balance_after")[:chunk_size]
+            )
+            if not chunk:
+                return updated
+            missing = []
+            for log in chunk:
+                balances[log.shard] = balances.get(log.shard, 0) + log.amount
+                if log.balance_after is None:
+                    log.balance_after = balances[log.shard]
+                    missing.append(log)
+            TransactionLog.objects.bulk_update(missing, ["balance_after"])
+            updated += len(missing)
+            cursor = chunk[-1].id
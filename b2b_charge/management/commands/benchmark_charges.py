@@ -0,0 +1,75 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from b2b_charge.benchmark import ENDPOINTS, SKEWS, BenchmarkConfig, run_benchmark
+
+
+def _mix(value):
+    mix = {}
+    for part in value.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise ValueError("unknown endpoint %s" % (endpoint))
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives add-credit, buy-charge and get-credit from many threads/processes and "
+        "prints a JSON report with latency percentiles, throughput, queries per "
+        "request and a balance consistency check."
+    )
+
+    def add_arguments(self, parser):
+        defaults = BenchmarkConfig()
+        parser.add_argument("--requests", type=int, default=defaults.requests)
+        parser.add_argument("--threads", type=int, default=defaults.threads)
+        parser.add_argument("--processes", type=int, default=defaults.processes)
+        parser.add_argument("--merchants", type=int, default=defaults.merchants)
+        parser.add_argument("--skew", choices=SKEWS, default=defaults.skew)
+        parser.add_argument(
+            "--mix",
+            type=_mix,
+            default=defaults.mix,
+            help="Endpoint weights, e.g. add-credit=1,buy-charge=8,get-credit=1",
+        )
+        parser.add_argument(
+            "--transport", choices=("inprocess", "http"), default=defaults.transport
+        )
+        parser.add_argument("--base-url", default=defaults.base_url)
+        parser.add_argument(
+            "--api-prefix",
+            default=defaults.api_prefix,
+            help="Use /api/v1/async/ to benchmark the async views.",
+        )
+        parser.add_argument("--seed", type=int, default=defaults.seed)
+        parser.add_argument("--output", help="Also write the report to this file.")
+        parser.add_argument(
+            "--fail-on-inconsistency",
+            action="store_true",
+            help="Exit with an error if a balance does not match its logs.",
+        )
+
+    def handle(self, *args, **options):
+        config = BenchmarkConfig(
+            requests=options["requests"],
+            threads=options["threads"],
+            processes=options["processes"],
+            merchants=options["merchants"],
+            skew=options["skew"],
+            mix=options["mix"],
+            transport=options["transport"],
+            base_url=options["base_url"],
+            api_prefix=options["api_prefix"],
+            seed=options["seed"],
+        )
+        report = run_benchmark(config)
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as report_file:
+                report_file.write(output)
+        self.stdout.write(output)
+        if options["fail_on_inconsistency"] and not report["consistency"]["ok"]:
+            raise CommandError("Merchant balances do not match their transaction logs.")
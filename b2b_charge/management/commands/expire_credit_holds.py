@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from b2b_charge.models import CreditHold
+
+
+class Command(BaseCommand):
+    help = (
+        "Gives the credit of expired holds back to their merchants. Runs once, or keeps "
+        "sweeping with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Holds expired per transaction.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Seconds between sweeps. 0 sweeps once and exits.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            expired = CreditHold.expire_stale(options["batch_size"])
+            if expired or not options["interval"]:
+                self.stdout.write("%d credit holds expired." % expired)
+            if not options["interval"]:
+                return
+            try:
+                time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from b2b_charge.exports import EXPORT_FORMATS, iter_export
+from b2b_charge.models import Merchant, TransactionLog
+from b2b_charge.sharding import merchant_shard
+
+
+def _datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError("invalid datetime: %s" % (value))
+    return parsed
+
+
+class Command(BaseCommand):
+    help = "Streams a merchant's transaction log as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("merchant_id", type=int)
+        parser.add_argument("--output", choices=sorted(EXPORT_FORMATS), default="csv")
+        parser.add_argument(
+            "--file", help="Write to this path instead of standard output."
+        )
+        parser.add_argument("--phone", type=int)
+        parser.add_argument("--since", type=_datetime)
+        parser.add_argument("--until", type=_datetime)
+        parser.add_argument("--chunk-size", type=int)
+
+    def handle(self, *args, **options):
+        with merchant_shard(options["merchant_id"]) as alias:
+            if not Merchant.objects.filter(id=options["merchant_id"]).exists():
+                raise CommandError(
+                    "Merchant %d does not exist." % options["merchant_id"]
+                )
+
+        logs = TransactionLog.filter_history(
+            options["merchant_id"],
+            phone=options["phone"],
+            since=options["since"],
+            until=options["until"],
+        ).using(alias)
+        chunks = iter_export(logs, options["output"], options["chunk_size"])
+        if options["file"]:
+            with open(options["file"], "w", newline="") as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from b2b_charge.outbox import flush_pending_logs, run_flusher
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the transaction logs waiting in the outbox (B2B_CHARGE_LOG_OUTBOX) to "
+        "the transaction log table. Runs once, or keeps flushing with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.B2B_CHARGE_LOG_FLUSH_BATCH_SIZE,
+            help="Entries moved per transaction.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Seconds between flushes. 0 flushes once and exits.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["interval"]:
+            moved = flush_pending_logs(options["batch_size"])
+            self.stdout.write("%d transaction logs flushed." % moved)
+            return
+
+        def report(moved):
+            if moved:
+                self.stdout.write("%d transaction logs flushed." % moved)
+
+        try:
+            run_flusher(options["interval"], options["batch_size"], report)
+        except KeyboardInterrupt:
+            pass
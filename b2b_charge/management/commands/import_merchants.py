@@ -0,0 +1,56 @@
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from b2b_charge.provisioning import (
+    IMPORT_FORMATS,
+    create_merchants,
+    read_rows,
+    top_up_merchants,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates merchants (rows with credit) or tops them up (rows with merchant_id "
+        "and credit) from a CSV or NDJSON file. Failed rows are printed as NDJSON and "
+        "do not stop the import."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--mode", choices=("create", "top-up"), default="create")
+        parser.add_argument(
+            "--format",
+            choices=IMPORT_FORMATS,
+            help="Defaults to ndjson for .ndjson/.jsonl files and csv otherwise.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.B2B_CHARGE_LOG_BATCH_SIZE,
+            help="Rows applied per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        apply = create_merchants if options["mode"] == "create" else top_up_merchants
+        try:
+            rows = read_rows(options["path"], options["format"])
+            succeeded = failed = 0
+            while True:
+                chunk = list(islice(rows, options["chunk_size"]))
+                if not chunk:
+                    break
+                for result in apply(
+                    chunk, options["chunk_size"], first_row=succeeded + failed
+                ):
+                    if result["status"] == "success":
+                        succeeded += 1
+                    else:
+                        failed += 1
+                        self.stdout.write(json.dumps(result))
+        except OSError as e:
+            raise CommandError(e)
+        self.stderr.write("%d rows imported, %d failed." % (succeeded, failed))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from b2b_charge import partitioning
+
+
+class Command(BaseCommand):
+    help = (
+        "Manages monthly partitions of the transaction log on PostgreSQL: enables "
+        "partitioning, creates future partitions and detaches old ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--enable",
+            action="store_true",
+            help="Convert the transaction log into a partitioned table.",
+        )
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=3,
+            help="Number of future monthly partitions to keep created.",
+        )
+        parser.add_argument(
+            "--retain-months",
+            type=int,
+            help="Detach partitions that ended more than this many months ago.",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning is only supported on PostgreSQL.")
+
+        if not partitioning.is_partitioned():
+            if not options["enable"]:
+                raise CommandError(
+                    "The transaction log is not partitioned. Run with --enable first."
+                )
+            partitioning.enable_partitioning(options["months_ahead"])
+            self.stdout.write("Transaction log is now partitioned.")
+
+        for name in partitioning.create_future_partitions(options["months_ahead"]):
+            self.stdout.write("created %s" % name)
+        if options["retain_months"] is not None:
+            for name in partitioning.detach_old_partitions(options["retain_months"]):
+                self.stdout.write("detached %s" % name)
@@ -0,0 +1,19 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from b2b_charge.microbench import run_microbenchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the CPU time per call of validating and rendering the charge "
+        "endpoints, with the previous DRF serializer path and the lean one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        report = run_microbenchmark(options["iterations"])
+        self.stdout.write(json.dumps(report, indent=2))
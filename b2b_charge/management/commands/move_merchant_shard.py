@@ -0,0 +1,35 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from b2b_charge.sharding import move_merchant
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves a merchant, with its transaction logs and every other row of it, to "
+        "another shard while it keeps serving. Its writes pause for about "
+        "B2B_CHARGE_SHARD_MAP_TTL seconds near the end of the move."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("merchant_id", type=int)
+        parser.add_argument("target", help="Database alias of the target shard.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.B2B_CHARGE_LOG_FLUSH_BATCH_SIZE,
+            help="Number of rows copied and deleted per statement.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            report = move_merchant(
+                options["merchant_id"],
+                options["target"],
+                batch_size=options["batch_size"],
+            )
+        except Exception as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from b2b_charge.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes idempotency keys older than B2B_CHARGE_IDEMPOTENCY_TTL. Runs once, or "
+        "keeps pruning with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ttl",
+            type=int,
+            default=None,
+            help="Age in seconds after which keys are deleted.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=settings.B2B_CHARGE_IDEMPOTENCY_PRUNE_INTERVAL,
+            help="Seconds between passes. 0 prunes once and exits.",
+        )
+
+    def handle(self, *args, **options):
+        ttl = options["ttl"]
+        if ttl is None:
+            ttl = settings.B2B_CHARGE_IDEMPOTENCY_TTL
+        try:
+            while True:
+                started = time.monotonic()
+                deleted = IdempotencyKey.prune_expired(ttl)
+                if deleted or not options["interval"]:
+                    self.stdout.write("%d idempotency keys deleted." % deleted)
+                if not options["interval"]:
+                    return
+                time.sleep(max(0, options["interval"] - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
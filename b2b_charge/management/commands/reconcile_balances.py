@@ -0,0 +1,54 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from b2b_charge.reconciliation import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks every merchant's credit against its transaction log, reading only the "
+        "log rows written since the merchant's last balance snapshot, and stores new "
+        "snapshots. Exits with an error if any merchant drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Ignore the snapshots and sum the whole history again.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.B2B_CHARGE_RECONCILE_WORKERS,
+            help="Number of processes reconciling merchants in parallel.",
+        )
+        parser.add_argument(
+            "--merchant",
+            type=int,
+            action="append",
+            dest="merchants",
+            help="Only reconcile this merchant. Can be repeated.",
+        )
+        parser.add_argument(
+            "--safety-lag",
+            type=int,
+            default=settings.B2B_CHARGE_RECONCILE_SAFETY_LAG,
+            help="Seconds a log row must be old before a snapshot may cover it.",
+        )
+
+    def handle(self, *args, **options):
+        report = reconcile(
+            merchant_ids=options["merchants"],
+            full=options["full"],
+            workers=options["workers"],
+            safety_lag=options["safety_lag"],
+        )
+        self.stdout.write(json.dumps(report, indent=2))
+        if report["drifted"]:
+            raise CommandError(
+                "%d of %d merchants drifted from their transaction logs."
+                % (len(report["drifted"]), report["merchants"])
+            )
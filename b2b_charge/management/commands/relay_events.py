@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from b2b_charge.events import get_sink, relay_events, run_relay
+
+
+class Command(BaseCommand):
+    help = (
+        "Publishes the transaction events waiting in the outbox (B2B_CHARGE_EVENTS) to "
+        "the event sink. Runs once, or keeps relaying with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sink",
+            default=settings.B2B_CHARGE_EVENT_SINK,
+            help='Sink to publish to, e.g. "file:/var/lib/b2b/events.jsonl".',
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.B2B_CHARGE_EVENT_BATCH_SIZE,
+            help="Events published per transaction.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Seconds between passes. 0 relays once and exits.",
+        )
+
+    def handle(self, *args, **options):
+        sink = get_sink(options["sink"])
+        if not options["interval"]:
+            published = relay_events(sink, options["batch_size"])
+            self.stdout.write("%d transaction events published." % published)
+            return
+
+        def report(published):
+            if published:
+                self.stdout.write("%d transaction events published." % published)
+
+        try:
+            run_relay(options["interval"], sink, options["batch_size"], report)
+        except KeyboardInterrupt:
+            pass
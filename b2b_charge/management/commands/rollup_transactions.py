@@ -0,0 +1,58 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from b2b_charge.rollups import run_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Updates the hourly and daily per-merchant transaction rollups with the log rows "
+        "written since the last run. Runs once, or keeps running with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--safety-lag",
+            type=int,
+            default=settings.B2B_CHARGE_ROLLUP_SAFETY_LAG,
+            help="Seconds a log row must be old before it is counted.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.B2B_CHARGE_ROLLUP_BATCH_SIZE,
+            help="Log rows processed per transaction.",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Drop the rollups and rebuild them from the whole log.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Seconds between runs. 0 runs once and exits.",
+        )
+
+    def handle(self, *args, **options):
+        rebuild = options["rebuild"]
+        while True:
+            report = run_rollups(
+                safety_lag=options["safety_lag"],
+                batch_size=options["batch_size"],
+                rebuild=rebuild,
+            )
+            rebuild = False
+            if not options["interval"]:
+                self.stdout.write(json.dumps(report))
+                return
+            if report["log_rows"]:
+                self.stdout.write(json.dumps(report))
+            try:
+                time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from b2b_charge.models import Merchant
+from b2b_charge.sharding import merchant_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Splits the credit of hot merchants over several balance shard rows, so that "
+        "their charges stop serializing on a single row, or moves it back with --shards 1."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--merchant",
+            type=int,
+            action="append",
+            dest="merchants",
+            required=True,
+            help="Merchant to reshard. Can be repeated.",
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            required=True,
+            help="Number of balance shards, 1 to stop sharding.",
+        )
+
+    def handle(self, *args, **options):
+        if options["shards"] < 1:
+            raise CommandError("--shards must be at least 1.")
+        for merchant_id in options["merchants"]:
+            try:
+                with merchant_shard(merchant_id):
+                    merchant = Merchant.objects.get(id=merchant_id)
+            except Merchant.DoesNotExist:
+                raise CommandError("Merchant %d does not exist." % (merchant_id))
+            merchant.rebalance_shards(count=options["shards"])
+            self.stdout.write(
+                "Merchant %d: %d balance shards, credit %d."
+                % (merchant.id, merchant.balance_shards, merchant.get_credit())
+            )
@@ -0,0 +1,65 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from b2b_charge.events import EventConsumer, get_sink, replay_logs
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the transaction events after a consumer's committed offset to stdout "
+        "as JSON lines, and commits the offset after each batch. With --from-log-id it "
+        "replays the transaction log instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("consumer", help="Name the offset is committed under.")
+        parser.add_argument("--sink", default=settings.B2B_CHARGE_EVENT_SINK)
+        parser.add_argument(
+            "--offset",
+            type=int,
+            help="Start from this offset instead of the committed one.",
+        )
+        parser.add_argument(
+            "--from-log-id",
+            type=int,
+            help="Replay the transaction log rows above this id and exit.",
+        )
+        parser.add_argument("--merchant", type=int, help="Only replay this merchant.")
+        parser.add_argument(
+            "--follow",
+            action="store_true",
+            help="Keep waiting for new events instead of exiting at the end.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait for new events with --follow.",
+        )
+
+    def write(self, events):
+        for event in events:
+            self.stdout.write(json.dumps(event, separators=(",", ":")))
+        self.stdout.flush()
+
+    def handle(self, *args, **options):
+        if options["from_log_id"] is not None:
+            self.write(replay_logs(options["from_log_id"], options["merchant"]))
+            return
+        consumer = EventConsumer(options["consumer"], get_sink(options["sink"]))
+        if options["offset"] is not None:
+            consumer.seek(options["offset"])
+        if options["follow"]:
+            try:
+                consumer.run(self.write, options["interval"])
+            except KeyboardInterrupt:
+                pass
+            return
+        while True:
+            events = consumer.poll()
+            if not events:
+                return
+            self.write(events)
+            consumer.commit()
@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from b2b_charge.stress import STRATEGIES, StressConfig, run_stress_suite
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs concurrent add/subtract operations against a few merchants with each "
+        "locking strategy, checks for lost updates and overdrafts and reports the "
+        "throughput of every strategy as JSON."
+    )
+
+    def add_arguments(self, parser):
+        defaults = StressConfig()
+        parser.add_argument(
+            "--strategy",
+            choices=list(STRATEGIES),
+            action="append",
+            dest="strategies",
+            help="Only run this strategy. Can be repeated. Defaults to all of them.",
+        )
+        parser.add_argument("--operations", type=int, default=defaults.operations)
+        parser.add_argument("--threads", type=int, default=defaults.threads)
+        parser.add_argument("--processes", type=int, default=defaults.processes)
+        parser.add_argument("--merchants", type=int, default=defaults.merchants)
+        parser.add_argument(
+            "--initial-credit", type=int, default=defaults.initial_credit
+        )
+        parser.add_argument("--add-ratio", type=float, default=defaults.add_ratio)
+        parser.add_argument("--seed", type=int, default=defaults.seed)
+        parser.add_argument("--output", help="Also write the report to this file.")
+
+    def handle(self, *args, **options):
+        config = StressConfig(
+            operations=options["operations"],
+            threads=options["threads"],
+            processes=options["processes"],
+            merchants=options["merchants"],
+            initial_credit=options["initial_credit"],
+            add_ratio=options["add_ratio"],
+            seed=options["seed"],
+        )
+        report = run_stress_suite(config, options["strategies"])
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as report_file:
+                report_file.write(output)
+        self.stdout.write(output)
+        failed = [
+            strategy["strategy"]
+            for strategy in report["strategies"]
+            if not strategy["ok"]
+        ]
+        if failed:
+            raise CommandError("Invariants violated by: %s" % (", ".join(failed)))
@@ -0,0 +1,336 @@
+"""
+Request metrics for the b2b_charge endpoints, exposed in the Prometheus text format.
+
+``MetricsMiddleware`` times every b2b_charge request. A sampled share of them
+(``B2B_CHARGE_METRICS_SAMPLE_RATE``) also records the number of SQL queries, the time
+spent in the database and the time spent in row-locking statements, through a
+connection-wide execute wrapper that only counts and times queries. Metrics are kept per
+process, so each worker has to be scraped on its own.
+"""
+
+import random
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse
+
+SECONDS_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+QUERIES_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+# url_name prefixes of the views that are instrumented.
+ENDPOINT_PREFIXES = ("merchant-", "async-merchant-")
+
+_current = ContextVar("b2b_charge_request_stats", default=None)
+
+
+class RequestStats:
+    """
+    The database work of one sampled request.
+    """
+
+    __slots__ = ("queries", "db_time", "lock_wait")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.lock_wait = 0.0
+
+
+class Histogram:
+    """
+    A thread-safe histogram with fixed upper bounds.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One extra slot for the +Inf bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Returns the cumulative ``(le, count)`` pairs, the sum and the count.
+        """
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return cumulative, total, count
+
+
+class Registry:
+    """
+    The per-endpoint request counters and histograms of this process.
+    """
+
+    HISTOGRAMS = {
+        "request_duration_seconds": (
+            SECONDS_BUCKETS,
+            "Wall time of b2b_charge requests.",
+        ),
+        "request_db_queries": (
+            QUERIES_BUCKETS,
+            "SQL queries per sampled b2b_charge request.",
+        ),
+        "request_db_duration_seconds": (
+            SECONDS_BUCKETS,
+            "Time spent in the database per sampled b2b_charge request.",
+        ),
+        "request_lock_wait_seconds": (
+            SECONDS_BUCKETS,
+            "Time spent in row-locking statements per sampled b2b_charge request.",
+        ),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.requests = {}
+            self.histograms = {name: {} for name in self.HISTOGRAMS}
+
+    def _histogram(self, name, endpoint):
+        histograms = self.histograms[name]
+        histogram = histograms.get(endpoint)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(
+                    endpoint, Histogram(self.HISTOGRAMS[name][0])
+                )
+        return histogram
+
+    def record(self, endpoint, status_code, duration, stats=None):
+        with self._lock:
+            key = (endpoint, status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+        self._histogram("request_duration_seconds", endpoint).observe(duration)
+        if stats is not None:
+            self._histogram("request_db_queries", endpoint).observe(stats.queries)
+            self._histogram("request_db_duration_seconds", endpoint).observe(
+                stats.db_time
+            )
+            self._histogram("request_lock_wait_seconds", endpoint).observe(
+                stats.lock_wait
+            )
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP b2b_charge_requests_total b2b_charge requests by endpoint and status.",
+            "# TYPE b2b_charge_requests_total counter",
+        ]
+        with self._lock:
+            requests = sorted(self.requests.items())
+        for (endpoint, status_code), count in requests:
+            lines.append(
+                'b2b_charge_requests_total{endpoint="%s",status="%d"} %d'
+                % (endpoint, status_code, count)
+            )
+        for name, (_, help_text) in self.HISTOGRAMS.items():
+            metric = "b2b_charge_" + name
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s histogram" % (metric))
+            for endpoint, histogram in sorted(self.histograms[name].items()):
+                buckets, total, count = histogram.snapshot()
+                for bound, bucket_count in buckets:
+                    lines.append(
+                        '%s_bucket{endpoint="%s",le="%s"} %d'
+                        % (metric, endpoint, bound, bucket_count)
+                    )
+                lines.append('%s_sum{endpoint="%s"} %r' % (metric, endpoint, total))
+                lines.append('%s_count{endpoint="%s"} %d' % (metric, endpoint, count))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def instrument_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every connection. Outside sampled requests it only
+    reads a context variable.
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += perf_counter() - started
+
+
+def install_query_instrumentation(sender, connection, **kwargs):
+    """
+    ``connection_created`` receiver that adds ``instrument_query`` to the connection.
+    """
+    if instrument_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument_query)
+
+
+@contextmanager
+def lock_wait():
+    """
+    Times a statement that may wait on a row lock, for the current sampled request.
+    """
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        stats.lock_wait += perf_counter() - started
+
+
+def _endpoint(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None or not match.url_name:
+        return None
+    if not match.url_name.startswith(ENDPOINT_PREFIXES):
+        return None
+    return match.url_name
+
+
+class MetricsMiddleware:
+    """
+    Records the wall time of b2b_charge requests, and the database work of sampled ones.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self):
+        if random.random() < settings.B2B_CHARGE_METRICS_SAMPLE_RATE:
+            stats = RequestStats()
+            return stats, _current.set(stats)
+        return None, None
+
+    def _finish(self, request, response, started, stats, token):
+        duration = perf_counter() - started
+        if token is not None:
+            _current.reset(token)
+        endpoint = _endpoint(request)
+        if endpoint is not None:
+            registry.record(endpoint, response.status_code, duration, stats)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = perf_counter()
+        stats, token = self._start()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            if token is not None:
+                _current.reset(token)
+            raise
+        self._finish(request, response, started, stats, token)
+        return response
+
+    async def __acall__(self, request):
+        started = perf_counter()
+        stats, token = self._start()
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            if token is not None:
+                _current.reset(token)
+            raise
+        self._finish(request, response, started, stats, token)
+        return response
+
+
+def _gauges():
+    # Imported here so that models can import this module.
+    from .admission import charge_admission
+    from .cache import balance_cache
+    from .combiner import charge_combiner
+    from .routers import read_counts
+    from .velocity import velocity_checks
+
+    cache = balance_cache.stats()
+    combiner = charge_combiner.stats()
+    reads = read_counts()
+    velocity = velocity_checks.stats()
+    return [
+        ("balance_cache_hits_total", "counter", cache["hits"]),
+        ("balance_cache_misses_total", "counter", cache["misses"]),
+        ("balance_cache_size", "gauge", cache["size"]),
+        ("write_combining_queue_depth", "gauge", combiner["queue_depth"]),
+        ("write_combining_batches_total", "counter", combiner["batches"]),
+        ("write_combining_charges_total", "counter", combiner["charges"]),
+        ("write_combining_max_batch_size", "gauge", combiner["max_batch_size"]),
+        ("admission_rejected_total", "counter", charge_admission.rejected),
+        ("velocity_rejected_total", "counter", velocity["rejected"]),
+        ("velocity_windows", "gauge", velocity["windows"]),
+        ("primary_reads_total", "counter", reads.pop(DEFAULT_DB_ALIAS, 0)),
+        (
+            "replica_reads_total",
+            "counter",
+            sum(
+                count
+                for alias, count in reads.items()
+                if alias in settings.B2B_CHARGE_READ_REPLICAS
+            ),
+        ),
+    ]
+
+
+def metrics_view(request):
+    """
+    The view that exposes the metrics of this process to Prometheus.
+    """
+    lines = [registry.render()]
+    for name, kind, value in _gauges():
+        if value is not None:
+            lines.append(
+                "# TYPE b2b_charge_%s %s\nb2b_charge_%s %s\n"
+                % (name, kind, name, value)
+            )
+    return HttpResponse(
+        "".join(lines), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
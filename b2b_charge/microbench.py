@@ -0,0 +1,119 @@
+"""
+Micro-benchmark of the CPU the charge endpoints spend outside the database.
+
+Each case runs a step of a hot request the way the endpoints used to do it (a
+``ModelSerializer`` over ``Merchant``, a DRF ``Response`` picked by content
+negotiation and rendered by the ``JSONRenderer``) and the way they do it now (the
+validators in ``serializers.py`` and ``json_response``). It reports the process CPU
+time per call. No database queries are made.
+"""
+
+import time
+
+from rest_framework import serializers
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+
+from .models import Merchant
+from .serializers import MerchantSerializer, validate_charge, validate_credit
+from .views import json_response
+
+EXCLUDED = (
+    "created_time",
+    "updated_time",
+    "is_active",
+    "balance_shards",
+    "rate_limit",
+    "rate_burst",
+    "held_credit",
+    "version",
+)
+
+
+class ModelBuyChargeSerializer(serializers.ModelSerializer):
+    """
+    The <buy-charge> serializer the endpoint used before the lean validators.
+    """
+
+    phone = serializers.CharField()
+    amount = serializers.IntegerField()
+
+    class Meta:
+        model = Merchant
+        exclude = EXCLUDED
+
+
+def _serializer_data(serializer_class, data):
+    serializer = serializer_class(data=data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+def _drf_render(request, data):
+    renderer, media_type = DefaultContentNegotiation().select_renderer(
+        request, [JSONRenderer(), BrowsableAPIRenderer()]
+    )
+    response = Response(data)
+    response.accepted_renderer = renderer
+    response.accepted_media_type = media_type
+    response.renderer_context = {}
+    return response.rendered_content
+
+
+def _cases():
+    request = Request(APIRequestFactory().get("/", HTTP_ACCEPT="application/json"))
+    charge = {"phone": "9121234567", "amount": "1000"}
+    credit = {"credit": "5000"}
+    body = {
+        "message": "Successfully bought charge.",
+        "amount": 1000,
+        "merchant_credit": 4000,
+    }
+    return {
+        "validate buy-charge": (
+            lambda: _serializer_data(ModelBuyChargeSerializer, charge),
+            lambda: validate_charge(charge),
+        ),
+        "validate add-credit": (
+            lambda: _serializer_data(MerchantSerializer, credit),
+            lambda: validate_credit(credit),
+        ),
+        # get-credit validated an empty MerchantSerializer, it now validates nothing.
+        "validate get-credit": (
+            lambda: _serializer_data(MerchantSerializer, {}),
+            lambda: None,
+        ),
+        "render response": (
+            lambda: _drf_render(request, body),
+            lambda: json_response(body).content,
+        ),
+    }
+
+
+def _cpu_per_call(func, iterations):
+    started = time.process_time()
+    for _ in range(iterations):
+        func()
+    return (time.process_time() - started) / iterations
+
+
+def run_microbenchmark(iterations=10000):
+    """
+    Returns ``{case: {before_us, after_us, speedup}}`` in CPU microseconds per call.
+    """
+    report = {}
+    for name, (before, after) in _cases().items():
+        # Warm up caches such as the serializers' field construction.
+        before()
+        after()
+        before_s = _cpu_per_call(before, iterations)
+        after_s = _cpu_per_call(after, iterations)
+        report[name] = {
+            "before_us": round(before_s * 10**6, 3),
+            "after_us": round(after_s * 10**6, 3),
+            "speedup": round(before_s / after_s, 1) if after_s else None,
+        }
+    return report
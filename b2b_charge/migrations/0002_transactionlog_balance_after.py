@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-18 12:09
+
+from django.db import migrations, models
+
+from b2b_charge.operations import AddIndexConcurrentlyIfSupported
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ("b2b_charge", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="transactionlog",
+            name="balance_after",
+            field=models.IntegerField(
+                null=True, verbose_name="Merchant Credit After Transaction"
+            ),
+        ),
+        AddIndexConcurrentlyIfSupported(
+            model_name="transactionlog",
+            index=models.Index(
+                fields=["merchant", "-id"], name="b2b_charge_log_merchant_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+from b2b_charge.operations import AddIndexConcurrentlyIfSupported
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ("b2b_charge", "0002_transactionlog_balance_after"),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyIfSupported(
+            model_name="transactionlog",
+            index=models.Index(
+                fields=["merchant", "created_time"],
+                name="b2b_charge_log_merchant_ct_idx",
+            ),
+        ),
+        AddIndexConcurrentlyIfSupported(
+            model_name="transactionlog",
+            index=models.Index(
+                fields=["phone", "created_time"], name="b2b_charge_log_phone_ct_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.2 on 2026-10-18 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0003_transactionlog_composite_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdempotencyKey",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "key",
+                    models.CharField(max_length=255, verbose_name="Idempotency Key"),
+                ),
+                ("action", models.CharField(max_length=32, verbose_name="Action")),
+                (
+                    "request_hash",
+                    models.CharField(max_length=64, verbose_name="Request Hash"),
+                ),
+                (
+                    "response_status",
+                    models.PositiveSmallIntegerField(verbose_name="Response Status"),
+                ),
+                ("response_body", models.JSONField(verbose_name="Response Body")),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="idempotencykey",
+            index=models.Index(
+                fields=["created_time"], name="b2b_charge_idem_created_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="idempotencykey",
+            constraint=models.UniqueConstraint(
+                fields=("merchant", "key"), name="b2b_charge_idempotency_key_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 4.2 on 2026-10-18 12:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0004_idempotencykey"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="merchant",
+            name="balance_shards",
+            field=models.PositiveSmallIntegerField(
+                default=1, verbose_name="Balance Shards"
+            ),
+        ),
+        migrations.AddField(
+            model_name="transactionlog",
+            name="is_transfer",
+            field=models.BooleanField(default=False, verbose_name="Is Transfer"),
+        ),
+        migrations.AddField(
+            model_name="transactionlog",
+            name="shard",
+            field=models.PositiveSmallIntegerField(
+                null=True, verbose_name="Balance Shard"
+            ),
+        ),
+        migrations.CreateModel(
+            name="MerchantBalanceShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "number",
+                    models.PositiveSmallIntegerField(verbose_name="Shard Number"),
+                ),
+                ("credit", models.IntegerField(default=0, verbose_name="Shard Credit")),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="balance_shard_set",
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="merchantbalanceshard",
+            constraint=models.UniqueConstraint(
+                fields=("merchant", "number"), name="b2b_charge_balance_shard_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2 on 2026-10-18 12:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0005_merchant_balance_shards"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BalanceSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "last_log_id",
+                    models.BigIntegerField(verbose_name="Last Transaction Log ID"),
+                ),
+                ("balance", models.IntegerField(verbose_name="Ledger Balance")),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="balancesnapshot",
+            index=models.Index(
+                fields=["merchant", "-last_log_id"], name="b2b_charge_snapshot_idx"
+            ),
+        ),
+    ]
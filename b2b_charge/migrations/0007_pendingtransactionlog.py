@@ -0,0 +1,59 @@
+# Generated by Django 4.2 on 2026-10-18 12:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0006_balancesnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingTransactionLog",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "phone",
+                    models.BigIntegerField(null=True, verbose_name="Phone Number"),
+                ),
+                ("amount", models.IntegerField(verbose_name="Charge Amount")),
+                (
+                    "balance_after",
+                    models.IntegerField(
+                        null=True, verbose_name="Merchant Credit After Transaction"
+                    ),
+                ),
+                (
+                    "shard",
+                    models.PositiveSmallIntegerField(
+                        null=True, verbose_name="Balance Shard"
+                    ),
+                ),
+                (
+                    "is_transfer",
+                    models.BooleanField(default=False, verbose_name="Is Transfer"),
+                ),
+                ("created_time", models.DateTimeField(verbose_name="Created Datetime")),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+    ]
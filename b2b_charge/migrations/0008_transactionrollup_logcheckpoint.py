@@ -0,0 +1,109 @@
+# Generated by Django 4.2 on 2026-10-18 12:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0007_pendingtransactionlog"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LogCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(max_length=64, unique=True, verbose_name="Name"),
+                ),
+                (
+                    "last_log_id",
+                    models.BigIntegerField(
+                        default=0, verbose_name="Last Transaction Log ID"
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="TransactionRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("hour", "Hour"), ("day", "Day")],
+                        max_length=4,
+                        verbose_name="Period",
+                    ),
+                ),
+                ("start", models.DateTimeField(verbose_name="Period Start")),
+                ("count", models.IntegerField(default=0, verbose_name="Transactions")),
+                (
+                    "credit",
+                    models.BigIntegerField(default=0, verbose_name="Total Credit"),
+                ),
+                (
+                    "debit",
+                    models.BigIntegerField(default=0, verbose_name="Total Debit"),
+                ),
+                (
+                    "phones",
+                    models.IntegerField(default=0, verbose_name="Distinct Phones"),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="transactionrollup",
+            constraint=models.UniqueConstraint(
+                fields=("merchant", "period", "start"), name="b2b_charge_rollup_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0008_transactionrollup_logcheckpoint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="merchant",
+            name="rate_burst",
+            field=models.PositiveIntegerField(null=True, verbose_name="Rate Burst"),
+        ),
+        migrations.AddField(
+            model_name="merchant",
+            name="rate_limit",
+            field=models.PositiveIntegerField(null=True, verbose_name="Rate Limit"),
+        ),
+    ]
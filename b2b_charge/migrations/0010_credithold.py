@@ -0,0 +1,78 @@
+# Generated by Django 4.2 on 2026-10-18 12:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0009_merchant_rate_limit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="merchant",
+            name="held_credit",
+            field=models.IntegerField(default=0, verbose_name="Held Credit"),
+        ),
+        migrations.CreateModel(
+            name="CreditHold",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                ("phone", models.BigIntegerField(verbose_name="Phone Number")),
+                ("amount", models.IntegerField(verbose_name="Charge Amount")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("held", "Held"),
+                            ("captured", "Captured"),
+                            ("released", "Released"),
+                            ("expired", "Expired"),
+                        ],
+                        default="held",
+                        max_length=8,
+                        verbose_name="Status",
+                    ),
+                ),
+                ("expires_at", models.DateTimeField(verbose_name="Expires At")),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="credithold",
+            index=models.Index(
+                condition=models.Q(("status", "held")),
+                fields=["expires_at"],
+                name="b2b_charge_hold_expiry_idx",
+            ),
+        ),
+    ]
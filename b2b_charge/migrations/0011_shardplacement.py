@@ -0,0 +1,54 @@
+# Generated by Django 4.2 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0010_credithold"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShardPlacement",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "merchant_id",
+                    models.BigIntegerField(unique=True, verbose_name="Merchant ID"),
+                ),
+                (
+                    "alias",
+                    models.CharField(max_length=64, verbose_name="Database Alias"),
+                ),
+                (
+                    "moving",
+                    models.BooleanField(default=False, verbose_name="Is Moving"),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 4.2 on 2026-10-18 13:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0011_shardplacement"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ConsumerOffset",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        max_length=64, unique=True, verbose_name="Consumer"
+                    ),
+                ),
+                ("offset", models.BigIntegerField(default=0, verbose_name="Offset")),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="TransactionEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "log_id",
+                    models.BigIntegerField(
+                        null=True, verbose_name="Transaction Log ID"
+                    ),
+                ),
+                (
+                    "phone",
+                    models.BigIntegerField(null=True, verbose_name="Phone Number"),
+                ),
+                ("amount", models.IntegerField(verbose_name="Charge Amount")),
+                (
+                    "balance_after",
+                    models.IntegerField(
+                        null=True, verbose_name="Merchant Credit After Transaction"
+                    ),
+                ),
+                (
+                    "shard",
+                    models.PositiveSmallIntegerField(
+                        null=True, verbose_name="Balance Shard"
+                    ),
+                ),
+                (
+                    "is_transfer",
+                    models.BooleanField(default=False, verbose_name="Is Transfer"),
+                ),
+                ("created_time", models.DateTimeField(verbose_name="Created Datetime")),
+                (
+                    "merchant",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="b2b_charge.merchant",
+                        verbose_name="Merchant",
+                    ),
+                ),
+            ],
+        ),
+    ]
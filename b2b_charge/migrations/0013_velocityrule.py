@@ -0,0 +1,70 @@
+# Generated by Django 4.2 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0012_transactionevent_consumeroffset"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VelocityRule",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "updated_time",
+                    models.DateTimeField(
+                        auto_now=True, verbose_name="Updated Datetime"
+                    ),
+                ),
+                (
+                    "created_time",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created Datetime"
+                    ),
+                ),
+                (
+                    "merchant_id",
+                    models.BigIntegerField(
+                        db_index=True, null=True, verbose_name="Merchant ID"
+                    ),
+                ),
+                (
+                    "scope",
+                    models.CharField(
+                        choices=[("merchant", "Merchant"), ("phone", "Phone")],
+                        default="phone",
+                        max_length=8,
+                        verbose_name="Scope",
+                    ),
+                ),
+                ("window", models.PositiveIntegerField(verbose_name="Window Seconds")),
+                (
+                    "max_count",
+                    models.PositiveIntegerField(null=True, verbose_name="Max Charges"),
+                ),
+                (
+                    "max_amount",
+                    models.BigIntegerField(null=True, verbose_name="Max Amount"),
+                ),
+                (
+                    "is_active",
+                    models.BooleanField(default=True, verbose_name="Is active"),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("b2b_charge", "0014_merchant_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="merchantbalanceshard",
+            name="version",
+            field=models.BigIntegerField(default=0, verbose_name="Credit Version"),
+        ),
+    ]
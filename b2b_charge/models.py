@@ -1,6 +1,24 @@
-from django.db import models
-from django.db.transaction import atomic
-from django.db.models import Sum
+import random
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import models, connections, router
+from django.db.transaction import atomic, on_commit
+from django.db.models import F, Sum, Value
+from django.utils import timezone
+
+from .cache import balance_cache
+from .metrics import lock_wait
+from .sharding import (
+    current_shard,
+    merchant_atomic,
+    merchant_shard,
+    new_merchant_ids,
+    shard_aliases,
+    shard_map,
+    using_shard,
+)
 
 
 class BaseModel(models.Model):
@@ -17,13 +35,109 @@ class BaseModel(models.Model):
         abstract = True
 
 
+def _apply_credit_delta(model, filters, delta, using=None, held=0, with_held=False):
+    """
+    Applies ``delta`` to the ``credit`` column of the ``model`` row matching ``filters``
+    with a single conditional UPDATE, and returns the new credit or None.
+    ``held`` is added to the ``held_credit`` column in the same UPDATE, and with
+    ``with_held`` the new ``(credit, held_credit)`` of the merchant are returned. The
+    row's ``version`` is bumped too, and its new credit published to the balance cache
+    once the transaction commits.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    now = timezone.now()
+    returning = ["credit", "version"]
+    if model is Merchant:
+        returning += ["balance_shards", "held_credit"]
+    if connection.vendor == "postgresql" or (
+        connection.vendor == "sqlite"
+        and connection.features.can_return_columns_from_insert
+    ):
+        where = " AND ".join(
+            "%s = %%s" % connection.ops.quote_name(model._meta.get_field(name).column)
+            for name in filters
+        )
+        sql = (
+            "UPDATE {table} SET credit = credit + %s,{held} version = version + 1,"
+            " updated_time = %s WHERE {where} AND credit >= %s RETURNING {returning}"
+        ).format(
+            table=connection.ops.quote_name(model._meta.db_table),
+            held=" held_credit = held_credit + %s," if held else "",
+            where=where,
+            returning=", ".join(returning),
+        )
+        updated_time = model._meta.get_field("updated_time").get_db_prep_value(
+            now, connection
+        )
+        params = [delta, *([held] if held else []), updated_time]
+        with lock_wait(), connection.cursor() as cursor:
+            cursor.execute(sql, [*params, *filters.values(), -delta])
+            row = cursor.fetchone()
+    else:
+        # Backends without UPDATE ... RETURNING pay for an extra SELECT.
+        values = {
+            "credit": F("credit") + delta,
+            "version": F("version") + 1,
+            "updated_time": now,
+        }
+        if held:
+            values["held_credit"] = F("held_credit") + held
+        with lock_wait():
+            updated = (
+                model.objects.using(using)
+                .filter(credit__gte=-delta, **filters)
+                .update(**values)
+            )
+        if not updated:
+            return None
+        row = model.objects.using(using).values_list(*returning).get(**filters)
+    if row is None:
+        return None
+    _publish_on_commit(model, filters, row, using)
+    if with_held:
+        return row[0], row[3]
+    return row[0]
+
+
+def _publish_on_commit(model, filters, row, using):
+    """
+    Publishes the ``(credit, version, ...)`` of a merchant or balance shard row to the
+    balance cache once the transaction commits.
+    """
+    if model is Merchant:
+        publish = partial(balance_cache.publish, filters["id"], *row[:3])
+    else:
+        publish = partial(
+            balance_cache.publish_shard, filters["merchant_id"], filters["number"], *row
+        )
+    on_commit(publish, using=using)
+
+
+class _ShardTooLow(Exception):
+    pass
+
+
 class Merchant(BaseModel):
     """
     The model for the B2B Merchant.
     """
 
     credit = models.IntegerField(verbose_name="Merchant Credit", default=0)
+    # Credit reserved by open CreditHolds. It has left ``credit`` but is not in the
+    # transaction log yet, so the log adds up to ``credit + held_credit``.
+    held_credit = models.IntegerField(verbose_name="Held Credit", default=0)
     is_active = models.BooleanField(verbose_name="Is active", default=True)
+    # Bumped by every change of the row's credit, in the same UPDATE, so it orders the
+    # changes as they commit. The balance cache keeps the credit of the latest version.
+    version = models.BigIntegerField(verbose_name="Credit Version", default=0)
+    balance_shards = models.PositiveSmallIntegerField(
+        verbose_name="Balance Shards", default=1
+    )
+    # Charges per second admitted for the merchant, and the burst above that rate.
+    # None falls back to B2B_CHARGE_RATE_LIMIT and B2B_CHARGE_RATE_BURST.
+    rate_limit = models.PositiveIntegerField(verbose_name="Rate Limit", null=True)
+    rate_burst = models.PositiveIntegerField(verbose_name="Rate Burst", null=True)
 
     @classmethod
     def create_merchant(cls, initial_credit=0):
@@ -34,49 +148,678 @@ class Merchant(BaseModel):
             raise Exception(
                 "create_merchant: Negative Credits happened. Cannot Continue."
             )
-        merchant = Merchant(credit=initial_credit)
-        merchant.save()
+        alias = shard_map.pick()
+        merchant = Merchant(id=new_merchant_ids(alias, 1)[0], credit=initial_credit)
+        merchant.save(using=alias, force_insert=True)
         return merchant
 
+    @property
+    def is_sharded(self):
+        return self.balance_shards > 1
+
     def get_credit(self):
         """
         Returns the overall credit of the merchant.
+        The credit of a sharded merchant is the sum of its shards.
         """
+        if self.is_sharded:
+            return self.credit + MerchantBalanceShard.get_total_credit(
+                self.id, self._state.db
+            )
         return self.credit
 
+    def get_ledger_credit(self):
+        """
+        Returns the credit the transaction log accounts for, held credit included.
+        """
+        return self.get_credit() + self.held_credit
+
+    @classmethod
+    def get_cached_credit(cls, merchant_id):
+        """
+        Returns the merchant's credit from the balance cache, falling back to the database.
+        Returns None if the merchant does not exist.
+        """
+        credit = balance_cache.get(merchant_id)
+        if credit is None:
+            with merchant_shard(merchant_id):
+                using = router.db_for_read(cls)
+            # One statement, so the merchant row and its shards are read at the same
+            # point in time. Annotations come after the fields on both sides.
+            fields = ("credit", "version", "number", "shards")
+            rows = (
+                cls.objects.using(using)
+                .filter(id=merchant_id)
+                .annotate(
+                    number=Value(None, output_field=models.IntegerField()),
+                    shards=F("balance_shards"),
+                )
+                .values_list(*fields)
+                .union(
+                    MerchantBalanceShard.objects.using(using)
+                    .filter(merchant_id=merchant_id)
+                    .annotate(shards=Value(0))
+                    .values_list(*fields),
+                    all=True,
+                )
+            )
+            row = None
+            parts = {}
+            for credit, version, number, balance_shards in rows:
+                if number is None:
+                    row = (credit, version, balance_shards)
+                else:
+                    parts[number] = (version, credit)
+            if row is None:
+                return None
+            # A replica may lag behind, so only the primary's credit is cached.
+            if using not in settings.B2B_CHARGE_READ_REPLICAS:
+                balance_cache.fill(merchant_id, *row, parts)
+            credit = row[0]
+            if row[2] > 1:
+                credit += sum(part[1] for part in parts.values())
+        return credit
+
+    def publish_credit(self, version):
+        """
+        Updates the balance cache with the merchant's own credit once the current
+        transaction commits. ``version`` is the merchant's ``version`` after the change.
+        """
+        _publish_on_commit(
+            Merchant,
+            {"id": self.id},
+            (self.credit, version, self.balance_shards),
+            self._state.db,
+        )
+
+    @classmethod
+    def apply_credit_delta(cls, merchant_id, delta, using=None, with_held=False):
+        """
+        Applies ``delta`` to the merchant's credit with a single conditional UPDATE.
+
+        The balance is changed in the database (``credit = credit + delta``) rather than
+        from an in-memory copy, so concurrent calls never lose updates, and the
+        ``credit >= -delta`` condition keeps the credit from going negative.
+        Returns the new credit, or None if the merchant does not exist or has too little credit.
+        With ``with_held`` it returns the new ``(credit, held_credit)`` instead.
+        """
+        shard_map.check_writable(merchant_id)
+        using = using or shard_map.alias_for(merchant_id)
+        return _apply_credit_delta(
+            cls, {"id": merchant_id}, delta, using, with_held=with_held
+        )
+
     def add_credit(self, credit):
         """
         Adds credit to the merchant.
         """
-        if self.credit + credit < 0:
+        credits = Merchant.apply_credit_delta(self.id, credit, with_held=True)
+        if credits is None:
             raise Exception("add_credit: Negative Credits happened. Cannot Continue.")
-        self.credit += credit
-        self.save()
+        self.credit, self.held_credit = credits
+        return self.credit
 
     def subtract_credit(self, credit):
         """
         Subtracts merchant's credit.
         """
-        if self.credit - credit < 0:
+        credits = Merchant.apply_credit_delta(self.id, -credit, with_held=True)
+        if credits is None:
+            self.refresh_from_db(fields=["credit"])
             raise Exception(
                 "subtract_credit: Negative Credits happened. Cannot Continue. %d - %d. merchant_id: %d, merchant_credits: %d"
                 % (self.credit, credit, self.id, self.get_credit())
             )
-        self.credit -= credit
-        self.save()
+        self.credit, self.held_credit = credits
+        return self.credit
 
-    @atomic
+    @merchant_atomic
     def transaction(self, action, phone, amount):
         """
         The method that executes the transaction and log in atomic fashion.
+        Returns the merchant's credit after the transaction.
         """
+        if self.is_sharded:
+            return self.sharded_transaction(action, phone, amount)
         if action == "add_credit":
             self.add_credit(amount)
-            TransactionLog(merchant_id=self.id, phone=None, amount=amount).log()
+            log = TransactionLog(
+                merchant_id=self.id,
+                phone=None,
+                amount=amount,
+                balance_after=self.credit + self.held_credit,
+            )
         elif action == "subtract_credit":
             self.subtract_credit(amount)
             amount = amount * -1
-            TransactionLog(merchant_id=self.id, phone=phone, amount=amount).log()
+            log = TransactionLog(
+                merchant_id=self.id,
+                phone=phone,
+                amount=amount,
+                balance_after=self.credit + self.held_credit,
+            )
+        else:
+            return self.credit
+        log.log()
+        return self.credit
+
+    @merchant_atomic
+    def batch_transaction(self, items):
+        """
+        Buys charge for many phones at once.
+        ``items`` is a list of ``(phone, amount)`` pairs. The merchant is debited once for all
+        the items that fit in its credit and their logs are written with ``bulk_create``.
+        Returns a list of booleans telling which items succeeded, in the order of ``items``.
+        """
+        if not items:
+            return []
+        total = sum(amount for _, amount in items)
+        shard = new_credit = None
+        held = 0
+        if self.is_sharded:
+            debit = self.debit_shards(total)
+            if debit is not None:
+                shard, new_credit = debit
+        else:
+            debit = Merchant.apply_credit_delta(self.id, -total, with_held=True)
+            if debit is not None:
+                new_credit, held = debit
+        if new_credit is not None:
+            accepted = [True] * len(items)
+        else:
+            # Not everything fits. Lock the balances so the credit we read stays valid,
+            # then accept items in order while they fit.
+            credit = self.lock_credit()
+            accepted = []
+            total = 0
+            for _, amount in items:
+                fits = total + amount <= credit
+                accepted.append(fits)
+                if fits:
+                    total += amount
+            if self.is_sharded:
+                shard, new_credit = self.rebalance_shards(debit=total)
+            else:
+                new_credit, held = Merchant.apply_credit_delta(
+                    self.id, -total, with_held=True
+                )
+        if not self.is_sharded:
+            self.credit, self.held_credit = new_credit, held
+
+        # The whole debit happened in one statement, so the balance after each item is
+        # the ledger credit (the credit of the shard, for sharded merchants) before the
+        # batch minus the accepted items so far.
+        balance = new_credit + held + total
+        logs = []
+        for (phone, amount), ok in zip(items, accepted):
+            if ok:
+                balance -= amount
+                logs.append(
+                    TransactionLog(
+                        merchant_id=self.id,
+                        phone=phone,
+                        amount=-amount,
+                        shard=shard,
+                        balance_after=balance,
+                    )
+                )
+        TransactionLog.bulk_log(logs)
+        return accepted
+
+    @merchant_atomic
+    def reserve_credit(self, phone, amount, ttl=None):
+        """
+        Moves ``amount`` from the merchant's credit to its held credit with one
+        conditional UPDATE and returns the new CreditHold, which expires after ``ttl``
+        seconds. Nothing is logged until the hold is captured.
+        """
+        if self.is_sharded:
+            raise Exception(
+                "reserve_credit: Sharded merchants cannot hold credit. merchant_id: %d"
+                % (self.id)
+            )
+        if amount <= 0:
+            raise Exception("reserve_credit: amount must be positive.")
+        if ttl is None:
+            ttl = settings.B2B_CHARGE_HOLD_TTL
+        credit = _apply_credit_delta(Merchant, {"id": self.id}, -amount, held=amount)
+        if credit is None:
+            raise Exception(
+                "reserve_credit: Negative Credits happened. Cannot Continue. merchant_id: %d"
+                % (self.id)
+            )
+        self.credit = credit
+        self.held_credit += amount
+        hold = CreditHold.objects.create(
+            merchant_id=self.id,
+            phone=phone,
+            amount=amount,
+            expires_at=timezone.now() + timedelta(seconds=ttl),
+        )
+        return hold
+
+    def lock_credit(self):
+        """
+        Locks the merchant's balance rows until the end of the transaction and returns
+        its credit.
+        """
+        if self.is_sharded:
+            main, _, _, _, shards = self._lock_balances()
+            return main + sum(shard.credit for shard in shards.values())
+        with lock_wait():
+            return (
+                Merchant.objects.select_for_update()
+                .values_list("credit", flat=True)
+                .get(id=self.id)
+            )
+
+    def _lock_balances(self):
+        """
+        Locks the merchant row and then its shards in order, so that concurrent
+        rebalances cannot deadlock. Returns the merchant's own credit, its held credit,
+        its version, its number of shards and its shards by number.
+        """
+        connection = connections[router.db_for_write(Merchant)]
+        # FOR NO KEY UPDATE does not block the key-share locks taken by log inserts.
+        no_key = connection.features.has_select_for_no_key_update
+        with lock_wait():
+            main, held, version, count = (
+                Merchant.objects.select_for_update(no_key=no_key)
+                .values_list("credit", "held_credit", "version", "balance_shards")
+                .get(id=self.id)
+            )
+            shards = {
+                shard.number: shard
+                for shard in MerchantBalanceShard.objects.select_for_update(
+                    no_key=no_key
+                )
+                .filter(merchant_id=self.id)
+                .order_by("number")
+            }
+        return main, held, version, count, shards
+
+    @merchant_atomic
+    def sharded_transaction(self, action, phone, amount):
+        """
+        Runs the transaction against a single balance shard of the merchant, so that
+        concurrent transactions mostly update different rows.
+        Returns the merchant's credit after the transaction.
+        """
+        if action == "add_credit":
+            number = random.randrange(self.balance_shards)
+            shard_credit = MerchantBalanceShard.apply_credit_delta(
+                self.id, number, amount
+            )
+            if shard_credit is None:
+                raise Exception(
+                    "add_credit: Negative Credits happened. Cannot Continue."
+                )
+            phone = None
+        elif action == "subtract_credit":
+            debit = self.debit_shards(amount)
+            if debit is None:
+                raise Exception(
+                    "subtract_credit: Negative Credits happened. Cannot Continue. merchant_id: %d, merchant_credits: %d"
+                    % (self.id, self.get_credit())
+                )
+            number, shard_credit = debit
+            amount = amount * -1
+        else:
+            return self.get_credit()
+        TransactionLog(
+            merchant_id=self.id,
+            phone=phone,
+            amount=amount,
+            shard=number,
+            balance_after=shard_credit,
+        ).log()
+        return self.get_credit()
+
+    def debit_shards(self, amount):
+        """
+        Takes ``amount`` from one shard that can cover it. Returns ``(shard number, shard
+        credit)``, or None if the merchant's whole credit is too low.
+
+        The fast path never waits on a busy shard. Otherwise the charge waits on the
+        shard with the most credit, and only if no single shard can cover the amount are
+        the shards rebalanced. A merchant that is out of credit is rejected without
+        taking any lock.
+        """
+        debit = MerchantBalanceShard.debit_any(self.id, amount)
+        if debit is not None:
+            return debit
+        credits = dict(
+            MerchantBalanceShard.objects.filter(merchant_id=self.id).values_list(
+                "number", "credit"
+            )
+        )
+        if self.credit + sum(credits.values()) < amount:
+            return None
+        number = max(credits, key=credits.get, default=None)
+        if number is not None and credits[number] >= amount:
+            try:
+                # A failed conditional UPDATE can keep the row locked, and holding a
+                # shard while rebalancing could deadlock, so undo it with a savepoint.
+                with atomic(using=current_shard()):
+                    credit = MerchantBalanceShard.apply_credit_delta(
+                        self.id, number, -amount
+                    )
+                    if credit is None:
+                        raise _ShardTooLow
+                return number, credit
+            except _ShardTooLow:
+                pass
+        return self.rebalance_shards(debit=amount)
+
+    @merchant_atomic
+    def rebalance_shards(self, count=None, debit=0):
+        """
+        Spreads the merchant's credit evenly over ``count`` balance shards (by default the
+        current number), after taking ``debit`` from it. A count of 1 moves the whole
+        credit back to ``Merchant.credit``.
+
+        The moves are logged as transfer entries that sum to zero, so the logs still add
+        up to the merchant's credit and each shard's logs add up to the shard's credit.
+        Returns ``(shard number, shard credit)`` of the shard the debit was taken from
+        (None for ``Merchant.credit``), or None if the credit is lower than ``debit``.
+        """
+        main, held, version, current_count, shards = self._lock_balances()
+        count = count or current_count
+        before = {None: main}
+        before.update((number, shard.credit) for number, shard in shards.items())
+        remaining = sum(before.values()) - debit
+        if remaining < 0:
+            return None
+
+        after = {None: remaining if count == 1 else 0}
+        debited = None
+        if count > 1:
+            share, extra = divmod(remaining, count)
+            after.update((number, share + (number < extra)) for number in range(count))
+            debited = 0
+        numbers = sorted((set(before) | set(after)) - {None})
+
+        # The held credit belongs to the ledger of Merchant.credit.
+        ledger = {None: held}
+        logs = []
+        for number in [None] + numbers:
+            transfer = after.get(number, 0) - before.get(number, 0)
+            if number == debited:
+                # The caller logs the debit itself, right after the transfer.
+                transfer += debit
+            if transfer:
+                logs.append(
+                    TransactionLog(
+                        merchant_id=self.id,
+                        phone=None,
+                        amount=transfer,
+                        shard=number,
+                        is_transfer=True,
+                        balance_after=before.get(number, 0)
+                        + ledger.get(number, 0)
+                        + transfer,
+                    )
+                )
+
+        now = timezone.now()
+        version += 1
+        Merchant.objects.filter(id=self.id).update(
+            credit=after[None], version=version, balance_shards=count, updated_time=now
+        )
+        MerchantBalanceShard.objects.filter(
+            merchant_id=self.id, number__gte=count if count > 1 else 0
+        ).delete()
+        for number in range(count if count > 1 else 0):
+            shard = shards.get(number)
+            if shard is None:
+                # Starts above every version an earlier shard of that number reached,
+                # as those started from an older merchant version shifted alike and
+                # never made 2**32 changes.
+                shards[number] = MerchantBalanceShard.objects.create(
+                    merchant_id=self.id,
+                    number=number,
+                    credit=after[number],
+                    version=version << 32,
+                )
+            elif shard.credit != after[number]:
+                shard.credit = after[number]
+                shard.version += 1
+                shard.save(update_fields=["credit", "version", "updated_time"])
+        TransactionLog.bulk_log(logs)
+        self.credit = after[None]
+        self.version = version
+        self.balance_shards = count
+        on_commit(
+            partial(
+                balance_cache.publish,
+                self.id,
+                after[None],
+                version,
+                count,
+                {
+                    number: (shards[number].version, after[number])
+                    for number in range(count if count > 1 else 0)
+                },
+            ),
+            using=current_shard(),
+        )
+        return debited, after[debited]
+
+
+class MerchantBalanceShard(BaseModel):
+    """
+    The model for one part of a sharded merchant's credit.
+    """
+
+    merchant = models.ForeignKey(
+        Merchant,
+        on_delete=models.CASCADE,
+        related_name="balance_shard_set",
+        verbose_name="Merchant",
+    )
+    number = models.PositiveSmallIntegerField(verbose_name="Shard Number")
+    credit = models.IntegerField(verbose_name="Shard Credit", default=0)
+    # Like Merchant.version, for the shard's credit.
+    version = models.BigIntegerField(verbose_name="Credit Version", default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["merchant", "number"], name="b2b_charge_balance_shard_unique"
+            ),
+        ]
+
+    @classmethod
+    def apply_credit_delta(cls, merchant_id, number, delta, using=None):
+        """
+        Applies ``delta`` to one shard like ``Merchant.apply_credit_delta``.
+        """
+        return _apply_credit_delta(
+            cls, {"merchant_id": merchant_id, "number": number}, delta, using
+        )
+
+    @classmethod
+    def debit_any(cls, merchant_id, amount, using=None):
+        """
+        Takes ``amount`` from any of the merchant's shards that can cover it, without
+        waiting on shards locked by other transactions.
+        Returns ``(shard number, shard credit)``, or None if no free shard has enough.
+        """
+        using = using or router.db_for_write(cls)
+        connection = connections[using]
+        if connection.vendor != "postgresql":
+            # Without SKIP LOCKED, try the shards in a random order.
+            numbers = list(
+                cls.objects.using(using)
+                .filter(merchant_id=merchant_id, credit__gte=amount)
+                .values_list("number", flat=True)
+            )
+            random.shuffle(numbers)
+            for number in numbers:
+                credit = cls.apply_credit_delta(merchant_id, number, -amount, using)
+                if credit is not None:
+                    return number, credit
+            return None
+
+        table = connection.ops.quote_name(cls._meta.db_table)
+        sql = (
+            "UPDATE {table} SET credit = credit - %s, version = version + 1,"
+            " updated_time = %s"
+            " WHERE id = (SELECT id FROM {table} WHERE merchant_id = %s AND credit >= %s"
+            " ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED) AND credit >= %s"
+            " RETURNING number, credit, version"
+        ).format(table=table)
+        updated_time = cls._meta.get_field("updated_time").get_db_prep_value(
+            timezone.now(), connection
+        )
+        with lock_wait(), connection.cursor() as cursor:
+            cursor.execute(sql, [amount, updated_time, merchant_id, amount, amount])
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        _publish_on_commit(
+            cls, {"merchant_id": merchant_id, "number": row[0]}, row[1:], using
+        )
+        return row[0], row[1]
+
+    @classmethod
+    def get_total_credit(cls, merchant_id, using=None):
+        """
+        Gets the sum of the merchant's shards.
+        """
+        return (
+            cls.objects.db_manager(using)
+            .filter(merchant_id=merchant_id)
+            .aggregate(Sum("credit"))["credit__sum"]
+            or 0
+        )
+
+
+class CreditHold(BaseModel):
+    """
+    The model for credit reserved for a charge that is captured or released later.
+    """
+
+    HELD = "held"
+    CAPTURED = "captured"
+    RELEASED = "released"
+    EXPIRED = "expired"
+    STATUSES = (
+        (HELD, "Held"),
+        (CAPTURED, "Captured"),
+        (RELEASED, "Released"),
+        (EXPIRED, "Expired"),
+    )
+
+    merchant = models.ForeignKey(
+        Merchant, on_delete=models.CASCADE, verbose_name="Merchant"
+    )
+    phone = models.BigIntegerField(verbose_name="Phone Number")
+    amount = models.IntegerField(verbose_name="Charge Amount")
+    status = models.CharField(
+        verbose_name="Status", max_length=8, choices=STATUSES, default=HELD
+    )
+    expires_at = models.DateTimeField(verbose_name="Expires At")
+
+    class Meta:
+        indexes = [
+            # Only open holds are looked up by expiry, by the sweeper.
+            models.Index(
+                fields=["expires_at"],
+                condition=models.Q(status="held"),
+                name="b2b_charge_hold_expiry_idx",
+            ),
+        ]
+
+    def _close(self, status, expired=False):
+        """
+        Moves the hold out of the held state. Returns False if it was not held anymore,
+        or had expired when ``expired`` is False.
+        """
+        holds = CreditHold.objects.filter(id=self.id, status=CreditHold.HELD)
+        if not expired:
+            holds = holds.filter(expires_at__gt=timezone.now())
+        if not holds.update(status=status, updated_time=timezone.now()):
+            return False
+        self.status = status
+        return True
+
+    @merchant_atomic
+    def capture(self):
+        """
+        Charges the held amount: the hold is closed, the amount leaves the merchant's held
+        credit and the charge is logged. Returns the merchant's credit.
+        """
+        if not self._close(CreditHold.CAPTURED):
+            raise Exception(
+                "capture: Credit hold is not open. hold_id: %d, status: %s"
+                % (self.id, CreditHold.objects.get(id=self.id).status)
+            )
+        credit, held = _apply_credit_delta(
+            Merchant, {"id": self.merchant_id}, 0, held=-self.amount, with_held=True
+        )
+        TransactionLog(
+            merchant_id=self.merchant_id,
+            phone=self.phone,
+            amount=-self.amount,
+            balance_after=credit + held,
+        ).log()
+        return credit
+
+    @merchant_atomic
+    def release(self):
+        """
+        Gives the held amount back to the merchant's credit. Returns the merchant's credit.
+        """
+        if not self._close(CreditHold.RELEASED, expired=True):
+            raise Exception(
+                "release: Credit hold is not open. hold_id: %d, status: %s"
+                % (self.id, CreditHold.objects.get(id=self.id).status)
+            )
+        return _apply_credit_delta(
+            Merchant, {"id": self.merchant_id}, self.amount, held=-self.amount
+        )
+
+    @classmethod
+    def expire_stale(cls, batch_size=1000):
+        """
+        Releases the holds whose TTL has passed, ``batch_size`` per transaction, and
+        returns the number expired.
+        """
+        expired = 0
+        for alias in shard_aliases():
+            with using_shard(alias):
+                expired += cls._expire_stale(alias, batch_size)
+        return expired
+
+    @classmethod
+    def _expire_stale(cls, alias, batch_size):
+        expired = 0
+        while True:
+            with atomic(using=alias):
+                holds = list(
+                    cls.objects.select_for_update(skip_locked=True)
+                    .filter(status=cls.HELD, expires_at__lte=timezone.now())
+                    .order_by("expires_at")[:batch_size]
+                )
+                totals = {}
+                for hold in holds:
+                    # Backends without row locks may have closed the hold meanwhile.
+                    if hold._close(cls.EXPIRED, expired=True):
+                        expired += 1
+                        totals[hold.merchant_id] = (
+                            totals.get(hold.merchant_id, 0) + hold.amount
+                        )
+                # In id order, so that concurrent sweepers lock merchants alike.
+                for merchant_id in sorted(totals):
+                    _apply_credit_delta(
+                        Merchant,
+                        {"id": merchant_id},
+                        totals[merchant_id],
+                        held=-totals[merchant_id],
+                    )
+            if len(holds) < batch_size:
+                return expired
 
 
 class TransactionLog(BaseModel):
@@ -89,19 +832,379 @@ class TransactionLog(BaseModel):
     )
     phone = models.BigIntegerField(verbose_name="Phone Number", null=True)
     amount = models.IntegerField(verbose_name="Charge Amount", default=0)
+    balance_after = models.IntegerField(
+        verbose_name="Merchant Credit After Transaction", null=True
+    )
+    # Balance shard the entry applies to, None for Merchant.credit. For sharded
+    # entries balance_after is the credit of the shard, otherwise the merchant's credit
+    # plus its held credit.
+    shard = models.PositiveSmallIntegerField(verbose_name="Balance Shard", null=True)
+    is_transfer = models.BooleanField(verbose_name="Is Transfer", default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["merchant", "-id"], name="b2b_charge_log_merchant_id_idx"
+            ),
+            models.Index(
+                fields=["merchant", "created_time"],
+                name="b2b_charge_log_merchant_ct_idx",
+            ),
+            models.Index(
+                fields=["phone", "created_time"], name="b2b_charge_log_phone_ct_idx"
+            ),
+        ]
 
     def log(self):
         """
         logs the transaction.
+        With ``B2B_CHARGE_LOG_OUTBOX`` the entry goes to the outbox instead, and the log
+        row (and its id) only exists once the flusher has moved it.
+        """
+        if settings.B2B_CHARGE_LOG_OUTBOX:
+            PendingTransactionLog.from_log(self).save()
+        else:
+            self.save()
+        if settings.B2B_CHARGE_EVENTS:
+            TransactionEvent.from_log(self).save()
+
+    @classmethod
+    def bulk_log(cls, logs, batch_size=None):
+        """
+        logs many transactions using chunked multi-row INSERTs.
+        """
+        batch_size = batch_size or settings.B2B_CHARGE_LOG_BATCH_SIZE
+        if settings.B2B_CHARGE_LOG_OUTBOX:
+            PendingTransactionLog.objects.bulk_create(
+                [PendingTransactionLog.from_log(log) for log in logs],
+                batch_size=batch_size,
+            )
+        else:
+            logs = cls.objects.bulk_create(logs, batch_size=batch_size)
+        if settings.B2B_CHARGE_EVENTS:
+            TransactionEvent.objects.bulk_create(
+                [TransactionEvent.from_log(log) for log in logs],
+                batch_size=batch_size,
+            )
+        return logs
+
+    @classmethod
+    def filter_history(cls, merchant_id, phone=None, since=None, until=None):
+        """
+        Returns the merchant's logs, optionally only for one phone and a
+        ``since <= created_time < until`` range. Transfers between balance shards are
+        left out.
         """
-        self.save()
+        logs = cls.objects.filter(merchant_id=merchant_id, is_transfer=False)
+        if phone is not None:
+            logs = logs.filter(phone=phone)
+        if since is not None:
+            logs = logs.filter(created_time__gte=since)
+        if until is not None:
+            logs = logs.filter(created_time__lt=until)
+        return logs
 
     @classmethod
     def get_merchant_credit_sum(cls, merchant):
         """
-        Gets the sum of all transactions for a particular merchant using the logs.
+        Gets the sum of all transactions for a particular merchant using the logs,
+        including the entries still waiting in the outbox.
+        """
+        with merchant_shard(merchant.pk):
+            merchant_transactionlogs_sum = cls.objects.filter(
+                merchant=merchant
+            ).aggregate(Sum("amount"))["amount__sum"]
+            pending_sum = PendingTransactionLog.objects.filter(
+                merchant=merchant
+            ).aggregate(Sum("amount"))["amount__sum"]
+        if pending_sum is None:
+            return merchant_transactionlogs_sum
+        return (merchant_transactionlogs_sum or 0) + pending_sum
+
+    @classmethod
+    def get_merchant_balance(cls, merchant, at=None):
+        """
+        Gets the merchant's credit right after its latest transaction, or after the latest
+        transaction made at or before ``at``. Returns None if there is no such transaction.
+        For sharded merchants this adds up the latest balance of each current shard.
+        """
+        # Entries still in the outbox are newer than every log row of the merchant.
+        with merchant_shard(merchant.pk) as alias:
+            sources = [
+                PendingTransactionLog.objects.using(alias).filter(merchant=merchant),
+                cls.objects.using(alias).filter(merchant=merchant),
+            ]
+        for index, logs in enumerate(sources):
+            if at is None:
+                sources[index] = logs.order_by("-id")
+            else:
+                sources[index] = logs.filter(created_time__lte=at).order_by(
+                    "-created_time", "-id"
+                )
+        shards = [None]
+        if merchant.is_sharded:
+            shards += range(merchant.balance_shards)
+        balances = []
+        for shard in shards:
+            for logs in sources:
+                balance = (
+                    logs.filter(shard=shard)
+                    .values_list("balance_after", flat=True)
+                    .first()
+                )
+                if balance is not None:
+                    break
+            balances.append(balance)
+        balances = [balance for balance in balances if balance is not None]
+        return sum(balances) if balances else None
+
+    @classmethod
+    def get_merchant_balance_drift(cls, merchant):
+        """
+        Gets the difference between the merchant's ledger credit and the balance recorded
+        by its latest transaction. Zero means they agree.
+        """
+        balance = cls.get_merchant_balance(merchant)
+        if balance is None:
+            return None
+        return merchant.get_ledger_credit() - balance
+
+
+class PendingTransactionLog(models.Model):
+    """
+    The model for transaction logs written to the outbox, waiting to be moved to
+    TransactionLog. It has no secondary indexes, so writing an entry costs one small
+    INSERT.
+    """
+
+    merchant = models.ForeignKey(
+        Merchant, on_delete=models.CASCADE, verbose_name="Merchant", db_index=False
+    )
+    phone = models.BigIntegerField(verbose_name="Phone Number", null=True)
+    amount = models.IntegerField(verbose_name="Charge Amount")
+    balance_after = models.IntegerField(
+        verbose_name="Merchant Credit After Transaction", null=True
+    )
+    shard = models.PositiveSmallIntegerField(verbose_name="Balance Shard", null=True)
+    is_transfer = models.BooleanField(verbose_name="Is Transfer", default=False)
+    created_time = models.DateTimeField(verbose_name="Created Datetime")
+
+    # The TransactionLog columns filled from an entry, in the order they are copied.
+    LOG_FIELDS = (
+        "merchant_id",
+        "phone",
+        "amount",
+        "balance_after",
+        "shard",
+        "is_transfer",
+        "created_time",
+    )
+
+    @classmethod
+    def from_log(cls, log):
+        return cls(
+            merchant_id=log.merchant_id,
+            phone=log.phone,
+            amount=log.amount,
+            balance_after=log.balance_after,
+            shard=log.shard,
+            is_transfer=log.is_transfer,
+            created_time=log.created_time or timezone.now(),
+        )
+
+
+class TransactionEvent(models.Model):
+    """
+    The model for the change feed entries of transactions, waiting for the relay to
+    publish them. Like the log outbox it has no secondary indexes.
+    """
+
+    merchant = models.ForeignKey(
+        Merchant, on_delete=models.CASCADE, verbose_name="Merchant", db_index=False
+    )
+    # None when the log row itself was written to the outbox.
+    log_id = models.BigIntegerField(verbose_name="Transaction Log ID", null=True)
+    phone = models.BigIntegerField(verbose_name="Phone Number", null=True)
+    amount = models.IntegerField(verbose_name="Charge Amount")
+    balance_after = models.IntegerField(
+        verbose_name="Merchant Credit After Transaction", null=True
+    )
+    shard = models.PositiveSmallIntegerField(verbose_name="Balance Shard", null=True)
+    is_transfer = models.BooleanField(verbose_name="Is Transfer", default=False)
+    created_time = models.DateTimeField(verbose_name="Created Datetime")
+
+    @classmethod
+    def from_log(cls, log):
+        return cls(
+            merchant_id=log.merchant_id,
+            log_id=log.id,
+            phone=log.phone,
+            amount=log.amount,
+            balance_after=log.balance_after,
+            shard=log.shard,
+            is_transfer=log.is_transfer,
+            created_time=log.created_time or timezone.now(),
+        )
+
+
+class ConsumerOffset(BaseModel):
+    """
+    The model for the position an event consumer has processed the change feed up to.
+    It only lives in the default database.
+    """
+
+    name = models.CharField(verbose_name="Consumer", max_length=64, unique=True)
+    offset = models.BigIntegerField(verbose_name="Offset", default=0)
+
+
+class BalanceSnapshot(BaseModel):
+    """
+    The model for a merchant's ledger balance up to a known transaction log row.
+    """
+
+    merchant = models.ForeignKey(
+        Merchant, on_delete=models.CASCADE, verbose_name="Merchant"
+    )
+    last_log_id = models.BigIntegerField(verbose_name="Last Transaction Log ID")
+    balance = models.IntegerField(verbose_name="Ledger Balance")
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["merchant", "-last_log_id"],
+                name="b2b_charge_snapshot_idx",
+            ),
+        ]
+
+    @classmethod
+    def get_latest(cls, merchant_id):
+        """
+        Returns the merchant's most recent snapshot, or None.
+        """
+        return (
+            cls.objects.filter(merchant_id=merchant_id).order_by("-last_log_id").first()
+        )
+
+
+class TransactionRollup(models.Model):
+    """
+    The model for a merchant's transaction totals over one UTC hour or day.
+    ``debit`` is the total charged, as a positive number. Transfers between balance
+    shards are not counted.
+    """
+
+    HOUR = "hour"
+    DAY = "day"
+    PERIODS = ((HOUR, "Hour"), (DAY, "Day"))
+
+    merchant = models.ForeignKey(
+        Merchant, on_delete=models.CASCADE, verbose_name="Merchant"
+    )
+    period = models.CharField(verbose_name="Period", max_length=4, choices=PERIODS)
+    start = models.DateTimeField(verbose_name="Period Start")
+    count = models.IntegerField(verbose_name="Transactions", default=0)
+    credit = models.BigIntegerField(verbose_name="Total Credit", default=0)
+    debit = models.BigIntegerField(verbose_name="Total Debit", default=0)
+    phones = models.IntegerField(verbose_name="Distinct Phones", default=0)
+    updated_time = models.DateTimeField(verbose_name="Updated Datetime", auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["merchant", "period", "start"],
+                name="b2b_charge_rollup_unique",
+            ),
+        ]
+
+
+class ShardPlacement(BaseModel):
+    """
+    The model for the shard of a merchant that was moved away from the shard its id was
+    made for. It only lives in the default database.
+    """
+
+    merchant_id = models.BigIntegerField(verbose_name="Merchant ID", unique=True)
+    alias = models.CharField(verbose_name="Database Alias", max_length=64)
+    # Writes to the merchant are refused while it moves.
+    moving = models.BooleanField(verbose_name="Is Moving", default=False)
+
+
+class VelocityRule(BaseModel):
+    """
+    The model for a limit on the charges of a merchant, or of every merchant, within a
+    sliding window. It only lives in the default database.
+    """
+
+    # Counts the merchant's charges, or its charges to each phone.
+    MERCHANT = "merchant"
+    PHONE = "phone"
+    SCOPES = ((MERCHANT, "Merchant"), (PHONE, "Phone"))
+
+    # None applies the rule to every merchant.
+    merchant_id = models.BigIntegerField(
+        verbose_name="Merchant ID", null=True, db_index=True
+    )
+    scope = models.CharField(
+        verbose_name="Scope", max_length=8, choices=SCOPES, default=PHONE
+    )
+    window = models.PositiveIntegerField(verbose_name="Window Seconds")
+    # Either limit may be None, for no limit.
+    max_count = models.PositiveIntegerField(verbose_name="Max Charges", null=True)
+    max_amount = models.BigIntegerField(verbose_name="Max Amount", null=True)
+    is_active = models.BooleanField(verbose_name="Is active", default=True)
+
+
+class LogCheckpoint(BaseModel):
+    """
+    The model for the id of the last transaction log row a background job has processed.
+    """
+
+    name = models.CharField(verbose_name="Name", max_length=64, unique=True)
+    last_log_id = models.BigIntegerField(
+        verbose_name="Last Transaction Log ID", default=0
+    )
+
+
+class IdempotencyKey(BaseModel):
+    """
+    The model for the stored responses of requests sent with an Idempotency-Key header.
+    """
+
+    merchant = models.ForeignKey(
+        Merchant, on_delete=models.CASCADE, verbose_name="Merchant"
+    )
+    key = models.CharField(verbose_name="Idempotency Key", max_length=255)
+    action = models.CharField(verbose_name="Action", max_length=32)
+    request_hash = models.CharField(verbose_name="Request Hash", max_length=64)
+    response_status = models.PositiveSmallIntegerField(verbose_name="Response Status")
+    response_body = models.JSONField(verbose_name="Response Body")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["merchant", "key"], name="b2b_charge_idempotency_key_unique"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["created_time"], name="b2b_charge_idem_created_idx"),
+        ]
+
+    @classmethod
+    def prune_expired(cls, ttl, batch_size=10000):
+        """
+        Deletes keys older than ``ttl`` seconds in batches. Returns the number deleted.
         """
-        merchant_transactionlogs_sum = cls.objects.filter(merchant=merchant).aggregate(
-            Sum("amount")
-        )["amount__sum"]
-        return merchant_transactionlogs_sum
+        cutoff = timezone.now() - timedelta(seconds=ttl)
+        deleted = 0
+        for alias in shard_aliases():
+            keys = cls.objects.using(alias)
+            while True:
+                ids = list(
+                    keys.filter(created_time__lt=cutoff).values_list("id", flat=True)[
+                        :batch_size
+                    ]
+                )
+                if not ids:
+                    break
+                deleted += keys.filter(id__in=ids).delete()[0]
+        return deleted
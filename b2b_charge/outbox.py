@@ -0,0 +1,129 @@
+"""
+Outbox for transaction logs.
+
+With ``B2B_CHARGE_LOG_OUTBOX`` enabled, ``TransactionLog.log`` and ``bulk_log`` write
+their entries to ``PendingTransactionLog``, a table without secondary indexes, in the
+same transaction as the credit change. ``flush_pending_logs`` later moves the entries
+to ``TransactionLog`` in large batches. Each batch is deleted from the outbox and
+inserted into the log in one transaction, so after a crash every entry is in exactly
+one of the two tables and the next flush picks up where the last one stopped.
+
+Only one flusher runs at a time, behind a transaction-level advisory lock on
+PostgreSQL. Entries are moved in id order, so a merchant's log rows keep the order of
+its transactions. An entry is left out of the history and the exports until it is
+flushed. It is still counted by the ledger sums and by reconciliation, which flushes
+first. The setting has to be the same in every process.
+"""
+
+import time
+import zlib
+
+from django.conf import settings
+from django.db import connections
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .models import PendingTransactionLog, TransactionLog
+from .sharding import shard_aliases
+
+LOCK_KEY = zlib.crc32(b"b2b_charge_log_outbox")
+
+
+def _move_batch(connection, batch_size, wait):
+    """
+    Moves up to ``batch_size`` of the oldest entries. Returns how many were moved, or
+    None if another flusher holds the lock.
+    """
+    quote = connection.ops.quote_name
+    pending_table = quote(PendingTransactionLog._meta.db_table)
+    log_table = quote(TransactionLog._meta.db_table)
+    columns = ", ".join(quote(column) for column in PendingTransactionLog.LOG_FIELDS)
+    now = TransactionLog._meta.get_field("updated_time").get_db_prep_value(
+        timezone.now(), connection
+    )
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                (
+                    "SELECT pg_advisory_xact_lock(%s), true"
+                    if wait
+                    else "SELECT pg_try_advisory_xact_lock(%s)"
+                ),
+                [LOCK_KEY],
+            )
+            if not cursor.fetchone()[-1]:
+                return None
+            # The rows never leave the server: the DELETE feeds the INSERT directly.
+            cursor.execute(
+                "WITH moved AS ("
+                " DELETE FROM {pending} WHERE id IN"
+                " (SELECT id FROM {pending} ORDER BY id LIMIT %s)"
+                " RETURNING id, {columns})"
+                " INSERT INTO {log} ({columns}, updated_time)"
+                " SELECT {columns}, %s FROM moved ORDER BY id".format(
+                    pending=pending_table, log=log_table, columns=columns
+                ),
+                [batch_size, now],
+            )
+            return cursor.rowcount
+        ids = list(
+            PendingTransactionLog.objects.using(connection.alias)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if ids:
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                "INSERT INTO {log} ({columns}, updated_time)"
+                " SELECT {columns}, %s FROM {pending} WHERE id IN ({ids})"
+                " ORDER BY id".format(
+                    pending=pending_table,
+                    log=log_table,
+                    columns=columns,
+                    ids=placeholders,
+                ),
+                [now] + ids,
+            )
+            cursor.execute(
+                "DELETE FROM {pending} WHERE id IN ({ids})".format(
+                    pending=pending_table, ids=placeholders
+                ),
+                ids,
+            )
+        return len(ids)
+
+
+def flush_pending_logs(batch_size=None, using=None, wait=True):
+    """
+    Moves every entry of the outbox to TransactionLog, one transaction per batch, and
+    returns the number moved. With ``wait=False`` it gives up, returning 0, when another
+    flusher is running. Every shard's outbox is flushed unless ``using`` names one.
+    """
+    batch_size = batch_size or settings.B2B_CHARGE_LOG_FLUSH_BATCH_SIZE
+    if using is None:
+        return sum(
+            flush_pending_logs(batch_size, alias, wait) for alias in shard_aliases()
+        )
+    connection = connections[using]
+    moved = 0
+    while True:
+        with atomic(using=using):
+            count = _move_batch(connection, batch_size, wait)
+        if count is None:
+            return moved
+        moved += count
+        if count < batch_size:
+            return moved
+
+
+def run_flusher(interval, batch_size=None, callback=None):
+    """
+    Flushes the outbox every ``interval`` seconds until interrupted. ``callback`` is
+    called with the number of entries moved by each pass.
+    """
+    while True:
+        started = time.monotonic()
+        moved = flush_pending_logs(batch_size, wait=False)
+        if callback is not None:
+            callback(moved)
+        time.sleep(max(0, interval - (time.monotonic() - started)))
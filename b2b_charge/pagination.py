@@ -0,0 +1,112 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .sharding import fetch_sharded
+
+
+class CreatedTimeKeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination over ``(created_time, id)``, newest first.
+
+    Each page is fetched with ``WHERE (created_time, id) < (<last seen>) ORDER BY
+    created_time DESC, id DESC LIMIT page_size + 1``, so a deep page costs the same as the
+    first one and no COUNT(*) is run. The cursor is opaque to clients.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def get_page_size(self, request):
+        page_size = settings.B2B_CHARGE_PAGE_SIZE
+        if self.page_size_query_param in request.query_params:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+            except ValueError:
+                pass
+        return max(1, min(page_size, settings.B2B_CHARGE_MAX_PAGE_SIZE))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            created_time, pk = urlsafe_b64decode(encoded.encode()).decode().split("|")
+            created_time = parse_datetime(created_time)
+            pk = int(pk)
+        except ValueError:
+            created_time = None
+        if created_time is None:
+            raise NotFound("Invalid cursor.")
+        return created_time, pk
+
+    def encode_cursor(self, instance):
+        position = "%s|%d" % (instance.created_time.isoformat(), instance.pk)
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by("-created_time", "-id")
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            created_time, pk = cursor
+            # The redundant created_time__lte bound lets the database walk the index.
+            queryset = queryset.filter(created_time__lte=created_time).filter(
+                Q(created_time__lt=created_time)
+                | Q(created_time=created_time, id__lt=pk)
+            )
+        results = self.fetch(queryset, page_size + 1)
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+        return self.page
+
+    def fetch(self, queryset, limit):
+        return list(queryset[:limit])
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(self.page[-1]),
+        )
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class ShardedKeysetPagination(CreatedTimeKeysetPagination):
+    """
+    Keyset pagination over a table that is spread over the merchant shards. Every shard
+    returns its own page, and the pages are merged.
+    """
+
+    def fetch(self, queryset, limit):
+        return fetch_sharded(
+            queryset, limit, key=lambda instance: (instance.created_time, instance.pk)
+        )
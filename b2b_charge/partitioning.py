@@ -0,0 +1,330 @@
+"""
+Monthly range partitioning of the TransactionLog table on PostgreSQL.
+
+Partitioning is opt-in and is switched on with ``manage_log_partitions --enable``:
+
+1. The existing table gets a unique index on ``(id, created_time)``, built
+   CONCURRENTLY.
+2. A partitioned copy of the table is created next to it, partitioned by
+   ``created_time`` with one partition per month. The first one starts at least
+   ``SWAP_MARGIN`` after now, so the month cannot end before the swap.
+3. The existing table gets a ``created_time < <first partition>`` CHECK constraint, read
+   back from the partition bounds. It is added NOT VALID and validated separately so it
+   never blocks writes.
+4. In one short transaction the tables are swapped by name and the old table is
+   attached as the "legacy" partition, up to the first partition's bound as read at
+   swap time. Thanks to the validated constraint and the pre-built indexes, attaching
+   does not scan or index the old rows.
+
+After that ``manage_log_partitions`` keeps partitions created ahead of time and detaches
+old ones (``DETACH PARTITION ... CONCURRENTLY``, PostgreSQL 14+).
+"""
+
+import re
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection as default_connection
+from django.db.transaction import atomic
+
+from .models import Merchant, TransactionLog
+
+TABLE = TransactionLog._meta.db_table
+LEGACY_TABLE = "%s_legacy" % TABLE
+STAGING_TABLE = "%s_partitioned" % TABLE
+SEQUENCE = "%s_id_seq_partitioned" % TABLE
+PARTITION_RE = re.compile(r"^%s_p(\d{4})_(\d{2})$" % re.escape(TABLE))
+LOWER_BOUND_RE = re.compile(r"FROM \('(\d{4})-(\d{2})-(\d{2})")
+UPPER_BOUND_RE = re.compile(r"TO \('(\d{4})-(\d{2})-(\d{2})")
+# How long enabling partitioning may take between reading the clock and the swap.
+SWAP_MARGIN = timedelta(days=7)
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return "%s_p%04d_%02d" % (TABLE, month.year, month.month)
+
+
+def partition_month(name):
+    """
+    Returns the month a partition covers from its name, or None for other tables.
+    """
+    match = PARTITION_RE.match(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def is_partitioned(connection=default_connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(%s)", [TABLE]
+        )
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def partition_bounds(bound):
+    """
+    Returns the ``(lower, upper)`` dates of a partition bound expression, None for
+    MINVALUE and MAXVALUE.
+    """
+    return tuple(
+        match and date(*(int(part) for part in match.groups()))
+        for match in (LOWER_BOUND_RE.search(bound), UPPER_BOUND_RE.search(bound))
+    )
+
+
+def _bounds(connection, table):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)"
+            " FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+            " WHERE i.inhparent = to_regclass(%s)",
+            [table],
+        )
+        return {name: partition_bounds(bound) for name, bound in cursor.fetchall()}
+
+
+def list_partitions(connection=default_connection):
+    """
+    Returns ``{name: upper bound}`` for the tables attached to the partitioned log.
+    """
+    return {name: upper for name, (_, upper) in _bounds(connection, TABLE).items()}
+
+
+def legacy_bound(bounds):
+    """
+    Returns the upper bound of the legacy partition: the lower bound of the first of
+    the ``{name: (lower, upper)}`` partitions it goes in front of.
+    """
+    lowers = [lower for lower, _ in bounds.values() if lower is not None]
+    if not lowers:
+        raise Exception("legacy_bound: The partitioned table has no partitions.")
+    return min(lowers)
+
+
+def first_partition_month(today):
+    """
+    Returns the month the first partition starts when partitioning is enabled on
+    ``today``: the next month that starts ``SWAP_MARGIN`` from now or later.
+    """
+    return add_months(month_start(today + SWAP_MARGIN), 1)
+
+
+def create_partition(cursor, table, month):
+    qn = cursor.db.ops.quote_name
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)"
+        % (qn(partition_name(month)), qn(table)),
+        [month.isoformat(), add_months(month, 1).isoformat()],
+    )
+
+
+def create_future_partitions(months_ahead, today=None, connection=default_connection):
+    """
+    Makes sure there is a partition for this month and the next ``months_ahead`` months.
+    Returns the names of the partitions that were created.
+    """
+    first = month_start(today or date.today())
+    partitions = list_partitions(connection)
+    # Months before the legacy partition's upper bound are already covered by it.
+    legacy_bound = partitions.get(LEGACY_TABLE)
+    if legacy_bound is not None:
+        first = max(first, legacy_bound)
+    created = []
+    with connection.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            month = add_months(first, offset)
+            if partition_name(month) not in partitions:
+                create_partition(cursor, TABLE, month)
+                created.append(partition_name(month))
+    return created
+
+
+def detach_old_partitions(retain_months, today=None, connection=default_connection):
+    """
+    Detaches monthly partitions that ended more than ``retain_months`` months ago.
+    The detached tables are kept so they can be archived or dropped separately.
+    Returns the names of the detached partitions.
+    """
+    cutoff = add_months(month_start(today or date.today()), -retain_months)
+    qn = connection.ops.quote_name
+    detached = []
+    for name in list_partitions(connection):
+        month = partition_month(name)
+        if month is None or add_months(month, 1) > cutoff:
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE %s DETACH PARTITION %s CONCURRENTLY"
+                % (qn(TABLE), qn(name))
+            )
+        detached.append(name)
+    return detached
+
+
+def retained_month(partitions):
+    """
+    Returns the first month of the log still complete in ``partitions``, as returned by
+    ``list_partitions``: the months before it were detached. None when none were.
+    """
+    months = sorted(filter(None, map(partition_month, partitions)))
+    legacy_bound = partitions.get(LEGACY_TABLE)
+    if not months or (legacy_bound is not None and months[0] <= legacy_bound):
+        return None
+    return months[0]
+
+
+def retained_since(connection=default_connection):
+    """
+    Returns the time from which the log rows are all attached, or None when the log
+    is whole, e.g. on a table that is not partitioned.
+    """
+    if connection.vendor != "postgresql" or not is_partitioned(connection):
+        return None
+    month = retained_month(list_partitions(connection))
+    if month is None:
+        return None
+    return datetime(month.year, month.month, 1, tzinfo=dt_timezone.utc)
+
+
+def enable_partitioning(months_ahead, today=None, connection=default_connection):
+    """
+    Turns the TransactionLog table into a partitioned table, keeping the existing rows
+    in a legacy partition. Must run outside of a transaction.
+    """
+    qn = connection.ops.quote_name
+    log_indexes = [(index.name, index.fields) for index in TransactionLog._meta.indexes]
+    check = qn("%s_legacy_range" % TABLE)
+
+    with connection.cursor() as cursor:
+        # Leftovers of an earlier attempt that failed before the swap.
+        cursor.execute("DROP TABLE IF EXISTS %s CASCADE" % qn(STAGING_TABLE))
+        cursor.execute("DROP SEQUENCE IF EXISTS %s" % qn(SEQUENCE))
+        cursor.execute(
+            "ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s" % (qn(TABLE), check)
+        )
+        cursor.execute(
+            "DROP INDEX CONCURRENTLY IF EXISTS %s" % qn("%s_legacy_pk" % TABLE)
+        )
+
+        # 1. The slow index build comes first, before the clock is read.
+        cursor.execute(
+            "CREATE UNIQUE INDEX CONCURRENTLY %s ON %s (id, created_time)"
+            % (qn("%s_legacy_pk" % TABLE), qn(TABLE))
+        )
+
+        # 2. The new, still empty, partitioned table.
+        cursor.execute(
+            "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (created_time)"
+            % (qn(STAGING_TABLE), qn(TABLE))
+        )
+        cursor.execute(
+            "ALTER TABLE %s ADD PRIMARY KEY (id, created_time)" % qn(STAGING_TABLE)
+        )
+        cursor.execute(
+            "ALTER TABLE %s ADD FOREIGN KEY (merchant_id) REFERENCES %s (id)"
+            " DEFERRABLE INITIALLY DEFERRED"
+            % (qn(STAGING_TABLE), qn(Merchant._meta.db_table))
+        )
+        for name, fields in log_indexes:
+            columns = ", ".join(
+                (
+                    "%s DESC" % qn(_column(field[1:]))
+                    if field.startswith("-")
+                    else qn(_column(field))
+                )
+                for field in fields
+            )
+            cursor.execute(
+                "CREATE INDEX %s ON %s (%s)"
+                % (qn("%s_p" % name), qn(STAGING_TABLE), columns)
+            )
+        first = first_partition_month(today or date.today())
+        for offset in range(months_ahead + 1):
+            create_partition(cursor, STAGING_TABLE, add_months(first, offset))
+        cursor.execute("CREATE SEQUENCE %s AS bigint" % qn(SEQUENCE))
+
+        # 3. Let the old table be attached in front of the partitions without a scan.
+        boundary = legacy_bound(_bounds(connection, STAGING_TABLE))
+        cursor.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s CHECK (created_time < %%s) NOT VALID"
+            % (qn(TABLE), check),
+            [boundary.isoformat()],
+        )
+        cursor.execute("ALTER TABLE %s VALIDATE CONSTRAINT %s" % (qn(TABLE), check))
+
+    # 4. Swap. Writers wait on the lock only for the duration of these statements.
+    with atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" % qn(TABLE))
+        boundary = legacy_bound(_bounds(connection, STAGING_TABLE))
+        cursor.execute(
+            "SELECT pg_get_constraintdef(oid) FROM pg_constraint"
+            " WHERE conrelid = %s::regclass AND conname = %s",
+            [TABLE, "%s_legacy_range" % TABLE],
+        )
+        row = cursor.fetchone()
+        if row is None or boundary.isoformat() not in row[0]:
+            raise Exception(
+                "enable_partitioning: The range constraint of the log does not end at "
+                "the first partition, %s. Run it again." % (boundary)
+            )
+        cursor.execute(
+            "SELECT setval(%%s, COALESCE((SELECT MAX(id) FROM %s), 0) + 1, false)"
+            % qn(TABLE),
+            [SEQUENCE],
+        )
+        cursor.execute(
+            "ALTER TABLE %s ALTER COLUMN id DROP IDENTITY IF EXISTS" % qn(TABLE)
+        )
+        cursor.execute("ALTER TABLE %s ALTER COLUMN id DROP DEFAULT" % qn(TABLE))
+        # The partition's key is the (id, created_time) index built above.
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass"
+            " AND contype = 'p'",
+            [TABLE],
+        )
+        for (name,) in cursor.fetchall():
+            cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (qn(TABLE), qn(name)))
+        cursor.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY USING INDEX %s"
+            % (qn(TABLE), qn("%s_legacy_pkey" % TABLE), qn("%s_legacy_pk" % TABLE))
+        )
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(TABLE), qn(LEGACY_TABLE)))
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(STAGING_TABLE), qn(TABLE)))
+        cursor.execute(
+            "ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval(%%s::regclass)"
+            % qn(TABLE),
+            [SEQUENCE],
+        )
+        cursor.execute("ALTER SEQUENCE %s OWNED BY %s.id" % (qn(SEQUENCE), qn(TABLE)))
+        cursor.execute(
+            "ALTER TABLE %s RENAME CONSTRAINT %s TO %s"
+            % (qn(TABLE), qn("%s_pkey" % STAGING_TABLE), qn("%s_pkey" % TABLE))
+        )
+        cursor.execute(
+            "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%%s)"
+            % (qn(TABLE), qn(LEGACY_TABLE)),
+            [boundary.isoformat()],
+        )
+        # Give the model's index names to the partitioned indexes, so later migrations
+        # touching them act on the whole table.
+        for name, _ in log_indexes:
+            cursor.execute(
+                "ALTER INDEX %s RENAME TO %s" % (qn(name), qn("%s_legacy" % name))
+            )
+            cursor.execute(
+                "ALTER INDEX %s RENAME TO %s" % (qn("%s_p" % name), qn(name))
+            )
+
+
+def _column(field_name):
+    return TransactionLog._meta.get_field(field_name).column
@@ -0,0 +1,259 @@
+"""
+Bulk merchant provisioning and credit top-ups.
+
+Rows are validated in one pass up front, then applied in chunks, each in its own
+transaction, so a bad row or a failed chunk is reported without aborting the rest.
+Every result is ``{"row": <index>, "status": "success", ...}`` or
+``{"row": <index>, "status": "failed", "message": ...}``, in the order of the input.
+"""
+
+import csv
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.transaction import atomic, on_commit
+from django.utils import timezone
+
+from .cache import balance_cache
+from .models import Merchant, TransactionLog
+from .serializers import _integer
+from .sharding import new_merchant_ids, shard_map, using_shard
+
+IMPORT_FORMATS = ("csv", "ndjson")
+
+
+def _failed(row, message):
+    return {"row": row, "status": "failed", "message": message}
+
+
+def _validate(rows, fields, first_row=0):
+    """
+    Converts the ``fields`` of every row to integers in one pass, as strictly as the
+    charge endpoints do.
+    Returns the valid ``(row, values)`` pairs and the failures.
+    """
+    valid = []
+    failures = []
+    for row, item in enumerate(rows, first_row):
+        if not isinstance(item, dict):
+            failures.append(_failed(row, "row must be an object"))
+            continue
+        errors = {}
+        values = tuple(_integer(item, field, errors) for field in fields)
+        if errors:
+            message = " ".join(
+                "%s: %s" % (field, messages[0]) for field, messages in errors.items()
+            )
+            failures.append(_failed(row, message))
+            continue
+        valid.append((row, values))
+    return valid, failures
+
+
+def _chunks(items, chunk_size):
+    chunk_size = chunk_size or settings.B2B_CHARGE_LOG_BATCH_SIZE
+    for start in range(0, len(items), chunk_size):
+        yield items[start : start + chunk_size]
+
+
+def _sorted_results(results):
+    return sorted(results, key=lambda result: result["row"])
+
+
+def create_merchants(rows, chunk_size=None, first_row=0):
+    """
+    Creates a merchant for each ``{"credit": <opening balance>}`` row with
+    ``bulk_create``, and logs the opening balances so that every credit still equals
+    the sum of its logs. With sharding, each chunk is placed on a random shard.
+    """
+    valid, results = _validate(rows, ("credit",), first_row)
+    pending = []
+    for row, (credit,) in valid:
+        if credit < 0:
+            results.append(_failed(row, "credit must not be negative"))
+        else:
+            pending.append((row, credit))
+
+    for chunk in _chunks(pending, chunk_size):
+        # Each chunk goes to one shard.
+        using = shard_map.pick()
+        try:
+            with using_shard(using), atomic(using=using):
+                ids = new_merchant_ids(using, len(chunk))
+                merchants = Merchant.objects.bulk_create(
+                    [
+                        Merchant(id=merchant_id, credit=credit)
+                        for merchant_id, (_, credit) in zip(ids, chunk)
+                    ]
+                )
+                TransactionLog.bulk_log(
+                    [
+                        TransactionLog(
+                            merchant_id=merchant.id,
+                            phone=None,
+                            amount=merchant.credit,
+                            balance_after=merchant.credit,
+                        )
+                        for merchant in merchants
+                        if merchant.credit
+                    ]
+                )
+        except DatabaseError as e:
+            results.extend(_failed(row, str(e)) for row, _ in chunk)
+            continue
+        results.extend(
+            {
+                "row": row,
+                "status": "success",
+                "merchant_id": merchant.id,
+                "credit": merchant.credit,
+            }
+            for (row, _), merchant in zip(chunk, merchants)
+        )
+    return _sorted_results(results)
+
+
+def _apply_top_ups(deltas, using):
+    """
+    Adds ``deltas`` (merchant id -> amount) to the merchants' credits.
+    Returns ``{merchant id: (new credit, version, balance shards, held credit)}`` for
+    the merchants found.
+    """
+    connection = connections[using]
+    now = timezone.now()
+    if connection.vendor != "postgresql":
+        credits = {}
+        for merchant_id, delta in deltas.items():
+            credit = Merchant.apply_credit_delta(merchant_id, delta, using)
+            if credit is not None:
+                credits[merchant_id] = credit
+        return {
+            merchant_id: (credits[merchant_id], version, balance_shards, held)
+            for merchant_id, version, balance_shards, held in Merchant.objects.using(
+                using
+            )
+            .filter(id__in=credits)
+            .values_list("id", "version", "balance_shards", "held_credit")
+        }
+
+    table = connection.ops.quote_name(Merchant._meta.db_table)
+    values = ", ".join(["(%s::bigint, %s::integer)"] * len(deltas))
+    sql = (
+        "UPDATE {table} AS m SET credit = m.credit + v.delta,"
+        " version = m.version + 1, updated_time = %s"
+        " FROM (VALUES {values}) AS v(id, delta) WHERE m.id = v.id"
+        " RETURNING m.id, m.credit, m.version, m.balance_shards, m.held_credit"
+    ).format(table=table, values=values)
+    params = [
+        Merchant._meta.get_field("updated_time").get_db_prep_value(now, connection)
+    ]
+    for merchant_id, delta in deltas.items():
+        params += [merchant_id, delta]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def _publish(credits):
+    for merchant_id, row in credits.items():
+        balance_cache.publish(merchant_id, *row[:3])
+
+
+def top_up_merchants(rows, chunk_size=None, first_row=0):
+    """
+    Adds credit to many merchants, one ``{"merchant_id", "credit"}`` row at a time.
+    Each chunk is applied with a single ``UPDATE ... FROM (VALUES ...)`` on PostgreSQL
+    (one conditional UPDATE per merchant elsewhere) and its logs with ``bulk_create``.
+    A sharded merchant's top-up goes to ``Merchant.credit`` and is spread over its shards
+    by the next rebalance.
+    """
+    valid, results = _validate(rows, ("merchant_id", "credit"), first_row)
+    pending = []
+    for row, (merchant_id, credit) in valid:
+        if credit <= 0:
+            results.append(_failed(row, "credit must be positive"))
+        else:
+            pending.append((row, merchant_id, credit))
+
+    for chunk in _chunks(pending, chunk_size):
+        shards = defaultdict(list)
+        for item in chunk:
+            shards[shard_map.placement(item[1])].append(item)
+        for (using, moving), items in shards.items():
+            if moving:
+                results.extend(
+                    _failed(row, "merchant is being moved to another shard")
+                    for row, _, _ in items
+                )
+            else:
+                with using_shard(using):
+                    results.extend(_top_up_chunk(items, using))
+    return _sorted_results(results)
+
+
+def _top_up_chunk(chunk, using):
+    """
+    Applies the top-ups of one chunk, whose merchants all live on the ``using`` shard.
+    """
+    deltas = defaultdict(int)
+    for _, merchant_id, credit in chunk:
+        deltas[merchant_id] += credit
+    chunk_results = []
+    try:
+        with atomic(using=using):
+            credits = _apply_top_ups(deltas, using)
+            # Rows of the same merchant are applied in file order, so walk back
+            # from the final ledger credit to the balance after each of them.
+            balances = {
+                merchant_id: credit + held - deltas[merchant_id]
+                for merchant_id, (credit, _, _, held) in credits.items()
+            }
+            logs = []
+            for row, merchant_id, credit in chunk:
+                if merchant_id not in credits:
+                    chunk_results.append(_failed(row, "merchant does not exist"))
+                    continue
+                balances[merchant_id] += credit
+                logs.append(
+                    TransactionLog(
+                        merchant_id=merchant_id,
+                        phone=None,
+                        amount=credit,
+                        balance_after=balances[merchant_id],
+                    )
+                )
+                chunk_results.append(
+                    {
+                        "row": row,
+                        "status": "success",
+                        "merchant_id": merchant_id,
+                        "credit": balances[merchant_id],
+                    }
+                )
+            TransactionLog.bulk_log(logs)
+            on_commit(lambda credits=credits: _publish(credits), using=using)
+    except DatabaseError as e:
+        chunk_results = [_failed(row, str(e)) for row, _, _ in chunk]
+    return chunk_results
+
+
+def read_rows(path, format=None):
+    """
+    Yields the rows of a CSV (with a header line) or NDJSON file as dicts. Lines that
+    are not valid JSON are yielded as they are and fail validation.
+    """
+    if format is None:
+        format = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+    with open(path, newline="") as rows_file:
+        if format == "csv":
+            yield from csv.DictReader(rows_file)
+            return
+        for line in rows_file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line
@@ -0,0 +1,152 @@
+"""
+Incremental reconciliation of merchant credits against the transaction log.
+
+Every run compares each merchant's credit with its ledger balance, which is the
+merchant's latest ``BalanceSnapshot`` plus the log rows written after it. Only those
+rows are read, through the ``(merchant, -id)`` index, so a run costs as much as the
+history written since the previous one. Afterwards a new snapshot is stored.
+
+A snapshot only covers log rows older than the safety lag. A row whose id is below the
+snapshot but that was committed later would never be summed, and the lag covers
+transactions that were still running when the snapshot was taken. Each merchant is
+checked in a single REPEATABLE READ transaction, so its credit and its log rows are
+read from the same point in time.
+
+Entries still in the transaction log outbox count towards the ledger balance, but
+``reconcile`` flushes the outbox first so that snapshots can cover them.
+
+``full=True`` ignores the snapshots and sums the whole history again. That only works
+while no log partitions have been detached. With sharding, each merchant is checked on
+its own shard.
+"""
+
+import multiprocessing
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max, Q, Sum
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .models import (
+    BalanceSnapshot,
+    Merchant,
+    PendingTransactionLog,
+    TransactionLog,
+)
+from .outbox import flush_pending_logs
+from .sharding import fan_out, merchant_shard
+
+
+def reconcile_merchant(merchant_id, full=False, safety_lag=None):
+    """
+    Reconciles one merchant and returns ``{merchant_id, credit, ledger, drift,
+    scanned_from}``, where a non-zero drift means the credit does not match the log.
+    """
+    if safety_lag is None:
+        safety_lag = settings.B2B_CHARGE_RECONCILE_SAFETY_LAG
+    with merchant_shard(merchant_id) as alias:
+        return _reconcile_merchant(merchant_id, full, safety_lag, connections[alias])
+
+
+def _reconcile_merchant(merchant_id, full, safety_lag, connection):
+    # The isolation level can only be set by the first statement of a transaction.
+    repeatable_read = (
+        connection.vendor == "postgresql" and not connection.in_atomic_block
+    )
+    with atomic(using=connection.alias):
+        if repeatable_read:
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cutoff = timezone.now() - timedelta(seconds=safety_lag)
+        merchant = Merchant.objects.get(id=merchant_id)
+        credit = merchant.get_ledger_credit()
+
+        snapshot = None if full else BalanceSnapshot.get_latest(merchant_id)
+        last_log_id = snapshot.last_log_id if snapshot else 0
+        balance = snapshot.balance if snapshot else 0
+
+        logs = TransactionLog.objects.filter(
+            merchant_id=merchant_id, id__gt=last_log_id
+        )
+        tail = logs.aggregate(
+            total=Sum("amount"),
+            settled_id=Max("id", filter=Q(created_time__lte=cutoff)),
+        )
+        pending = PendingTransactionLog.objects.filter(
+            merchant_id=merchant_id
+        ).aggregate(Sum("amount"))["amount__sum"]
+        ledger = balance + (tail["total"] or 0) + (pending or 0)
+
+        if tail["settled_id"] is not None:
+            settled = logs.filter(id__lte=tail["settled_id"]).aggregate(Sum("amount"))
+            BalanceSnapshot.objects.create(
+                merchant_id=merchant_id,
+                last_log_id=tail["settled_id"],
+                balance=balance + settled["amount__sum"],
+            )
+    return {
+        "merchant_id": merchant_id,
+        "credit": credit,
+        "ledger": ledger,
+        "drift": credit - ledger,
+        "scanned_from": last_log_id,
+    }
+
+
+def _reconcile_chunk(args):
+    merchant_ids, full, safety_lag = args
+    try:
+        return [
+            reconcile_merchant(merchant_id, full, safety_lag)
+            for merchant_id in merchant_ids
+        ]
+    finally:
+        connections.close_all()
+
+
+def reconcile(merchant_ids=None, full=False, workers=None, safety_lag=None, flush=True):
+    """
+    Reconciles the given merchants (all of them by default) over ``workers`` processes
+    and returns a report with the merchants whose credit drifted from the log.
+    """
+    if flush:
+        flush_pending_logs()
+    if workers is None:
+        workers = settings.B2B_CHARGE_RECONCILE_WORKERS
+    if merchant_ids is None:
+        merchant_ids = sorted(
+            merchant_id
+            for shard in fan_out(
+                lambda: list(Merchant.objects.values_list("id", flat=True))
+            )
+            for merchant_id in shard
+        )
+    started = time.perf_counter()
+    if workers > 1 and len(merchant_ids) > 1:
+        # Forked children must not share the parent's database connections.
+        connections.close_all()
+        # Interleave the merchants so that big and small ones spread over the workers.
+        jobs = [
+            (merchant_ids[index::workers], full, safety_lag) for index in range(workers)
+        ]
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = [
+                result for chunk in pool.map(_reconcile_chunk, jobs) for result in chunk
+            ]
+    else:
+        results = [
+            reconcile_merchant(merchant_id, full, safety_lag)
+            for merchant_id in merchant_ids
+        ]
+    return {
+        "full": full,
+        "merchants": len(results),
+        "elapsed_s": time.perf_counter() - started,
+        "drifted": sorted(
+            (result for result in results if result["drift"]),
+            key=lambda result: result["merchant_id"],
+        ),
+    }
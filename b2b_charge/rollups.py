@@ -0,0 +1,183 @@
+"""
+Hourly and daily per-merchant transaction rollups for reporting.
+
+``run_rollups`` follows the transaction log with a high-water mark stored in a
+``LogCheckpoint``. For the log rows written since the last run it finds the hours and
+days they fall in, then rebuilds those buckets from the log through the
+``(merchant, created_time)`` index. Rebuilding a whole bucket instead of adding the new
+rows to it keeps the distinct phone count exact. It also makes a run idempotent: a run
+that failed halfway is simply repeated. A run costs as much as the buckets it touches.
+
+Like the balance snapshots, the high-water mark stops at rows older than a safety lag,
+so rows committed out of id order are not skipped. Entries still in the log outbox are
+picked up once they are flushed. Rollups outlive detached log partitions: buckets
+older than the oldest month still attached are never rebuilt, as their rows are gone.
+"""
+
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .models import LogCheckpoint, TransactionLog, TransactionRollup
+from .partitioning import retained_since
+from .sharding import shard_aliases, using_shard
+
+CHECKPOINT = "transaction_rollups"
+
+PERIODS = {
+    TransactionRollup.HOUR: (TruncHour, timedelta(hours=1)),
+    TransactionRollup.DAY: (TruncDay, timedelta(days=1)),
+}
+
+
+def _trunc(period):
+    return PERIODS[period][0]("created_time", tzinfo=dt_timezone.utc)
+
+
+def _runs(starts, size):
+    """
+    Merges sorted bucket starts into ``(start, end)`` ranges of adjacent buckets.
+    """
+    runs = []
+    for start in starts:
+        if runs and runs[-1][1] == start:
+            runs[-1][1] = start + size
+        else:
+            runs.append([start, start + size])
+    return runs
+
+
+def rebuild_buckets(merchant_id, period, starts, since=None):
+    """
+    Recomputes the merchant's ``period`` buckets beginning at ``starts`` from the log.
+    Buckets starting before ``since``, whose rows may be detached, are left alone.
+    """
+    size = PERIODS[period][1]
+    if since is not None:
+        starts = [start for start in starts if start >= since]
+    if not starts:
+        return
+    ranges = Q()
+    for start, end in _runs(sorted(starts), size):
+        ranges |= Q(created_time__gte=start, created_time__lt=end)
+    rows = (
+        TransactionLog.objects.filter(
+            ranges, merchant_id=merchant_id, is_transfer=False
+        )
+        .annotate(bucket=_trunc(period))
+        .values("bucket")
+        .annotate(
+            transactions=Count("id"),
+            credit=Sum("amount", filter=Q(amount__gt=0), default=0),
+            debit=Sum("amount", filter=Q(amount__lt=0), default=0),
+            phones=Count("phone", distinct=True),
+        )
+    )
+    TransactionRollup.objects.bulk_create(
+        [
+            TransactionRollup(
+                merchant_id=merchant_id,
+                period=period,
+                start=row["bucket"],
+                count=row["transactions"],
+                credit=row["credit"],
+                debit=-row["debit"],
+                phones=row["phones"],
+            )
+            for row in rows
+        ],
+        update_conflicts=True,
+        unique_fields=["merchant", "period", "start"],
+        update_fields=["count", "credit", "debit", "phones", "updated_time"],
+    )
+
+
+def run_rollups(safety_lag=None, batch_size=None, rebuild=False):
+    """
+    Brings the rollups up to date with the settled log rows, ``batch_size`` rows per
+    transaction, and returns ``{log_rows, buckets, last_log_id}``. ``rebuild=True``
+    drops the rollups and starts again from the first row.
+
+    Each shard has its own checkpoint. With several shards ``last_log_id`` maps each
+    shard to its checkpoint, and the other counts are summed.
+    """
+    aliases = shard_aliases()
+    reports = {}
+    for alias in aliases:
+        with using_shard(alias):
+            reports[alias] = _run_rollups(alias, safety_lag, batch_size, rebuild)
+    if len(aliases) == 1:
+        return reports[aliases[0]]
+    return {
+        "log_rows": sum(report["log_rows"] for report in reports.values()),
+        "buckets": sum(report["buckets"] for report in reports.values()),
+        "last_log_id": {
+            alias: report["last_log_id"] for alias, report in reports.items()
+        },
+    }
+
+
+def _run_rollups(using, safety_lag, batch_size, rebuild):
+    if safety_lag is None:
+        safety_lag = settings.B2B_CHARGE_ROLLUP_SAFETY_LAG
+    batch_size = batch_size or settings.B2B_CHARGE_ROLLUP_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(seconds=safety_lag)
+    since = retained_since(connections[using])
+    report = {"log_rows": 0, "buckets": 0, "last_log_id": None}
+    LogCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    if rebuild:
+        with atomic(using=using):
+            LogCheckpoint.objects.select_for_update().filter(name=CHECKPOINT).update(
+                last_log_id=0
+            )
+            rollups = TransactionRollup.objects.all()
+            if since is not None:
+                rollups = rollups.filter(start__gte=since)
+            rollups.delete()
+
+    while True:
+        with atomic(using=using):
+            # The row lock keeps concurrent runs from processing the same rows.
+            checkpoint = LogCheckpoint.objects.select_for_update().get(name=CHECKPOINT)
+            logs = TransactionLog.objects.filter(id__gt=checkpoint.last_log_id)
+            batch_end = (
+                logs.order_by("id")
+                .values_list("id", flat=True)[batch_size - 1 : batch_size]
+                .first()
+            )
+            if batch_end is not None:
+                logs = logs.filter(id__lte=batch_end)
+            last_id = logs.aggregate(
+                last_id=Max("id", filter=Q(created_time__lte=cutoff))
+            )["last_id"]
+            report["last_log_id"] = checkpoint.last_log_id
+            if last_id is None:
+                return report
+
+            # Younger rows below the last settled one are included, their buckets are
+            # rebuilt again when later rows touch them.
+            logs = logs.filter(id__lte=last_id)
+            new = logs.filter(is_transfer=False)
+            for period in PERIODS:
+                touched = {}
+                for merchant_id, start in (
+                    new.annotate(bucket=_trunc(period))
+                    .values_list("merchant_id", "bucket")
+                    .distinct()
+                ):
+                    touched.setdefault(merchant_id, []).append(start)
+                for merchant_id, starts in touched.items():
+                    rebuild_buckets(merchant_id, period, starts, since)
+                    report["buckets"] += len(starts)
+
+            checkpoint.last_log_id = last_id
+            checkpoint.save(update_fields=["last_log_id", "updated_time"])
+            report["log_rows"] += logs.count()
+            report["last_log_id"] = last_id
+            if last_id != batch_end:
+                return report
@@ -0,0 +1,148 @@
+"""
+Database routing between the primary and the read replicas.
+
+Every query goes to the primary (``default``) unless it runs inside ``replica_reads()``,
+which the read-only endpoints use: listings, history, exports, stats and get-credit.
+There, reads are spread over ``B2B_CHARGE_READ_REPLICAS`` at random, until the first
+write. A write pins the rest of the block to the primary, so the code reads its own
+writes, and so does a transaction open on the primary. Writes, and every read of the
+charge paths, stay on the primary.
+
+Replicas lag behind the primary, so a read-only endpoint may return data that is a
+little stale. Credits read from a replica are not put in the balance cache.
+
+With sharding (see ``sharding``) the router also picks the shard: every query goes to
+the shard of the merchant the code runs for, and the replicas only serve the first one.
+"""
+
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+from .sharding import current_shard
+
+# Models kept in the default database only: the shard directory, the offsets of the
+# event consumers and the velocity rules.
+GLOBAL_MODELS = ("shardplacement", "consumeroffset", "velocityrule")
+
+_state = ContextVar("b2b_charge_replica_reads", default=None)
+
+
+class _ReadState:
+    __slots__ = ("pinned",)
+
+    def __init__(self):
+        self.pinned = False
+
+
+@contextmanager
+def replica_reads():
+    """
+    Lets the reads of the block go to the replicas until the block writes. Also works
+    as a decorator.
+    """
+    token = _state.set(_ReadState())
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+def read_alias():
+    """
+    Returns the alias a read would use here. Querysets consumed after the block ends,
+    like streamed exports, are bound to it with ``using()``.
+    """
+    shard = current_shard()
+    if shard != DEFAULT_DB_ALIAS:
+        # The replicas are copies of the first shard only.
+        return shard
+    state = _state.get()
+    replicas = settings.B2B_CHARGE_READ_REPLICAS
+    if state is None or state.pinned or not replicas:
+        return DEFAULT_DB_ALIAS
+    # Reads inside a transaction on the primary must see its writes.
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+def _instance_shard(hints):
+    """
+    Returns the shard an instance was loaded from, so that its related rows and its
+    saves stay there.
+    """
+    instance = hints.get("instance")
+    if instance is None or not settings.B2B_CHARGE_SHARDS:
+        return None
+    if instance._state.db in settings.B2B_CHARGE_SHARDS:
+        return instance._state.db
+    return None
+
+
+class ReplicaRouter:
+    """
+    Sends reads inside ``replica_reads()`` to a replica and everything else to the
+    primary, of the current shard.
+    """
+
+    def __init__(self):
+        # Reads routed to each alias, counted by each thread of this process so that
+        # routing a read takes no lock. The lock only guards registering a thread.
+        self._local = threading.local()
+        self._counters = []
+        self._lock = threading.Lock()
+
+    def _thread_reads(self):
+        reads = getattr(self._local, "reads", None)
+        if reads is None:
+            reads = self._local.reads = Counter()
+            with self._lock:
+                self._counters.append(reads)
+        return reads
+
+    def db_for_read(self, model, **hints):
+        alias = _instance_shard(hints) or read_alias()
+        self._thread_reads()[alias] += 1
+        return alias
+
+    def read_counts(self):
+        with self._lock:
+            counters = list(self._counters)
+        counts = Counter()
+        for reads in counters:
+            counts.update(dict(reads))
+        return dict(counts)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = True
+        return _instance_shard(hints) or current_shard()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.B2B_CHARGE_READ_REPLICAS:
+            return False
+        if model_name in GLOBAL_MODELS:
+            return db == DEFAULT_DB_ALIAS
+        return None
+
+
+def read_counts():
+    """
+    Returns the reads routed to each alias by this process.
+    """
+    counts = Counter()
+    for instance in router.routers:
+        if isinstance(instance, ReplicaRouter):
+            counts.update(instance.read_counts())
+    return counts
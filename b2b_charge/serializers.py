@@ -1,21 +1,176 @@
+import re
+
+from django.conf import settings
 from rest_framework import serializers
-from .models import Merchant, TransactionLog
+from .models import Merchant, TransactionLog, TransactionRollup
+from .exports import EXPORT_FORMATS
 
 
 class MerchantSerializer(serializers.ModelSerializer):
     class Meta:
         model = Merchant
-        exclude = ("created_time", "updated_time", "is_active")
+        exclude = (
+            "created_time",
+            "updated_time",
+            "is_active",
+            "balance_shards",
+            "rate_limit",
+            "rate_burst",
+            "held_credit",
+            "version",
+        )
 
-class BuyChargeSerializer(serializers.ModelSerializer):
-    phone = serializers.CharField()
-    amount = serializers.IntegerField()
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.is_sharded:
+            data["credit"] = instance.get_credit()
+        return data
+
+
+# The hot endpoints validate their few fields by hand: building and running a
+# serializer costs more CPU than the rest of the request outside the database.
+# The errors have the same shape and messages as DRF's IntegerField.
+INTEGER_SUFFIX = re.compile(r"\.0*\s*$")
+
+
+def _integer(data, field, errors):
+    try:
+        value = data[field]
+    except (KeyError, TypeError):
+        errors[field] = ["This field is required."]
+        return None
+    if type(value) is int:
+        return value
+    if isinstance(value, str) and len(value) <= 1000:
+        try:
+            return int(INTEGER_SUFFIX.sub("", value))
+        except ValueError:
+            pass
+    elif isinstance(value, float) and value.is_integer():
+        return int(value)
+    errors[field] = ["A valid integer is required."]
+    return None
+
+
+def validate_credit(data):
+    """
+    Validates an <add-credit> body and returns the credit as an int.
+    """
+    errors = {}
+    credit = _integer(data, "credit", errors)
+    if errors:
+        raise serializers.ValidationError(errors)
+    return credit
+
+
+def _charge(data, errors):
+    phone = _integer(data, "phone", errors)
+    amount = _integer(data, "amount", errors)
+    if phone is not None and phone < 0:
+        errors["phone"] = ["Ensure this value is greater than or equal to 0."]
+    if amount is not None and amount <= 0:
+        errors["amount"] = ["Ensure this value is greater than or equal to 1."]
+    return phone, amount
+
+
+def validate_charge(data):
+    """
+    Validates a <buy-charge> body and returns ``(phone, amount)`` as ints.
+    """
+    errors = {}
+    phone, amount = _charge(data, errors)
+    if errors:
+        raise serializers.ValidationError(errors)
+    return phone, amount
+
+
+def validate_reserve(data):
+    """
+    Validates a <reserve> body and returns ``(phone, amount, ttl)``, ttl being None when
+    it is not given.
+    """
+    errors = {}
+    phone, amount = _charge(data, errors)
+    ttl = None
+    if data is not None and "ttl" in data:
+        ttl = _integer(data, "ttl", errors)
+        if ttl is not None and not 0 < ttl <= settings.B2B_CHARGE_HOLD_MAX_TTL:
+            errors["ttl"] = [
+                "Ensure this value is between 1 and %d."
+                % settings.B2B_CHARGE_HOLD_MAX_TTL
+            ]
+    if errors:
+        raise serializers.ValidationError(errors)
+    return phone, amount, ttl
+
+
+class BuyChargeBatchSerializer(serializers.Serializer):
+    items = serializers.ListField(
+        child=serializers.DictField(),
+        allow_empty=False,
+        max_length=settings.B2B_CHARGE_MAX_BATCH_ITEMS,
+    )
+
+    @staticmethod
+    def parse_item(item):
+        """
+        Validates a single ``{phone, amount}`` item like <buy-charge> and returns
+        ``(phone, amount)`` as ints. Raises ValueError with a readable message when the
+        item is invalid.
+        """
+        errors = {}
+        phone, amount = _charge(item, errors)
+        if errors:
+            raise ValueError(
+                " ".join(
+                    "%s: %s" % (field, messages[0])
+                    for field, messages in errors.items()
+                )
+            )
+        return phone, amount
+
+
+class BulkCreateMerchantSerializer(serializers.Serializer):
+    merchants = serializers.ListField(
+        child=serializers.DictField(),
+        allow_empty=False,
+        max_length=settings.B2B_CHARGE_MAX_BULK_ROWS,
+    )
+
+
+class BulkTopUpSerializer(serializers.Serializer):
+    items = serializers.ListField(
+        child=serializers.DictField(),
+        allow_empty=False,
+        max_length=settings.B2B_CHARGE_MAX_BULK_ROWS,
+    )
 
-    class Meta:
-        model = Merchant
-        exclude = ("created_time", "updated_time", "is_active")
 
 class TransactionLogSerializer(serializers.ModelSerializer):
     class Meta:
         model = TransactionLog
-        exclude = ("created_time", "updated_time", "is_active")
\ No newline at end of file
+        fields = ("id", "merchant", "phone", "amount", "balance_after", "created_time")
+
+
+class TransactionLogFilterSerializer(serializers.Serializer):
+    phone = serializers.IntegerField(required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+
+class TransactionLogExportSerializer(TransactionLogFilterSerializer):
+    output = serializers.ChoiceField(choices=sorted(EXPORT_FORMATS), default="csv")
+
+
+class TransactionRollupFilterSerializer(serializers.Serializer):
+    period = serializers.ChoiceField(
+        choices=TransactionRollup.PERIODS, default=TransactionRollup.DAY
+    )
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+
+class TransactionRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TransactionRollup
+        fields = ("start", "count", "credit", "debit", "phones")
@@ -0,0 +1,544 @@
+"""
+Horizontal sharding of merchants over several databases.
+
+Sharding is opt-in: ``B2B_CHARGE_SHARDS`` lists the database aliases, and when it is
+empty everything lives in ``default``. A merchant and every row that belongs to it (its
+logs, balance shards, holds, snapshots, rollups and idempotency keys) live on one shard.
+Only the ``ShardPlacement`` directory is global, and it lives in ``default``.
+
+Merchant ids are globally unique 63-bit ids, so that they fit a signed bigint, made of
+the milliseconds since ``EPOCH`` (40 bits, which last until 2058), the index of the
+merchant's home shard in ``B2B_CHARGE_SHARDS`` (13 bits) and a sequence number (10
+bits). The sequence comes from the home shard's own id sequence on PostgreSQL, so ids
+made by different processes never collide. Ids below ``1 << 23`` were handed out before
+sharding and belong to the first shard. A merchant that has been moved away from its
+home shard has a ``ShardPlacement`` row.
+
+Code that touches a merchant runs inside ``merchant_shard(merchant_id)``, and
+``ReplicaRouter`` sends its queries to the merchant's shard. The viewset, the async
+views, the commands and the model methods that open transactions do this themselves.
+Queries that are not about one merchant, like the merchant listing and reconciliation,
+run on every shard in parallel with ``fan_out`` and merge the results.
+
+``move_merchant`` moves a merchant to another shard while it keeps serving. The logs
+are copied first, while the merchant still takes writes. Then the merchant is marked as
+moving in the directory, and writes to it are refused until the end of the move. That
+lasts ``B2B_CHARGE_SHARD_MAP_TTL`` seconds, long enough for every process to see the
+mark, plus the time it takes to copy what was written meanwhile. Last, the directory
+points to the new shard and the old copy is deleted.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .cache import LRUCache
+
+# 2024-01-01 UTC, in milliseconds.
+EPOCH = 1704067200000
+TIMESTAMP_BITS = 40
+SHARD_BITS = 13
+SEQUENCE_BITS = 10
+# Ids below this were handed out by the id sequence before sharding.
+FIRST_SHARDED_ID = 1 << (SHARD_BITS + SEQUENCE_BITS)
+MAP_CACHE_SIZE = 100000
+
+_shard = ContextVar("b2b_charge_shard", default=None)
+_local_sequence = itertools.count()
+
+
+def shard_aliases():
+    """
+    Returns the database aliases of the shards, ``["default"]`` without sharding.
+    """
+    return settings.B2B_CHARGE_SHARDS or [DEFAULT_DB_ALIAS]
+
+
+def current_shard():
+    """
+    Returns the alias of the shard the current code runs on.
+    """
+    return _shard.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def using_shard(alias):
+    """
+    Sends the queries of the block to the ``alias`` shard.
+    """
+    token = _shard.set(alias)
+    try:
+        yield alias
+    finally:
+        _shard.reset(token)
+
+
+@contextmanager
+def merchant_shard(merchant_id):
+    """
+    Sends the queries of the block to the merchant's shard. Ids that are not integers
+    leave the routing as it is, so that the code inside can answer 404.
+    """
+    try:
+        merchant_id = int(merchant_id)
+    except (TypeError, ValueError):
+        yield current_shard()
+        return
+    with using_shard(shard_map.alias_for(merchant_id)) as alias:
+        yield alias
+
+
+def merchant_atomic(method):
+    """
+    Like ``atomic``, for methods of a merchant or of one of its rows: the transaction
+    runs on the merchant's shard, and writes are refused while the merchant moves.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        merchant_id = getattr(self, "merchant_id", self.pk)
+        shard_map.check_writable(merchant_id)
+        with merchant_shard(merchant_id) as alias, atomic(using=alias):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def make_id(shard, sequence, milliseconds=None):
+    if milliseconds is None:
+        milliseconds = int(time.time() * 1000)
+    if not 0 <= milliseconds - EPOCH < 1 << TIMESTAMP_BITS:
+        raise Exception(
+            "make_id: Timestamp out of the id range. milliseconds: %d" % (milliseconds)
+        )
+    return (
+        ((milliseconds - EPOCH) << (SHARD_BITS + SEQUENCE_BITS))
+        | (shard << SEQUENCE_BITS)
+        | (sequence % (1 << SEQUENCE_BITS))
+    )
+
+
+def home_shard(merchant_id):
+    """
+    Returns the index of the shard encoded in a merchant id.
+    """
+    if merchant_id < FIRST_SHARDED_ID:
+        return 0
+    return (merchant_id >> SEQUENCE_BITS) & ((1 << SHARD_BITS) - 1)
+
+
+def new_merchant_ids(alias, count):
+    """
+    Returns ``count`` new ids for merchants placed on the ``alias`` shard, or Nones,
+    which leave the ids to the database, without sharding.
+    """
+    if not settings.B2B_CHARGE_SHARDS:
+        return [None] * count
+    from .models import Merchant
+
+    shard = settings.B2B_CHARGE_SHARDS.index(alias)
+    connection = connections[alias]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id'))"
+                " FROM generate_series(1, %s)",
+                [Merchant._meta.db_table, count],
+            )
+            sequences = [row[0] for row in cursor.fetchall()]
+    else:
+        # Only unique within the process, which is enough for development databases.
+        sequences = [next(_local_sequence) for _ in range(count)]
+    milliseconds = int(time.time() * 1000)
+    ids = [make_id(shard, sequence, milliseconds) for sequence in sequences]
+    if len(set(ids)) < count:
+        # More than one sequence cycle within the millisecond.
+        time.sleep(0.001)
+        return new_merchant_ids(alias, count)
+    return ids
+
+
+class ShardMap:
+    """
+    Maps merchant ids to the aliases of their shards. Directory lookups are cached for
+    ``B2B_CHARGE_SHARD_MAP_TTL`` seconds.
+    """
+
+    def __init__(self):
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def _placements(self):
+        ttl = settings.B2B_CHARGE_SHARD_MAP_TTL
+        if self._cache is None or self._cache.ttl != ttl:
+            with self._lock:
+                if self._cache is None or self._cache.ttl != ttl:
+                    self._cache = LRUCache(max_size=MAP_CACHE_SIZE, ttl=ttl)
+        return self._cache
+
+    def placement(self, merchant_id):
+        """
+        Returns the merchant's ``(alias, moving)``.
+        """
+        aliases = settings.B2B_CHARGE_SHARDS
+        if not aliases:
+            return DEFAULT_DB_ALIAS, False
+        cache = self._placements()
+        placement = cache.get(merchant_id)
+        if placement is None:
+            from .models import ShardPlacement
+
+            placement = (
+                ShardPlacement.objects.using(DEFAULT_DB_ALIAS)
+                .filter(merchant_id=merchant_id)
+                .values_list("alias", "moving")
+                .first()
+            )
+            if placement is None:
+                shard = home_shard(merchant_id)
+                alias = aliases[shard] if shard < len(aliases) else DEFAULT_DB_ALIAS
+                placement = (alias, False)
+            cache.set(merchant_id, placement)
+        return placement
+
+    def alias_for(self, merchant_id):
+        return self.placement(merchant_id)[0]
+
+    def check_writable(self, merchant_id):
+        if self.placement(merchant_id)[1]:
+            raise Exception(
+                "Merchant is being moved to another shard. Retry later. merchant_id: %d"
+                % (merchant_id)
+            )
+
+    def pick(self):
+        """
+        Returns the alias of the shard a new merchant is placed on: the one of the
+        ``using_shard()`` block, or a random one.
+        """
+        return _shard.get() or random.choice(shard_aliases())
+
+    def forget(self, merchant_id):
+        if self._cache is not None:
+            self._cache.delete(merchant_id)
+
+    def clear(self):
+        if self._cache is not None:
+            self._cache.clear()
+
+
+shard_map = ShardMap()
+
+
+def _on_shard(alias, func, args):
+    try:
+        with using_shard(alias):
+            return func(*args)
+    finally:
+        # The threads only live for one fan-out.
+        connections.close_all()
+
+
+def fan_out(func, *args):
+    """
+    Runs ``func(*args)`` on every shard, on one thread per shard, and returns the
+    results in the order of the shards. Without sharding it runs in the calling thread.
+    """
+    aliases = shard_aliases()
+    if len(aliases) == 1:
+        with using_shard(aliases[0]):
+            return [func(*args)]
+    with ThreadPoolExecutor(
+        max_workers=len(aliases), thread_name_prefix="b2b-charge-shard"
+    ) as executor:
+        # Each call runs in a copy of the caller's context, so that replica reads and
+        # request metrics follow it.
+        futures = [
+            executor.submit(copy_context().run, _on_shard, alias, func, args)
+            for alias in aliases
+        ]
+        return [future.result() for future in futures]
+
+
+def fetch_sharded(queryset, limit, key):
+    """
+    Returns the first ``limit`` rows of an ordered queryset over all the shards. Each
+    shard returns its first ``limit`` rows, which are merged by ``key`` (descending).
+    """
+    if len(shard_aliases()) == 1:
+        return list(queryset[:limit])
+    results = fan_out(lambda: list(queryset.all()[:limit]))
+    return list(itertools.islice(heapq.merge(*results, key=key, reverse=True), limit))
+
+
+def _columns(model):
+    return [field for field in model._meta.concrete_fields if not field.primary_key]
+
+
+def _copy_rows(model, rows, target, fields=None):
+    """
+    Inserts ``rows`` (tuples of the ``fields`` values) into ``model``'s table on the
+    target shard, with new ids. Timestamps are copied as they are.
+    """
+    if not rows:
+        return
+    fields = fields or _columns(model)
+    connection = connections[target]
+    quote = connection.ops.quote_name
+    sql = "INSERT INTO {table} ({columns}) VALUES ({values})".format(
+        table=quote(model._meta.db_table),
+        columns=", ".join(quote(field.column) for field in fields),
+        values=", ".join(["%s"] * len(fields)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            sql,
+            [
+                [
+                    field.get_db_prep_save(value, connection)
+                    for field, value in zip(fields, row)
+                ]
+                for row in rows
+            ],
+        )
+
+
+def _copy_logs(merchant_id, source, target, after_id, batch_size):
+    """
+    Copies the merchant's log rows with ids above ``after_id``, in id order, and returns
+    the id of the last one copied.
+    """
+    from .models import TransactionLog
+
+    fields = _columns(TransactionLog)
+    while True:
+        rows = list(
+            TransactionLog.objects.using(source)
+            .filter(merchant_id=merchant_id, id__gt=after_id)
+            .order_by("id")
+            .values_list("id", *[field.attname for field in fields])[:batch_size]
+        )
+        if not rows:
+            return after_id
+        with atomic(using=target):
+            _copy_rows(TransactionLog, [row[1:] for row in rows], target, fields)
+        after_id = rows[-1][0]
+
+
+def purge_merchant(merchant_id, alias, batch_size=None):
+    """
+    Deletes the merchant and all of its rows from the ``alias`` shard, ``batch_size``
+    rows per statement.
+    """
+    from .models import Merchant
+
+    batch_size = batch_size or settings.B2B_CHARGE_LOG_FLUSH_BATCH_SIZE
+    deleted = 0
+    for relation in Merchant._meta.related_objects:
+        rows = relation.related_model.objects.using(alias).filter(
+            **{relation.field.name: merchant_id}
+        )
+        while True:
+            ids = list(rows.values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted += rows.filter(pk__in=ids).delete()[0]
+    return deleted + Merchant.objects.using(alias).filter(id=merchant_id).delete()[0]
+
+
+def _set_placement(merchant_id, alias, moving):
+    from .models import ShardPlacement
+
+    ShardPlacement.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        merchant_id=merchant_id, defaults={"alias": alias, "moving": moving}
+    )
+    shard_map.forget(merchant_id)
+
+
+def _finish_move(merchant_id, source, target, copied_id, batch_size):
+    """
+    Copies what the merchant wrote since the bulk copy and switches it to the target
+    shard. Runs while writes to the merchant are refused.
+    """
+    from .models import (
+        BalanceSnapshot,
+        CreditHold,
+        Merchant,
+        PendingTransactionLog,
+        TransactionLog,
+    )
+    from .partitioning import retained_since
+    from .rollups import PERIODS, _trunc, rebuild_buckets
+
+    # Committed on the target before the source, so a failure in between leaves the
+    # merchant on the source, with an unused copy that the next move deletes.
+    with atomic(using=source), atomic(using=target):
+        # Waits for the transactions that started before the merchant was marked.
+        merchant = (
+            Merchant.objects.using(source).select_for_update().get(id=merchant_id)
+        )
+        if (
+            CreditHold.objects.using(source)
+            .filter(merchant_id=merchant_id, status=CreditHold.HELD)
+            .exists()
+        ):
+            raise Exception(
+                "move_merchant: Merchant has open credit holds. merchant_id: %d"
+                % (merchant_id)
+            )
+        _copy_logs(merchant_id, source, target, copied_id, batch_size)
+        pending = [
+            field
+            for field in _columns(TransactionLog)
+            if field.attname in PendingTransactionLog.LOG_FIELDS
+        ]
+        now = timezone.now()
+        _copy_rows(
+            TransactionLog,
+            [
+                row + (now,)
+                for row in PendingTransactionLog.objects.using(source)
+                .filter(merchant_id=merchant_id)
+                .order_by("id")
+                .values_list(*[field.attname for field in pending])
+            ],
+            target,
+            pending + [TransactionLog._meta.get_field("updated_time")],
+        )
+        # Snapshots point at log ids of the source, the next reconciliation of the
+        # merchant sums its whole log instead.
+        skipped = {TransactionLog, PendingTransactionLog, BalanceSnapshot}
+        for relation in Merchant._meta.related_objects:
+            model = relation.related_model
+            if model in skipped:
+                continue
+            fields = _columns(model)
+            _copy_rows(
+                model,
+                list(
+                    model.objects.using(source)
+                    .filter(**{relation.field.name: merchant_id})
+                    .order_by("pk")
+                    .values_list(*[field.attname for field in fields])
+                ),
+                target,
+                fields,
+            )
+        Merchant.objects.using(target).filter(id=merchant_id).update(
+            credit=merchant.credit,
+            held_credit=merchant.held_credit,
+            version=merchant.version,
+            is_active=merchant.is_active,
+            balance_shards=merchant.balance_shards,
+            rate_limit=merchant.rate_limit,
+            rate_burst=merchant.rate_burst,
+            updated_time=merchant.updated_time,
+        )
+        # The rollups of the buckets the copied rows fall in are rebuilt from them, as
+        # the rollup job of the target has not seen most of them.
+        with using_shard(target):
+            copied = TransactionLog.objects.filter(
+                merchant_id=merchant_id, is_transfer=False
+            )
+            since = retained_since(connections[target])
+            for period in PERIODS:
+                starts = list(
+                    copied.annotate(bucket=_trunc(period))
+                    .values_list("bucket", flat=True)
+                    .distinct()
+                )
+                rebuild_buckets(merchant_id, period, starts, since)
+        # The old copy drops out of the merchant listing until it is deleted.
+        Merchant.objects.using(source).filter(id=merchant_id).update(is_active=False)
+
+
+def move_merchant(merchant_id, target, batch_size=None):
+    """
+    Moves the merchant to the ``target`` shard while it keeps serving, and returns a
+    report. Merchants with open credit holds cannot move, as the holds' ids would
+    change.
+    """
+    from .models import Merchant, ShardPlacement, TransactionLog
+
+    batch_size = batch_size or settings.B2B_CHARGE_LOG_FLUSH_BATCH_SIZE
+    if target not in settings.B2B_CHARGE_SHARDS:
+        raise Exception("move_merchant: %s is not a shard." % (target))
+    shard_map.forget(merchant_id)
+    source, moving = shard_map.placement(merchant_id)
+    if moving:
+        raise Exception(
+            "move_merchant: Merchant is already moving. merchant_id: %d" % (merchant_id)
+        )
+    if source == target:
+        raise Exception(
+            "move_merchant: Merchant is already on %s. merchant_id: %d"
+            % (target, merchant_id)
+        )
+    started = time.perf_counter()
+    placed = (
+        ShardPlacement.objects.using(DEFAULT_DB_ALIAS)
+        .filter(merchant_id=merchant_id)
+        .first()
+    )
+
+    # A copy left by a move that failed halfway.
+    purge_merchant(merchant_id, target, batch_size)
+    fields = Merchant._meta.concrete_fields
+    row = list(
+        Merchant.objects.using(source)
+        .filter(id=merchant_id)
+        .values_list(*[field.attname for field in fields])
+    )
+    if not row:
+        raise Exception(
+            "move_merchant: Merchant does not exist. merchant_id: %d" % (merchant_id)
+        )
+    with atomic(using=target):
+        # Inactive and empty until the move finishes.
+        placeholder = dict(zip([field.attname for field in fields], row[0]))
+        placeholder.update(
+            credit=0, held_credit=0, version=0, balance_shards=1, is_active=False
+        )
+        _copy_rows(
+            Merchant, [[placeholder[field.attname] for field in fields]], target, fields
+        )
+    copied_id = _copy_logs(merchant_id, source, target, 0, batch_size)
+
+    _set_placement(merchant_id, source, True)
+    try:
+        # Every process has seen the mark once their cached placements expire.
+        time.sleep(settings.B2B_CHARGE_SHARD_MAP_TTL)
+        _finish_move(merchant_id, source, target, copied_id, batch_size)
+    except BaseException:
+        if placed is None:
+            ShardPlacement.objects.using(DEFAULT_DB_ALIAS).filter(
+                merchant_id=merchant_id
+            ).delete()
+            shard_map.forget(merchant_id)
+        else:
+            _set_placement(merchant_id, placed.alias, placed.moving)
+        raise
+    # The version moves along with the credit, so cached credits stay valid.
+    _set_placement(merchant_id, target, False)
+    deleted = purge_merchant(merchant_id, source, batch_size)
+    return {
+        "merchant_id": merchant_id,
+        "source": source,
+        "target": target,
+        "logs": TransactionLog.objects.using(target)
+        .filter(merchant_id=merchant_id)
+        .count(),
+        "deleted_rows": deleted,
+        "elapsed_s": time.perf_counter() - started,
+    }
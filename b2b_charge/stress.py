@@ -0,0 +1,280 @@
+"""
+Concurrency stress harness for merchant transactions.
+
+Many threads (and optionally forked processes) hammer a few merchants with add and
+subtract operations through one locking strategy at a time. Each worker tallies what it
+was told succeeded, and afterwards the tallies are checked against the database:
+
+* the credit never went negative,
+* the credit equals the sum of the merchant's logs,
+* the credit equals the initial credit plus the acknowledged adds minus the acknowledged
+  charges (a lost update breaks this one even when the logs agree with the credit),
+* the number of acknowledged charges and adds equals the number of their logs,
+* for sharded merchants, every shard is >= 0 and equals the sum of its logs.
+
+Merchants start with little credit so that many charges are rejected and the overdraft
+checks are actually exercised.
+"""
+
+import multiprocessing
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+
+from django.db import connection, connections
+from django.db.models import Count, Q, Sum
+from django.db.transaction import atomic
+
+from .benchmark import setup_merchants
+from .combiner import charge_combiner
+from .models import Merchant, MerchantBalanceShard, TransactionLog
+from .outbox import flush_pending_logs
+
+
+@dataclass
+class StressConfig:
+    operations: int = 5000
+    threads: int = 16
+    processes: int = 1
+    merchants: int = 1
+    initial_credit: int = 100000
+    # Share of the operations that add credit, the rest buy charge.
+    add_ratio: float = 0.2
+    # Shards per merchant for the sharded_balances strategy.
+    balance_shards: int = 8
+    seed: int = 0
+
+
+def _conditional_update(merchant, action, phone, amount):
+    return merchant.transaction(action=action, phone=phone, amount=amount)
+
+
+@atomic
+def _select_for_update(merchant, action, phone, amount):
+    """
+    The pessimistic alternative: lock the row, check the credit in Python, write it back.
+    """
+    locked = Merchant.objects.select_for_update().get(id=merchant.id)
+    if action == "subtract_credit":
+        if locked.credit < amount:
+            raise Exception(
+                "subtract_credit: Negative Credits happened. Cannot Continue. merchant_id: %d"
+                % (merchant.id)
+            )
+        amount = -amount
+    else:
+        phone = None
+    locked.credit += amount
+    locked.version += 1
+    locked.save(update_fields=["credit", "version", "updated_time"])
+    TransactionLog(
+        merchant_id=merchant.id,
+        phone=phone,
+        amount=amount,
+        balance_after=locked.credit + locked.held_credit,
+    ).log()
+    locked.publish_credit(locked.version)
+    return locked.credit
+
+
+def _write_combining(merchant, action, phone, amount):
+    if action == "subtract_credit":
+        return charge_combiner.charge(merchant, phone, amount)
+    return merchant.transaction(action=action, phone=phone, amount=amount)
+
+
+STRATEGIES = {
+    "conditional_update": _conditional_update,
+    "select_for_update": _select_for_update,
+    "write_combining": _write_combining,
+    # Merchant.transaction on merchants whose credit is split into balance shards.
+    "sharded_balances": _conditional_update,
+}
+
+
+def _worker(strategy, config, merchant_ids, count, seed):
+    """
+    Runs ``count`` operations and returns a Counter keyed by ``(merchant_id, outcome)``
+    plus the acknowledged amounts.
+    """
+    execute = STRATEGIES[strategy]
+    rng = random.Random(seed)
+    merchants = {
+        merchant.id: merchant
+        for merchant in Merchant.objects.filter(id__in=merchant_ids)
+    }
+    tally = Counter()
+    for _ in range(count):
+        merchant_id = rng.choice(merchant_ids)
+        if rng.random() < config.add_ratio:
+            action = "add_credit"
+            amount = rng.choice([1000, 5000, 10000])
+        else:
+            action = "subtract_credit"
+            amount = rng.choice([1000, 2000, 5000, 10000, 20000])
+        phone = rng.randint(9000000000, 9999999999)
+        try:
+            execute(merchants[merchant_id], action, phone, amount)
+        except Exception as e:
+            outcome = "rejected" if "Negative Credits" in str(e) else "errors"
+            tally[(merchant_id, outcome)] += 1
+            continue
+        tally[(merchant_id, action)] += 1
+        tally[(merchant_id, action + "_amount")] += amount
+    if threading.current_thread() is not threading.main_thread():
+        connection.close()
+    return tally
+
+
+def _run_threads(args):
+    strategy, config, merchant_ids, count, seed = args
+    if config.threads == 1:
+        return _worker(strategy, config, merchant_ids, count, seed)
+    tallies = [None] * config.threads
+    share, extra = divmod(count, config.threads)
+
+    def run(index):
+        tallies[index] = _worker(
+            strategy,
+            config,
+            merchant_ids,
+            share + (index < extra),
+            seed * 1000 + index,
+        )
+
+    threads = [
+        threading.Thread(target=run, args=(index,)) for index in range(config.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(tallies, Counter())
+
+
+def check_invariants(config, merchant_ids, tally):
+    """
+    Returns the violated invariants, one dict per merchant and invariant.
+    """
+    flush_pending_logs()
+    logs = {
+        row["merchant_id"]: row
+        for row in TransactionLog.objects.filter(merchant_id__in=merchant_ids)
+        .values("merchant_id")
+        .annotate(
+            total=Sum("amount"),
+            charges=Count("id", filter=Q(amount__lt=0, is_transfer=False)),
+            # The initial funding is a logged add as well.
+            adds=Count("id", filter=Q(amount__gt=0, is_transfer=False)) - 1,
+        )
+    }
+    violations = []
+
+    def check(merchant_id, name, expected, actual):
+        if expected != actual:
+            violations.append(
+                {
+                    "merchant_id": merchant_id,
+                    "invariant": name,
+                    "expected": expected,
+                    "actual": actual,
+                }
+            )
+
+    for merchant in Merchant.objects.filter(id__in=merchant_ids):
+        row = logs[merchant.id]
+        credit = merchant.get_ledger_credit()
+        expected_credit = (
+            config.initial_credit
+            + tally[(merchant.id, "add_credit_amount")]
+            - tally[(merchant.id, "subtract_credit_amount")]
+        )
+        if credit < 0:
+            check(merchant.id, "credit >= 0", 0, credit)
+        check(merchant.id, "credit == sum(logs)", credit, row["total"])
+        check(merchant.id, "no lost updates", expected_credit, credit)
+        check(
+            merchant.id,
+            "charges == charge logs",
+            tally[(merchant.id, "subtract_credit")],
+            row["charges"],
+        )
+        check(
+            merchant.id,
+            "adds == add logs",
+            tally[(merchant.id, "add_credit")],
+            row["adds"],
+        )
+    for shard in MerchantBalanceShard.objects.filter(merchant_id__in=merchant_ids):
+        if shard.credit < 0:
+            check(shard.merchant_id, "shard %d >= 0" % shard.number, 0, shard.credit)
+        check(
+            shard.merchant_id,
+            "shard %d == sum(shard logs)" % shard.number,
+            shard.credit,
+            TransactionLog.objects.filter(
+                merchant_id=shard.merchant_id, shard=shard.number
+            ).aggregate(Sum("amount"))["amount__sum"],
+        )
+    return violations
+
+
+def run_stress(strategy, config):
+    """
+    Stresses one strategy on fresh merchants and returns its report.
+    """
+    merchant_ids = setup_merchants(config)
+    if strategy == "sharded_balances":
+        for merchant in Merchant.objects.filter(id__in=merchant_ids):
+            merchant.rebalance_shards(count=config.balance_shards)
+    started = time.perf_counter()
+    if config.processes > 1:
+        # Forked children must not share the parent's database connections.
+        connections.close_all()
+        share, extra = divmod(config.operations, config.processes)
+        jobs = [
+            (
+                strategy,
+                config,
+                merchant_ids,
+                share + (index < extra),
+                config.seed + index + 1,
+            )
+            for index in range(config.processes)
+        ]
+        with multiprocessing.get_context("fork").Pool(config.processes) as pool:
+            tally = sum(pool.map(_run_threads, jobs), Counter())
+    else:
+        tally = _run_threads(
+            (strategy, config, merchant_ids, config.operations, config.seed)
+        )
+    elapsed = time.perf_counter() - started
+
+    outcomes = Counter()
+    for (_, outcome), value in tally.items():
+        outcomes[outcome] += value
+    violations = check_invariants(config, merchant_ids, tally)
+    succeeded = outcomes["add_credit"] + outcomes["subtract_credit"]
+    return {
+        "strategy": strategy,
+        "elapsed_s": elapsed,
+        "operations_per_s": config.operations / elapsed if elapsed else None,
+        "succeeded_per_s": succeeded / elapsed if elapsed else None,
+        "adds": outcomes["add_credit"],
+        "charges": outcomes["subtract_credit"],
+        "rejected": outcomes["rejected"],
+        "errors": outcomes["errors"],
+        "ok": not violations and not outcomes["errors"],
+        "violations": violations,
+    }
+
+
+def run_stress_suite(config, strategies=None):
+    """
+    Stresses each strategy in turn and returns the reports, fastest safe one first.
+    """
+    reports = [run_stress(strategy, config) for strategy in strategies or STRATEGIES]
+    reports.sort(key=lambda report: (not report["ok"], -report["operations_per_s"]))
+    return {"config": asdict(config), "strategies": reports}
@@ -1,17 +1,78 @@
 from rest_framework.test import APITestCase
 from rest_framework.test import APIClient
 from rest_framework import status
+from rest_framework.serializers import ValidationError
+from django.test import AsyncClient, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
 from django.urls import reverse
 from django.shortcuts import get_object_or_404
-from .models import Merchant, TransactionLog
-from .serializers import MerchantSerializer, TransactionLogSerializer
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, router
+from django.db.models import F, Sum
+from django.db.transaction import atomic
+from django.utils import timezone
+from .models import (
+    BalanceSnapshot,
+    CreditHold,
+    IdempotencyKey,
+    Merchant,
+    MerchantBalanceShard,
+    PendingTransactionLog,
+    ShardPlacement,
+    TransactionEvent,
+    TransactionLog,
+    TransactionRollup,
+    VelocityRule,
+)
+from .serializers import (
+    MerchantSerializer,
+    TransactionLogSerializer,
+    validate_charge,
+)
+from .microbench import run_microbenchmark
+from .admission import TokenBuckets, charge_admission
+from .benchmark import BenchmarkConfig, _run_threads, percentile
+from .cache import balance_cache, LRUCache
+from .combiner import ChargeCombiner, charge_combiner
+from .events import CacheSink, EventConsumer, FileSink, relay_events, replay_logs
+from .metrics import Histogram, registry
+from .outbox import flush_pending_logs
+from .reconciliation import reconcile, reconcile_merchant
+from .rollups import rebuild_buckets, run_rollups
+from .routers import read_counts, replica_reads
+from .sharding import (
+    EPOCH,
+    FIRST_SHARDED_ID,
+    TIMESTAMP_BITS,
+    home_shard,
+    make_id,
+    move_merchant,
+    shard_map,
+    using_shard,
+)
+from .stress import STRATEGIES, StressConfig, run_stress
+from .velocity import LocalWindows, SlidingWindow, velocity_checks
+from . import idempotency, partitioning
 
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+import asyncio
+import csv
+import os
+import tempfile
+import json
 import random
+import threading
+from unittest import skipUnless
 
 
 class MerchantTestCase(APITestCase):
     def setUp(self):
         self.client = APIClient()
+        balance_cache.clear()
         self.test_data_init()
 
     def test_data_init(self):
@@ -20,6 +81,14 @@ class MerchantTestCase(APITestCase):
         self.data_1 = {"merchant_id": merchant_1_id, "credit": 1000000}
         self.data_2 = {"merchant_id": merchant_2_id, "credit": 1200000}
 
+    def test_merchant_fields(self):
+        """
+        tests that the merchant listing does not expose internal bookkeeping.
+        """
+        response = self.client.get(reverse("merchant-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data["results"][0]), {"id", "credit"})
+
     def add_credit_x_times(self, x, data):
         """
         Helper function. Adds credits to a given merchant two times.
@@ -199,3 +268,2161 @@ class MerchantTestCase(APITestCase):
         self.assertEqual(
             merchant_2_credit_sum, merchant_2_added_credits + merchant_2_bought_charges
         )
+
+
+class MerchantCreditDeltaTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+
+    def test_apply_credit_delta_returns_new_balance(self):
+        """
+        tests that the conditional update returns the balance written by the same statement.
+        """
+        self.assertEqual(Merchant.apply_credit_delta(self.merchant.id, 500), 1500)
+        self.assertEqual(Merchant.apply_credit_delta(self.merchant.id, -1500), 0)
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 0)
+
+    def test_apply_credit_delta_rejects_overdraft(self):
+        """
+        tests that a debit larger than the credit leaves the row untouched.
+        """
+        self.assertIsNone(Merchant.apply_credit_delta(self.merchant.id, -1001))
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 1000)
+
+    def test_stale_instances_do_not_lose_updates(self):
+        """
+        tests that two in-memory copies of the same merchant both apply their delta.
+        """
+        first = Merchant.objects.get(id=self.merchant.id)
+        second = Merchant.objects.get(id=self.merchant.id)
+        first.transaction(action="add_credit", phone=None, amount=100)
+        second.transaction(action="subtract_credit", phone=1, amount=300)
+        self.assertEqual(second.get_credit(), 800)
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 800)
+        self.assertEqual(
+            TransactionLog.get_merchant_credit_sum(merchant=self.merchant), -200
+        )
+
+
+class BuyChargeBatchTestCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.merchant = Merchant.create_merchant(initial_credit=10000)
+        self.url = (
+            reverse("merchant-list") + str(self.merchant.id) + "/buy-charge-batch/"
+        )
+
+    def test_buy_charge_batch(self):
+        """
+        tests that a batch that fits is debited once and logged per item.
+        """
+        items = [{"phone": i, "amount": 100} for i in range(50)]
+        response = self.client.post(self.url, data={"items": items}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["succeeded"], 50)
+        self.assertEqual(response.data["merchant_credit"], 5000)
+        self.assertEqual(
+            TransactionLog.objects.filter(merchant=self.merchant).count(), 50
+        )
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 5000)
+
+    def test_buy_charge_batch_partial(self):
+        """
+        tests that invalid and overdrawing items fail individually.
+        """
+        items = [
+            {"phone": 1, "amount": 6000},
+            {"phone": "not-a-phone", "amount": 10},
+            {"phone": 2, "amount": 5000},
+            {"phone": 3, "amount": -5},
+            {"phone": 4, "amount": 4000},
+        ]
+        response = self.client.post(self.url, data={"items": items}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            ["success", "failed", "failed", "failed", "success"],
+        )
+        self.assertEqual(response.data["merchant_credit"], 0)
+        self.assertEqual(
+            TransactionLog.get_merchant_credit_sum(merchant=self.merchant), -10000
+        )
+
+    def test_buy_charge_batch_strict_integers(self):
+        """
+        tests that items are validated like buy-charge, without truncating or casting.
+        """
+        items = [
+            {"phone": 1, "amount": 3.7},
+            {"phone": True, "amount": 10},
+            {"phone": 2},
+            {"phone": "3", "amount": "10.0"},
+        ]
+        response = self.client.post(self.url, data={"items": items}, format="json")
+        self.assertEqual(
+            [result.get("message") for result in response.data["results"]],
+            [
+                "amount: A valid integer is required.",
+                "phone: A valid integer is required.",
+                "amount: This field is required.",
+                None,
+            ],
+        )
+        self.assertEqual(response.data["results"][3]["phone"], 3)
+        self.assertEqual(response.data["merchant_credit"], 9990)
+
+    def test_buy_charge_batch_empty(self):
+        """
+        tests that an empty batch is rejected.
+        """
+        response = self.client.post(self.url, data={"items": []}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ChargeCombinerTestCase(APITestCase):
+    class FakeMerchant:
+        def __init__(self, credit):
+            self.id = 1
+            self.credit = credit
+            self.batches = []
+
+        def batch_transaction(self, items):
+            self.batches.append(items)
+            accepted = []
+            for _, amount in items:
+                accepted.append(amount <= self.credit)
+                if accepted[-1]:
+                    self.credit -= amount
+            return accepted
+
+        def get_credit(self):
+            return self.credit
+
+    @override_settings(B2B_CHARGE_WRITE_COMBINING_WINDOW_MS=200)
+    def test_concurrent_charges_are_combined(self):
+        """
+        tests that charges arriving within the window share one batch and that an
+        overdrawing charge fails on its own.
+        """
+        combiner = ChargeCombiner()
+        merchant = self.FakeMerchant(credit=250)
+        results = {}
+
+        def charge(phone, amount):
+            try:
+                results[phone] = combiner.charge(merchant, phone, amount)
+            except Exception:
+                results[phone] = None
+
+        threads = [
+            threading.Thread(target=charge, args=(phone, 100)) for phone in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(merchant.batches), 1)
+        self.assertEqual(sorted(results.values(), key=str), [50, 50, None])
+        stats = combiner.stats()
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["max_batch_size"], 3)
+
+    @override_settings(
+        B2B_CHARGE_WRITE_COMBINING=True, B2B_CHARGE_WRITE_COMBINING_WINDOW_MS=0
+    )
+    def test_buy_charge_through_combiner(self):
+        """
+        tests the <buy-charge> endpoint with write combining enabled.
+        """
+        merchant = Merchant.create_merchant(initial_credit=1000)
+        url = reverse("merchant-list") + str(merchant.id) + "/buy-charge/"
+        response = self.client.post(url, data={"phone": 1, "amount": 400})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["merchant_credit"], 600)
+        response = self.client.post(url, data={"phone": 1, "amount": 700})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            TransactionLog.get_merchant_credit_sum(merchant=merchant), -400
+        )
+
+
+@override_settings(B2B_CHARGE_ASYNC_DB_POOL_SIZE=0)
+class AsyncMerchantViewsTestCase(APITestCase):
+    def setUp(self):
+        balance_cache.clear()
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+        self.base_url = "/api/v1/async/merchant/%d/" % self.merchant.id
+
+    async def test_async_charge_flow(self):
+        """
+        tests the async <add-credit>, <buy-charge> and <get-credit> endpoints together.
+        """
+        client = AsyncClient()
+        response = await client.post(
+            self.base_url + "add-credit/",
+            data={"credit": 500},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = await client.post(
+            self.base_url + "buy-charge/",
+            data={"phone": "9121234567", "amount": 1200},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["merchant_credit"], 300)
+        response = await client.post(
+            self.base_url + "buy-charge/",
+            data={"phone": "9121234567", "amount": 301},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = await client.get(self.base_url + "get-credit/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["credit"], 300)
+
+    async def test_async_idempotency_key(self):
+        """
+        tests that the async views honour the Idempotency-Key header like the DRF ones.
+        """
+        client = AsyncClient()
+        for _ in range(2):
+            response = await client.post(
+                self.base_url + "buy-charge/",
+                data={"phone": "9121234567", "amount": 300},
+                content_type="application/json",
+                headers={"Idempotency-Key": "charge-1"},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json()["merchant_credit"], 700)
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+        response = await client.post(
+            self.base_url + "add-credit/",
+            data={"credit": 300},
+            content_type="application/json",
+            headers={"Idempotency-Key": "charge-1"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        response = await client.get(self.base_url + "get-credit/")
+        self.assertEqual(response.json()["credit"], 700)
+
+    @override_settings(
+        B2B_CHARGE_WRITE_COMBINING=True, B2B_CHARGE_WRITE_COMBINING_WINDOW_MS=50
+    )
+    async def test_async_combined_charges(self):
+        """
+        tests that concurrent async charges share one batch while waiting on the event
+        loop, since the database work has a single thread here.
+        """
+        client = AsyncClient()
+        batches = charge_combiner.stats()["batches"]
+        responses = await asyncio.gather(
+            *[
+                client.post(
+                    self.base_url + "buy-charge/",
+                    data={"phone": phone, "amount": 400},
+                    content_type="application/json",
+                )
+                for phone in range(3)
+            ]
+        )
+        self.assertEqual(
+            sorted(response.status_code for response in responses), [200, 200, 400]
+        )
+        self.assertEqual(charge_combiner.stats()["batches"], batches + 1)
+        response = await client.get(self.base_url + "get-credit/")
+        self.assertEqual(response.json()["credit"], 200)
+
+    async def test_async_unknown_merchant(self):
+        """
+        tests that the async views return 404 for unknown merchants.
+        """
+        client = AsyncClient()
+        response = await client.get("/api/v1/async/merchant/0/get-credit/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TransactionLogBalanceTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+
+    def test_balance_after_is_recorded(self):
+        """
+        tests that single and batch transactions record the running balance.
+        """
+        self.merchant.transaction(action="add_credit", phone=None, amount=500)
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=200)
+        self.merchant.batch_transaction([(2, 300), (3, 2000), (4, 100)])
+        self.assertEqual(
+            list(
+                TransactionLog.objects.filter(merchant=self.merchant)
+                .order_by("id")
+                .values_list("balance_after", flat=True)
+            ),
+            [1500, 1300, 1000, 900],
+        )
+        self.assertEqual(TransactionLog.get_merchant_balance(self.merchant), 900)
+        self.assertEqual(TransactionLog.get_merchant_balance_drift(self.merchant), 0)
+
+    def test_point_in_time_balance(self):
+        """
+        tests the balance lookup at a given time.
+        """
+        self.merchant.transaction(action="add_credit", phone=None, amount=500)
+        first = TransactionLog.objects.get(merchant=self.merchant)
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=200)
+        self.assertEqual(
+            TransactionLog.get_merchant_balance(self.merchant, at=first.created_time),
+            1500,
+        )
+        self.assertIsNone(
+            TransactionLog.get_merchant_balance(
+                self.merchant, at=first.created_time - timedelta(days=1)
+            )
+        )
+
+    def test_backfill_balance_after(self):
+        """
+        tests that the backfill command rebuilds balances for old rows.
+        """
+        self.merchant.transaction(action="add_credit", phone=None, amount=500)
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=200)
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=100)
+        TransactionLog.objects.update(balance_after=None)
+        call_command("backfill_balance_after", chunk_size=2, stdout=StringIO())
+        self.assertEqual(
+            list(
+                TransactionLog.objects.filter(merchant=self.merchant)
+                .order_by("id")
+                .values_list("balance_after", flat=True)
+            ),
+            [1500, 1300, 1200],
+        )
+
+
+class TransactionLogPartitioningTestCase(APITestCase):
+    def test_partition_naming(self):
+        """
+        tests the month arithmetic and naming of the monthly partitions.
+        """
+        self.assertEqual(
+            partitioning.add_months(date(2026, 11, 1), 2), date(2027, 1, 1)
+        )
+        self.assertEqual(
+            partitioning.add_months(date(2026, 1, 1), -1), date(2025, 12, 1)
+        )
+        name = partitioning.partition_name(date(2026, 3, 1))
+        self.assertEqual(name, "b2b_charge_transactionlog_p2026_03")
+        self.assertEqual(partitioning.partition_month(name), date(2026, 3, 1))
+        self.assertIsNone(partitioning.partition_month(partitioning.LEGACY_TABLE))
+
+    def test_legacy_range_follows_partitions(self):
+        """
+        tests that the legacy range ends where the first partition starts, which is
+        far enough ahead for the swap to happen before it.
+        """
+        self.assertEqual(
+            partitioning.first_partition_month(date(2026, 10, 20)), date(2026, 11, 1)
+        )
+        self.assertEqual(
+            partitioning.first_partition_month(date(2026, 10, 28)), date(2026, 12, 1)
+        )
+        bounds = {
+            "a": partitioning.partition_bounds(
+                "FOR VALUES FROM ('2027-01-01 00:00:00+00') TO ('2027-02-01 00:00:00+00')"
+            ),
+            "b": partitioning.partition_bounds(
+                "FOR VALUES FROM ('2026-12-01 00:00:00+00') TO ('2027-01-01 00:00:00+00')"
+            ),
+        }
+        self.assertEqual(bounds["b"], (date(2026, 12, 1), date(2027, 1, 1)))
+        self.assertEqual(partitioning.legacy_bound(bounds), date(2026, 12, 1))
+        self.assertEqual(
+            partitioning.partition_bounds(
+                "FOR VALUES FROM (MINVALUE) TO ('2026-12-01 00:00:00+00')"
+            ),
+            (None, date(2026, 12, 1)),
+        )
+        with self.assertRaises(Exception):
+            partitioning.legacy_bound({})
+
+    def test_partitioning_requires_postgresql(self):
+        """
+        tests that the partition command refuses to run on other databases.
+        """
+        if connection.vendor == "postgresql":
+            self.skipTest("Only meaningful on non-PostgreSQL databases.")
+        with self.assertRaises(CommandError):
+            call_command("manage_log_partitions", "--enable", stdout=StringIO())
+
+
+class BalanceCacheTestCase(APITestCase):
+    def setUp(self):
+        balance_cache.clear()
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+        self.url = reverse("merchant-list") + str(self.merchant.id) + "/get-credit/"
+
+    def test_get_credit_is_cached(self):
+        """
+        tests that repeated <get-credit> calls are served from the cache.
+        """
+        self.assertEqual(self.client.get(self.url).data["credit"], 1000)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["credit"], 1000)
+        self.assertEqual(balance_cache.stats()["hits"], 1)
+        self.assertEqual(balance_cache.stats()["misses"], 1)
+
+    def test_transaction_updates_cache_on_commit(self):
+        """
+        tests that committed transactions write the new credit through to the cache.
+        """
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.transaction(action="subtract_credit", phone=1, amount=300)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["credit"], 700)
+
+    @override_settings(B2B_CHARGE_LOG_OUTBOX=True)
+    def test_outbox_transaction_updates_cache(self):
+        """
+        tests that transactions logged to the outbox still publish a versioned credit,
+        which a slower reader's older credit does not replace.
+        """
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.transaction(action="subtract_credit", phone=1, amount=300)
+        balance_cache.fill(self.merchant.id, 1000, version=0)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["credit"], 700)
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.version, 1)
+
+    def test_sharded_credit_is_cached(self):
+        """
+        tests that the shards of a sharded merchant are cached and published one by one,
+        and that a skipped version of the merchant row drops them.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.rebalance_shards(count=4)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["credit"], 1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.transaction(action="subtract_credit", phone=1, amount=100)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["credit"], 900)
+        for number in range(4):
+            balance_cache.publish_shard(self.merchant.id, number, 250, version=1)
+        self.assertEqual(balance_cache.get(self.merchant.id), 900)
+        balance_cache.publish(self.merchant.id, 0, self.merchant.version + 2, 4)
+        self.assertIsNone(balance_cache.get(self.merchant.id))
+        balance_cache.clear()
+        self.assertEqual(self.client.get(self.url).data["credit"], 900)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["credit"], 900)
+
+    def test_older_versions_are_ignored(self):
+        """
+        tests that a publish with an older version does not replace a newer credit.
+        """
+        balance_cache.publish(self.merchant.id, 500, version=10)
+        balance_cache.publish(self.merchant.id, 900, version=9)
+        balance_cache.fill(self.merchant.id, 1000, version=0)
+        self.assertEqual(balance_cache.get(self.merchant.id), 500)
+
+    def test_stale_fill_after_invalidate(self):
+        """
+        tests that a credit read before an unversioned change is not cached after it.
+        """
+        self.assertIsNone(balance_cache.get(self.merchant.id))
+        # The reader has read 1000 when a writer commits and invalidates.
+        balance_cache.invalidate(self.merchant.id)
+        balance_cache.fill(self.merchant.id, 1000, version=0)
+        self.assertIsNone(balance_cache.get(self.merchant.id))
+        balance_cache.publish(self.merchant.id, 900, version=10)
+        self.assertIsNone(balance_cache.get(self.merchant.id))
+
+    @override_settings(B2B_CHARGE_BALANCE_CACHE_BACKEND="default")
+    def test_shared_backend_merges_under_lock_key(self):
+        """
+        tests that a shared cache alias keeps the newer credit and that fills skip an
+        entry another process is merging.
+        """
+        caches["default"].clear()
+        balance_cache.publish(self.merchant.id, 500, version=10)
+        balance_cache.publish(self.merchant.id, 900, version=9)
+        self.assertEqual(balance_cache.get(self.merchant.id), 500)
+        lock = "b2b_charge:credit:%d:lock" % self.merchant.id
+        caches["default"].add(lock, 1)
+        balance_cache.fill(self.merchant.id, 400, version=11)
+        self.assertEqual(balance_cache.get(self.merchant.id), 500)
+        caches["default"].delete(lock)
+        balance_cache.fill(self.merchant.id, 400, version=11)
+        self.assertEqual(balance_cache.get(self.merchant.id), 400)
+        self.assertIsNone(caches["default"].get(lock))
+        caches["default"].clear()
+
+    def test_lru_cache_expiry_and_eviction(self):
+        """
+        tests the eviction order and TTL of the local cache.
+        """
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        expired = LRUCache(max_size=2, ttl=-1)
+        expired.set("a", 1)
+        self.assertIsNone(expired.get("a"))
+
+
+class TransactionHistoryTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant(initial_credit=100000)
+        self.merchant.batch_transaction(
+            [(phone % 3, 100 + phone) for phone in range(10)]
+        )
+        self.url = reverse("merchant-transactions", args=[self.merchant.id])
+
+    def test_transactions_keyset_pages(self):
+        """
+        tests that walking the cursor returns every log exactly once, newest first.
+        """
+        seen = []
+        url = self.url + "?page_size=3"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 3)
+            seen.extend(log["id"] for log in response.data["results"])
+            url = response.data["next"]
+        expected = list(
+            TransactionLog.objects.filter(merchant=self.merchant)
+            .order_by("-created_time", "-id")
+            .values_list("id", flat=True)
+        )
+        self.assertEqual(seen, expected)
+
+    def test_transactions_filters(self):
+        """
+        tests the phone and time range filters.
+        """
+        response = self.client.get(self.url, {"phone": 1})
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertTrue(all(log["phone"] == 1 for log in response.data["results"]))
+        first = TransactionLog.objects.filter(merchant=self.merchant).earliest("id")
+        response = self.client.get(self.url, {"until": first.created_time.isoformat()})
+        self.assertEqual(response.data["results"], [])
+        response = self.client.get(self.url, {"since": "not-a-date"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_merchant_list_has_no_count_query(self):
+        """
+        tests that the merchant listing is cursor paginated without COUNT(*).
+        """
+        Merchant.create_merchant()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("merchant-list"), {"page_size": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertIsNotNone(response.data["next"])
+        self.assertFalse(any("COUNT" in query["sql"] for query in queries))
+
+
+class TransactionExportTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant(initial_credit=10000)
+        self.merchant.batch_transaction([(1, 100), (2, 200), (1, 300)])
+        self.url = reverse("merchant-export", args=[self.merchant.id])
+
+    def test_export_csv(self):
+        """
+        tests the streamed CSV export with a phone filter.
+        """
+        response = self.client.get(self.url, {"phone": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(
+            rows[0], ["id", "created_time", "phone", "amount", "balance_after"]
+        )
+        self.assertEqual([row[3] for row in rows[1:]], ["-100", "-300"])
+
+    def test_export_ndjson(self):
+        """
+        tests the streamed NDJSON export.
+        """
+        response = self.client.get(self.url, {"output": "ndjson"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        records = [
+            json.loads(line)
+            for line in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(
+            [record["balance_after"] for record in records], [9900, 9700, 9400]
+        )
+
+    def test_export_command(self):
+        """
+        tests the export management command.
+        """
+        out = StringIO()
+        call_command(
+            "export_transactions", self.merchant.id, output="ndjson", stdout=out
+        )
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+class IdempotencyKeyTestCase(APITestCase):
+    def setUp(self):
+        idempotency._recent.clear()
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+        self.url = reverse("merchant-buy-charge", args=[self.merchant.id])
+
+    def test_retried_buy_charge_is_not_charged_twice(self):
+        """
+        tests that a retry with the same key replays the first response.
+        """
+        data = {"phone": 1, "amount": 300}
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post(self.url, data=data, HTTP_IDEMPOTENCY_KEY="abc")
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            second = self.client.post(self.url, data=data, HTTP_IDEMPOTENCY_KEY="abc")
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 700)
+        self.assertEqual(
+            TransactionLog.objects.filter(merchant=self.merchant).count(), 1
+        )
+
+    def test_key_reused_for_another_request(self):
+        """
+        tests that a key cannot be replayed for a different payload or action.
+        """
+        self.client.post(
+            self.url, data={"phone": 1, "amount": 300}, HTTP_IDEMPOTENCY_KEY="abc"
+        )
+        response = self.client.post(
+            self.url, data={"phone": 1, "amount": 400}, HTTP_IDEMPOTENCY_KEY="abc"
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        response = self.client.post(
+            reverse("merchant-add-credit", args=[self.merchant.id]),
+            data={"credit": 300},
+            HTTP_IDEMPOTENCY_KEY="abc",
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_failed_requests_are_not_stored(self):
+        """
+        tests that a failed charge can be retried with the same key.
+        """
+        data = {"phone": 1, "amount": 3000}
+        response = self.client.post(self.url, data=data, HTTP_IDEMPOTENCY_KEY="xyz")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_prune_expired_keys(self):
+        """
+        tests that the prune command deletes only expired keys.
+        """
+        self.client.post(
+            self.url, data={"phone": 1, "amount": 1}, HTTP_IDEMPOTENCY_KEY="old"
+        )
+        self.client.post(
+            self.url, data={"phone": 1, "amount": 1}, HTTP_IDEMPOTENCY_KEY="new"
+        )
+        IdempotencyKey.objects.filter(key="old").update(
+            created_time=timezone.now() - timedelta(days=2)
+        )
+        call_command("prune_idempotency_keys", ttl=86400, stdout=StringIO())
+        self.assertEqual(
+            list(IdempotencyKey.objects.values_list("key", flat=True)), ["new"]
+        )
+
+
+class BenchmarkTestCase(APITestCase):
+    def test_percentile(self):
+        """
+        tests the interpolated percentiles used by the benchmark report.
+        """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50.5)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertIsNone(percentile([], 99))
+
+    def test_benchmark_report(self):
+        """
+        tests a small single-threaded in-process run of the benchmark command.
+        """
+        out = StringIO()
+        call_command(
+            "benchmark_charges",
+            requests=30,
+            threads=1,
+            merchants=2,
+            skew="hot",
+            stdout=out,
+        )
+        report = json.loads(out.getvalue())
+        self.assertTrue(report["consistency"]["ok"])
+        self.assertEqual(
+            sum(endpoint["requests"] for endpoint in report["endpoints"].values()), 30
+        )
+        self.assertGreater(report["endpoints"]["buy-charge"]["queries_per_request"], 0)
+
+
+class ConcurrencyStressTestCase(TransactionTestCase):
+    """
+    Runs the stress harness for real: TransactionTestCase commits, so every worker thread
+    sees the others' writes and the row locks are actually contended. SQLite serialises
+    writers, so the concurrent runs need PostgreSQL.
+    """
+
+    def setUp(self):
+        balance_cache.clear()
+
+    def stress(self, strategy, **kwargs):
+        if connection.vendor != "postgresql":
+            kwargs.update(threads=1, processes=1)
+        config = StressConfig(
+            operations=400, merchants=2, initial_credit=20000, **kwargs
+        )
+        report = run_stress(strategy, config)
+        self.assertEqual(report["violations"], [])
+        self.assertEqual(report["errors"], 0)
+        self.assertGreater(report["rejected"], 0)
+        self.assertEqual(
+            report["adds"] + report["charges"] + report["rejected"], config.operations
+        )
+
+    def test_strategies_under_threads(self):
+        """
+        tests that no strategy loses an update or overdraws a merchant under threads.
+        """
+        for strategy in STRATEGIES:
+            with self.subTest(strategy=strategy):
+                self.stress(strategy, threads=8)
+
+    def test_conditional_update_under_processes(self):
+        """
+        tests the conditional UPDATE across forked processes.
+        """
+        self.stress("conditional_update", threads=4, processes=2)
+
+
+@override_settings(B2B_CHARGE_METRICS_SAMPLE_RATE=1.0, B2B_CHARGE_ASYNC_DB_POOL_SIZE=0)
+class MetricsTestCase(APITestCase):
+    def setUp(self):
+        balance_cache.clear()
+        registry.clear()
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+
+    def test_histogram_buckets(self):
+        """
+        tests that histogram buckets are cumulative and end with +Inf.
+        """
+        histogram = Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        buckets, total, count = histogram.snapshot()
+        self.assertEqual(buckets, [(1, 2), (5, 3), ("+Inf", 4)])
+        self.assertEqual((total, count), (14.5, 4))
+
+    def test_request_metrics(self):
+        """
+        tests that <buy-charge> requests are counted with their queries and lock wait.
+        """
+        url = reverse("merchant-buy-charge", kwargs={"pk": self.merchant.id})
+        self.client.post(url, {"phone": "9121234567", "amount": 100})
+        self.client.post(url, {"phone": "9121234567", "amount": 5000})
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        body = response.content.decode()
+        for line in (
+            'b2b_charge_requests_total{endpoint="merchant-buy-charge",status="200"} 1',
+            'b2b_charge_requests_total{endpoint="merchant-buy-charge",status="400"} 1',
+            'b2b_charge_request_duration_seconds_count{endpoint="merchant-buy-charge"} 2',
+            'b2b_charge_request_lock_wait_seconds_count{endpoint="merchant-buy-charge"} 2',
+            "b2b_charge_balance_cache_hits_total 0",
+        ):
+            self.assertIn(line, body)
+        self.assertNotIn("b2b-charge-metrics", body)
+        queries = registry.histograms["request_db_queries"]["merchant-buy-charge"]
+        self.assertGreaterEqual(queries.snapshot()[1], 4)
+
+    async def test_async_request_metrics(self):
+        """
+        tests that the database work of the async views is attributed to their request.
+        """
+        client = AsyncClient()
+        response = await client.post(
+            "/api/v1/async/merchant/%d/buy-charge/" % self.merchant.id,
+            data={"phone": "9121234567", "amount": 100},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        queries = registry.histograms["request_db_queries"]["async-merchant-buy-charge"]
+        self.assertGreater(queries.snapshot()[1], 0)
+
+
+class ShardedBalanceTestCase(APITestCase):
+    def setUp(self):
+        balance_cache.clear()
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+        call_command(
+            "set_balance_shards",
+            "--merchant=%d" % self.merchant.id,
+            "--shards=4",
+            stdout=StringIO(),
+        )
+        self.merchant.refresh_from_db()
+
+    def assertLedger(self):
+        credit = self.merchant.get_credit()
+        self.assertEqual(TransactionLog.get_merchant_credit_sum(self.merchant), credit)
+        self.assertEqual(TransactionLog.get_merchant_balance(self.merchant), credit)
+        for shard in MerchantBalanceShard.objects.filter(merchant=self.merchant):
+            self.assertGreaterEqual(shard.credit, 0)
+            self.assertEqual(
+                TransactionLog.objects.filter(
+                    merchant=self.merchant, shard=shard.number
+                ).aggregate(Sum("amount"))["amount__sum"],
+                shard.credit,
+            )
+
+    def test_enable_shards(self):
+        """
+        tests that enabling shards spreads the credit with zero-sum transfer entries.
+        """
+        self.assertEqual(self.merchant.balance_shards, 4)
+        self.assertEqual(self.merchant.credit, 0)
+        self.assertEqual(
+            sorted(
+                MerchantBalanceShard.objects.filter(merchant=self.merchant).values_list(
+                    "credit", flat=True
+                )
+            ),
+            [250, 250, 250, 250],
+        )
+        self.assertEqual(self.merchant.get_credit(), 1000)
+        self.assertEqual(
+            TransactionLog.objects.filter(
+                merchant=self.merchant, is_transfer=True
+            ).aggregate(Sum("amount"))["amount__sum"],
+            0,
+        )
+        self.assertLedger()
+
+    def test_charges_and_rebalance(self):
+        """
+        tests charges on a sharded merchant, including one no single shard can cover.
+        """
+        base_url = "/api/v1/merchant/%d/" % self.merchant.id
+        response = self.client.post(
+            base_url + "buy-charge/", {"phone": "9121234567", "amount": 100}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["merchant_credit"], 900)
+        response = self.client.post(
+            base_url + "buy-charge/", {"phone": "9121234567", "amount": 800}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["merchant_credit"], 100)
+        response = self.client.post(
+            base_url + "buy-charge/", {"phone": "9121234567", "amount": 101}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.post(base_url + "add-credit/", {"credit": 50})
+        response = self.client.get(base_url + "get-credit/")
+        self.assertEqual(response.data["credit"], 150)
+        self.merchant.refresh_from_db()
+        self.assertLedger()
+        self.assertEqual(
+            [
+                log["amount"]
+                for log in self.client.get(base_url + "transactions/").data["results"]
+            ],
+            [50, -800, -100, 1000],
+        )
+
+    def test_batch_and_unshard(self):
+        """
+        tests a batch against a sharded merchant and moving the credit back to one row.
+        """
+        accepted = self.merchant.batch_transaction([(1, 200), (2, 700), (3, 50)])
+        self.assertEqual(accepted, [True, True, True])
+        self.assertEqual(self.merchant.get_credit(), 50)
+        self.assertEqual(
+            self.merchant.batch_transaction([(4, 60), (5, 40)]), [False, True]
+        )
+        self.assertLedger()
+        self.merchant.rebalance_shards(count=1)
+        self.merchant.refresh_from_db()
+        self.assertEqual((self.merchant.balance_shards, self.merchant.credit), (1, 10))
+        self.assertFalse(
+            MerchantBalanceShard.objects.filter(merchant=self.merchant).exists()
+        )
+        self.assertLedger()
+
+    def test_backfill_balance_after(self):
+        """
+        tests that the backfill keeps one running balance per shard.
+        """
+        self.merchant.batch_transaction([(1, 200), (2, 700)])
+        self.merchant.transaction(action="add_credit", phone=None, amount=50)
+        logs = TransactionLog.objects.filter(merchant=self.merchant).order_by("id")
+        expected = list(logs.values_list("balance_after", flat=True))
+        logs.update(balance_after=None)
+        call_command("backfill_balance_after", chunk_size=3, stdout=StringIO())
+        self.assertEqual(list(logs.values_list("balance_after", flat=True)), expected)
+
+
+class ReconciliationTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant()
+        for amount in (1000, 500):
+            self.merchant.transaction(action="add_credit", phone=None, amount=amount)
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=300)
+
+    def test_incremental_reconciliation(self):
+        """
+        tests that a run only reads the log rows written after the last snapshot.
+        """
+        result = reconcile_merchant(self.merchant.id, safety_lag=0)
+        self.assertEqual((result["credit"], result["drift"]), (1200, 0))
+        snapshot = BalanceSnapshot.get_latest(self.merchant.id)
+        self.assertEqual(snapshot.balance, 1200)
+        self.assertEqual(
+            snapshot.last_log_id,
+            TransactionLog.objects.filter(merchant=self.merchant).latest("id").id,
+        )
+
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=200)
+        # History covered by the snapshot is not read again.
+        TransactionLog.objects.filter(id=snapshot.last_log_id).update(amount=0)
+        result = reconcile_merchant(self.merchant.id, safety_lag=0)
+        self.assertEqual(result["scanned_from"], snapshot.last_log_id)
+        self.assertEqual((result["ledger"], result["drift"]), (1000, 0))
+        self.assertEqual(BalanceSnapshot.get_latest(self.merchant.id).balance, 1000)
+        self.assertEqual(reconcile_merchant(self.merchant.id, full=True)["drift"], -300)
+
+    def test_safety_lag(self):
+        """
+        tests that snapshots do not cover log rows younger than the safety lag.
+        """
+        result = reconcile_merchant(self.merchant.id, safety_lag=3600)
+        self.assertEqual(result["drift"], 0)
+        self.assertIsNone(BalanceSnapshot.get_latest(self.merchant.id))
+
+    def test_drift_is_reported(self):
+        """
+        tests that the command reports merchants whose credit drifted.
+        """
+        other = Merchant.create_merchant()
+        other.transaction(action="add_credit", phone=None, amount=10)
+        Merchant.objects.filter(id=self.merchant.id).update(credit=F("credit") + 5)
+        report = reconcile(workers=1, safety_lag=0)
+        self.assertEqual(report["merchants"], 2)
+        self.assertEqual(
+            [(result["merchant_id"], result["drift"]) for result in report["drifted"]],
+            [(self.merchant.id, 5)],
+        )
+        with self.assertRaises(CommandError):
+            call_command(
+                "reconcile_balances", "--workers=1", "--safety-lag=0", stdout=StringIO()
+            )
+
+
+class ReconciliationPoolTestCase(TransactionTestCase):
+    @skipUnless(connection.vendor == "postgresql", "forked workers need a server")
+    def test_process_pool(self):
+        """
+        tests reconciling merchants over a process pool, which needs committed data.
+        """
+        merchants = [Merchant.create_merchant() for _ in range(3)]
+        for merchant in merchants:
+            merchant.transaction(action="add_credit", phone=None, amount=100)
+        Merchant.objects.filter(id=merchants[1].id).update(credit=99)
+        report = reconcile(workers=2, safety_lag=0)
+        self.assertEqual(report["merchants"], 3)
+        self.assertEqual(
+            [result["merchant_id"] for result in report["drifted"]], [merchants[1].id]
+        )
+        self.assertEqual(BalanceSnapshot.objects.count(), 3)
+
+
+class BulkProvisioningTestCase(APITestCase):
+    def test_bulk_create(self):
+        """
+        tests creating merchants in bulk, with per-row failures and logged opening balances.
+        """
+        response = self.client.post(
+            reverse("merchant-bulk-create"),
+            data={"merchants": [{"credit": 100}, {"credit": -1}, {}, {"credit": 0}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["succeeded"], response.data["failed"]), (2, 2))
+        results = response.data["results"]
+        self.assertEqual([result["row"] for result in results], [0, 1, 2, 3])
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["success", "failed", "failed", "success"],
+        )
+        merchant = Merchant.objects.get(id=results[0]["merchant_id"])
+        self.assertEqual(merchant.credit, 100)
+        self.assertEqual(TransactionLog.get_merchant_credit_sum(merchant), 100)
+        self.assertEqual(
+            TransactionLog.objects.filter(
+                merchant_id=results[3]["merchant_id"]
+            ).count(),
+            0,
+        )
+
+    def test_bulk_rows_are_strict_integers(self):
+        """
+        tests that bulk rows are not truncated or cast from booleans.
+        """
+        response = self.client.post(
+            reverse("merchant-bulk-create"),
+            data={"merchants": [{"credit": 3.7}, {"credit": True}, {"credit": "5"}]},
+            format="json",
+        )
+        self.assertEqual(
+            [result.get("message") for result in response.data["results"]],
+            [
+                "credit: A valid integer is required.",
+                "credit: A valid integer is required.",
+                None,
+            ],
+        )
+        self.assertEqual(response.data["results"][2]["credit"], 5)
+
+    def test_bulk_top_up(self):
+        """
+        tests topping up many merchants, several rows of one merchant included.
+        """
+        merchants = [Merchant.create_merchant() for _ in range(2)]
+        items = [
+            {"merchant_id": merchants[0].id, "credit": 100},
+            {"merchant_id": merchants[1].id, "credit": 50},
+            {"merchant_id": merchants[0].id, "credit": 30},
+            {"merchant_id": 10**9, "credit": 10},
+            {"merchant_id": merchants[1].id, "credit": 0},
+            {"merchant_id": "x", "credit": 10},
+        ]
+        response = self.client.post(
+            reverse("merchant-bulk-top-up"), data={"items": items}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["succeeded"], response.data["failed"]), (3, 3))
+        self.assertEqual(
+            [result.get("credit") for result in response.data["results"][:3]],
+            [100, 50, 130],
+        )
+        self.assertEqual(
+            response.data["results"][3]["message"], "merchant does not exist"
+        )
+        for merchant, credit in zip(merchants, (130, 50)):
+            merchant.refresh_from_db()
+            self.assertEqual(merchant.credit, credit)
+            self.assertEqual(TransactionLog.get_merchant_credit_sum(merchant), credit)
+        self.assertEqual(
+            list(
+                TransactionLog.objects.filter(merchant=merchants[0])
+                .order_by("id")
+                .values_list("balance_after", flat=True)
+            ),
+            [100, 130],
+        )
+
+    def test_bulk_limits(self):
+        """
+        tests that an empty or oversized bulk request is rejected as a whole.
+        """
+        response = self.client.post(
+            reverse("merchant-bulk-create"), data={"merchants": []}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_command(self):
+        """
+        tests importing merchants from a CSV file and topping them up from an NDJSON file.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "merchants.csv")
+            with open(path, "w", newline="") as rows_file:
+                writer = csv.writer(rows_file)
+                writer.writerows([["credit"], [10], [20], ["bad"]])
+            out = StringIO()
+            call_command(
+                "import_merchants",
+                path,
+                "--chunk-size=2",
+                stdout=out,
+                stderr=StringIO(),
+            )
+            failures = [json.loads(line) for line in out.getvalue().splitlines()]
+            self.assertEqual([failure["row"] for failure in failures], [2])
+            merchant_ids = list(
+                Merchant.objects.order_by("id").values_list("id", flat=True)
+            )
+            self.assertEqual(len(merchant_ids), 2)
+
+            path = os.path.join(directory, "top-ups.ndjson")
+            with open(path, "w") as rows_file:
+                for merchant_id in merchant_ids:
+                    rows_file.write(
+                        json.dumps({"merchant_id": merchant_id, "credit": 5}) + "\n"
+                    )
+                rows_file.write("not json\n")
+            out = StringIO()
+            call_command(
+                "import_merchants", path, "--mode=top-up", stdout=out, stderr=StringIO()
+            )
+            self.assertEqual(json.loads(out.getvalue())["row"], 2)
+        self.assertEqual(
+            list(Merchant.objects.order_by("id").values_list("credit", flat=True)),
+            [15, 25],
+        )
+
+
+@override_settings(B2B_CHARGE_LOG_OUTBOX=True)
+class TransactionLogOutboxTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant()
+
+    def test_flush(self):
+        """
+        tests that logs wait in the outbox until flushed, and keep their order and times.
+        """
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=300)
+        self.merchant.batch_transaction([(2, 100)])
+        self.assertEqual(TransactionLog.objects.count(), 0)
+        self.assertEqual(PendingTransactionLog.objects.count(), 3)
+        self.assertEqual(TransactionLog.get_merchant_credit_sum(self.merchant), 600)
+        self.assertEqual(TransactionLog.get_merchant_balance(self.merchant), 600)
+        created_times = list(
+            PendingTransactionLog.objects.order_by("id").values_list(
+                "created_time", flat=True
+            )
+        )
+
+        self.assertEqual(flush_pending_logs(batch_size=2), 3)
+        self.assertEqual(PendingTransactionLog.objects.count(), 0)
+        logs = TransactionLog.objects.filter(merchant=self.merchant).order_by("id")
+        self.assertEqual(
+            [(log.amount, log.balance_after) for log in logs],
+            [(1000, 1000), (-300, 700), (-100, 600)],
+        )
+        self.assertEqual([log.created_time for log in logs], created_times)
+        self.assertEqual(TransactionLog.get_merchant_credit_sum(self.merchant), 600)
+        self.assertEqual(flush_pending_logs(), 0)
+
+    def test_failed_transaction(self):
+        """
+        tests that a rolled back charge leaves nothing in the outbox.
+        """
+        with self.assertRaises(Exception):
+            self.merchant.transaction(action="subtract_credit", phone=1, amount=10)
+        self.assertEqual(PendingTransactionLog.objects.count(), 0)
+
+    def test_reconcile_flushes(self):
+        """
+        tests that reconciliation flushes the outbox and counts entries left in it.
+        """
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+        result = reconcile_merchant(self.merchant.id, safety_lag=0)
+        self.assertEqual((result["ledger"], result["drift"]), (1000, 0))
+        self.assertIsNone(BalanceSnapshot.get_latest(self.merchant.id))
+
+        report = reconcile(workers=1, safety_lag=0)
+        self.assertEqual(report["drifted"], [])
+        self.assertEqual(PendingTransactionLog.objects.count(), 0)
+        self.assertEqual(BalanceSnapshot.get_latest(self.merchant.id).balance, 1000)
+
+    def test_flush_command(self):
+        """
+        tests flushing the outbox with the management command.
+        """
+        self.merchant.transaction(action="add_credit", phone=None, amount=10)
+        out = StringIO()
+        call_command("flush_transaction_logs", stdout=out)
+        self.assertIn("1 transaction logs flushed.", out.getvalue())
+        self.assertEqual(
+            TransactionLog.objects.filter(merchant=self.merchant).count(), 1
+        )
+
+
+class TransactionRollupTestCase(APITestCase):
+    def setUp(self):
+        self.merchant = Merchant.create_merchant()
+        self.day = datetime(2026, 1, 5, tzinfo=dt_timezone.utc)
+        self.log(1000, None, hour=9)
+        self.log(-100, 1, hour=9)
+        self.log(-200, 2, hour=9)
+        self.log(-300, 1, hour=10)
+
+    def log(self, amount, phone, hour, **kwargs):
+        log = TransactionLog.objects.create(
+            merchant=self.merchant, phone=phone, amount=amount, **kwargs
+        )
+        TransactionLog.objects.filter(id=log.id).update(
+            created_time=self.day + timedelta(hours=hour, minutes=30)
+        )
+        return log
+
+    def rollups(self, period):
+        return list(
+            TransactionRollup.objects.filter(merchant=self.merchant, period=period)
+            .order_by("start")
+            .values_list("start", "count", "credit", "debit", "phones")
+        )
+
+    def test_rollups(self):
+        """
+        tests that the hourly and daily rollups match the log rows.
+        """
+        report = run_rollups(safety_lag=0)
+        self.assertEqual(report["log_rows"], 4)
+        self.assertEqual(
+            self.rollups("hour"),
+            [
+                (self.day + timedelta(hours=9), 3, 1000, 300, 2),
+                (self.day + timedelta(hours=10), 1, 0, 300, 1),
+            ],
+        )
+        self.assertEqual(self.rollups("day"), [(self.day, 4, 1000, 600, 2)])
+
+    def test_incremental(self):
+        """
+        tests that a run only adds the rows written since the last one, and that
+        transfers and rows younger than the safety lag are not counted.
+        """
+        run_rollups(safety_lag=0)
+        self.log(-50, 3, hour=10)
+        self.log(40, None, hour=10, shard=0, is_transfer=True)
+        report = run_rollups(safety_lag=0, batch_size=1)
+        self.assertEqual(report["log_rows"], 2)
+        self.assertEqual(
+            self.rollups("hour")[1], (self.day + timedelta(hours=10), 2, 0, 350, 2)
+        )
+        self.assertEqual(self.rollups("day"), [(self.day, 5, 1000, 650, 3)])
+
+        TransactionLog.objects.create(merchant=self.merchant, phone=4, amount=-1)
+        self.assertEqual(run_rollups(safety_lag=3600)["log_rows"], 0)
+        self.assertEqual(run_rollups(safety_lag=0)["log_rows"], 1)
+
+        TransactionRollup.objects.all().delete()
+        out = StringIO()
+        call_command("rollup_transactions", "--rebuild", "--safety-lag=0", stdout=out)
+        self.assertEqual(json.loads(out.getvalue())["log_rows"], 7)
+        self.assertEqual(self.rollups("day")[0], (self.day, 5, 1000, 650, 3))
+
+    def test_stats_endpoint(self):
+        """
+        tests the stats endpoint that serves the rollups.
+        """
+        run_rollups(safety_lag=0)
+        url = reverse("merchant-stats", args=[self.merchant.id])
+        response = self.client.get(url, {"period": "hour"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["count"] for row in response.data["results"]], [3, 1])
+        self.assertEqual(
+            response.data["totals"], {"count": 4, "credit": 1000, "debit": 600}
+        )
+        response = self.client.get(
+            url,
+            {"period": "hour", "since": (self.day + timedelta(hours=10)).isoformat()},
+        )
+        self.assertEqual(response.data["totals"]["count"], 1)
+        response = self.client.get(url)
+        self.assertEqual(response.data["results"][0]["phones"], 2)
+        response = self.client.get(url, {"period": "week"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_detached_buckets_are_kept(self):
+        """
+        tests that buckets older than the attached partitions are not rebuilt from the
+        rows left after a detach.
+        """
+        run_rollups(safety_lag=0)
+        TransactionLog.objects.filter(phone=2).delete()
+        next_day = self.day + timedelta(days=1)
+        rebuild_buckets(self.merchant.id, "day", [self.day], since=next_day)
+        self.assertEqual(self.rollups("day"), [(self.day, 4, 1000, 600, 2)])
+        rebuild_buckets(self.merchant.id, "day", [self.day])
+        self.assertEqual(self.rollups("day"), [(self.day, 3, 1000, 400, 1)])
+
+        month = date(2026, 2, 1)
+        partitions = {
+            partitioning.LEGACY_TABLE: month,
+            partitioning.partition_name(month): date(2026, 3, 1),
+            partitioning.partition_name(date(2026, 3, 1)): date(2026, 4, 1),
+        }
+        self.assertIsNone(partitioning.retained_month(partitions))
+        del partitions[partitioning.partition_name(month)]
+        self.assertEqual(partitioning.retained_month(partitions), date(2026, 3, 1))
+
+
+class AdmissionControlTestCase(APITestCase):
+    def setUp(self):
+        charge_admission.clear()
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=10000)
+        self.url = reverse("merchant-buy-charge", args=[self.merchant.id])
+        self.data = {"phone": 9123456789, "amount": 100}
+
+    def tearDown(self):
+        charge_admission.clear()
+
+    def test_token_bucket(self):
+        """
+        tests that a bucket admits a burst and then refills at the rate.
+        """
+        buckets = TokenBuckets(max_size=10)
+        self.assertEqual([buckets.take("m", 1000, 2) for _ in range(2)], [0, 0])
+        self.assertGreater(buckets.take("m", 0.001, 2), 0)
+        self.assertEqual(buckets.take("other", 1000, 1), 0)
+
+    def test_merchant_rate_limit(self):
+        """
+        tests that charges over the merchant's limit get 429 without being applied.
+        """
+        Merchant.objects.filter(id=self.merchant.id).update(rate_limit=1, rate_burst=2)
+        codes = [
+            self.client.post(self.url, data=self.data).status_code for _ in range(3)
+        ]
+        self.assertEqual(codes, [200, 200, 429])
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 9800)
+        response = self.client.post(self.url, data=self.data)
+        self.assertIn("Retry-After", response)
+
+        other = Merchant.create_merchant()
+        other.transaction(action="add_credit", phone=None, amount=100)
+        response = self.client.post(
+            reverse("merchant-buy-charge", args=[other.id]), data=self.data
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(B2B_CHARGE_RATE_LIMIT_BACKEND="")
+    def test_rate_limit_disabled(self):
+        """
+        tests that no limit is looked up or enforced without a rate limit backend.
+        """
+        Merchant.objects.filter(id=self.merchant.id).update(rate_limit=1, rate_burst=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(charge_admission.limits(self.merchant.id), (0, 1))
+        codes = [
+            self.client.post(self.url, data=self.data).status_code for _ in range(3)
+        ]
+        self.assertEqual(codes, [200, 200, 200])
+
+    @override_settings(B2B_CHARGE_RATE_LIMIT=1, B2B_CHARGE_ASYNC_DB_POOL_SIZE=0)
+    async def test_default_rate_limit(self):
+        """
+        tests the default limit, and that the async view answers 429 as well.
+        """
+        client = AsyncClient()
+        url = reverse("async-merchant-buy-charge", args=[self.merchant.id])
+        response = await client.post(
+            url, data=self.data, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = await client.post(
+            url, data=self.data, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(charge_admission.rejected, 1)
+
+    @override_settings(B2B_CHARGE_MAX_CONCURRENT_CHARGES=1)
+    def test_concurrency_cap(self):
+        """
+        tests that a charge is rejected while every slot of the process is taken.
+        """
+        with charge_admission.slot():
+            response = self.client.post(self.url, data=self.data)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        response = self.client.post(self.url, data=self.data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class LeanValidationTestCase(APITestCase):
+    def setUp(self):
+        balance_cache.clear()
+        self.merchant = Merchant.create_merchant(initial_credit=1000)
+        self.url = reverse("merchant-buy-charge", args=[self.merchant.id])
+
+    def test_validate_charge(self):
+        """
+        tests that the charge validator normalizes to ints and reports every bad field.
+        """
+        self.assertEqual(
+            validate_charge({"phone": "09121234567", "amount": "10"}), (9121234567, 10)
+        )
+        self.assertEqual(validate_charge({"phone": 1, "amount": 10.0}), (1, 10))
+        with self.assertRaises(ValidationError) as context:
+            validate_charge({"phone": "abc", "amount": 0})
+        self.assertEqual(sorted(context.exception.detail), ["amount", "phone"])
+        with self.assertRaises(ValidationError) as context:
+            validate_charge({"amount": True})
+        self.assertEqual(
+            context.exception.detail,
+            {
+                "phone": ["This field is required."],
+                "amount": ["A valid integer is required."],
+            },
+        )
+
+    def test_endpoints(self):
+        """
+        tests the lean <buy-charge>, <add-credit> and <get-credit> responses.
+        """
+        response = self.client.post(self.url, {"phone": "9121234567", "amount": 100})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.content,
+            b'{"message":"Successfully bought charge.","amount":100,"merchant_credit":900}',
+        )
+        self.assertEqual(
+            TransactionLog.objects.filter(merchant=self.merchant).latest("id").phone,
+            9121234567,
+        )
+        response = self.client.post(self.url, {"phone": "9121234567", "amount": -5})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("amount", response.data)
+        response = self.client.post(
+            reverse("merchant-add-credit", args=[self.merchant.id]), {}
+        )
+        self.assertEqual(response.data, {"credit": ["This field is required."]})
+        response = self.client.get(
+            reverse("merchant-get-credit", args=[self.merchant.id])
+        )
+        self.assertEqual(
+            response.json(), {"merchant_id": self.merchant.id, "credit": 900}
+        )
+
+    def test_microbenchmark(self):
+        """
+        tests that the micro-benchmark reports both paths for every case.
+        """
+        report = run_microbenchmark(iterations=5)
+        self.assertIn("validate buy-charge", report)
+        for case in report.values():
+            self.assertGreater(case["before_us"], 0)
+
+
+class CreditHoldTestCase(APITestCase):
+    def setUp(self):
+        balance_cache.clear()
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+
+    def reserve(self, amount, **data):
+        return self.client.post(
+            reverse("merchant-reserve", args=[self.merchant.id]),
+            data={"phone": 9121234567, "amount": amount, **data},
+        )
+
+    def close(self, hold_id, name):
+        return self.client.post(
+            reverse("merchant-%s" % name, args=[self.merchant.id, hold_id])
+        )
+
+    def test_reserve_and_capture(self):
+        """
+        tests that a captured hold is charged and logged once.
+        """
+        response = self.reserve(300)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["merchant_credit"], 700)
+        hold_id = response.data["hold_id"]
+        self.merchant.refresh_from_db()
+        self.assertEqual((self.merchant.credit, self.merchant.held_credit), (700, 300))
+        self.assertEqual(TransactionLog.objects.filter(amount__lt=0).count(), 0)
+        self.assertEqual(self.reserve(800).status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.close(hold_id, "capture")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["merchant_credit"], 700)
+        self.merchant.refresh_from_db()
+        self.assertEqual((self.merchant.credit, self.merchant.held_credit), (700, 0))
+        log = TransactionLog.objects.filter(merchant=self.merchant).latest("id")
+        self.assertEqual(
+            (log.amount, log.phone, log.balance_after), (-300, 9121234567, 700)
+        )
+        self.assertEqual(TransactionLog.get_merchant_credit_sum(self.merchant), 700)
+
+        self.assertEqual(
+            self.close(hold_id, "capture").status_code, status.HTTP_400_BAD_REQUEST
+        )
+        self.assertEqual(
+            self.close(hold_id, "release").status_code, status.HTTP_400_BAD_REQUEST
+        )
+
+    def test_release(self):
+        """
+        tests that a released hold gives the credit back without a log row.
+        """
+        hold_id = self.reserve(300).data["hold_id"]
+        self.assertEqual(reconcile_merchant(self.merchant.id)["drift"], 0)
+        response = self.close(hold_id, "release")
+        self.assertEqual(response.data["merchant_credit"], 1000)
+        self.merchant.refresh_from_db()
+        self.assertEqual((self.merchant.credit, self.merchant.held_credit), (1000, 0))
+        self.assertEqual(
+            TransactionLog.objects.filter(merchant=self.merchant).count(), 1
+        )
+        other = Merchant.create_merchant()
+        response = self.client.post(
+            reverse("merchant-capture", args=[other.id, hold_id])
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_balance_after_counts_held_credit(self):
+        """
+        tests that logs written while a hold is open record the held credit too, and
+        that the backfill agrees with them.
+        """
+        first = self.reserve(300).data["hold_id"]
+        self.reserve(200)
+        self.merchant.refresh_from_db()
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=100)
+        self.merchant.batch_transaction([(1, 50), (2, 50)])
+        self.close(first, "capture")
+        self.merchant.transaction(action="add_credit", phone=None, amount=400)
+        logs = TransactionLog.objects.filter(merchant=self.merchant).order_by("id")
+        expected = [1000, 900, 850, 800, 500, 900]
+        self.assertEqual(list(logs.values_list("balance_after", flat=True)), expected)
+        self.merchant.refresh_from_db()
+        self.assertEqual(TransactionLog.get_merchant_balance_drift(self.merchant), 0)
+
+        logs.update(balance_after=None)
+        call_command("backfill_balance_after", chunk_size=2, stdout=StringIO())
+        self.assertEqual(list(logs.values_list("balance_after", flat=True)), expected)
+
+    def test_expiry(self):
+        """
+        tests that expired holds cannot be captured and are swept back to the credit.
+        """
+        response = self.reserve(200, ttl=60)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.reserve(100, ttl=0).status_code, 400)
+        kept = self.reserve(100).data["hold_id"]
+        CreditHold.objects.filter(id=response.data["hold_id"]).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(
+            self.close(response.data["hold_id"], "capture").status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        out = StringIO()
+        call_command("expire_credit_holds", stdout=out)
+        self.assertIn("1 credit holds expired.", out.getvalue())
+        self.merchant.refresh_from_db()
+        self.assertEqual((self.merchant.credit, self.merchant.held_credit), (900, 100))
+        self.assertEqual(
+            CreditHold.objects.get(id=response.data["hold_id"]).status,
+            CreditHold.EXPIRED,
+        )
+        self.assertEqual(CreditHold.objects.get(id=kept).status, CreditHold.HELD)
+        self.assertEqual(CreditHold.expire_stale(), 0)
+
+
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Routes reads outside of a transaction, as the endpoints do. Only the router's
+    decisions are checked, so the replica aliases need not exist.
+    """
+
+    def setUp(self):
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+        # The committed transaction published the credit.
+        balance_cache.clear()
+
+    @override_settings(B2B_CHARGE_READ_REPLICAS=["replica_0", "replica_1"])
+    def test_router(self):
+        """
+        tests that only reads inside replica_reads() go to a replica, until a write.
+        """
+        self.assertEqual(router.db_for_read(Merchant), DEFAULT_DB_ALIAS)
+        with replica_reads():
+            self.assertIn(router.db_for_read(Merchant), ["replica_0", "replica_1"])
+            self.assertEqual(router.db_for_write(Merchant), DEFAULT_DB_ALIAS)
+            self.assertEqual(router.db_for_read(Merchant), DEFAULT_DB_ALIAS)
+        with replica_reads():
+            self.assertNotEqual(router.db_for_read(TransactionLog), DEFAULT_DB_ALIAS)
+            with atomic():
+                self.assertEqual(router.db_for_read(TransactionLog), DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_read(Merchant), DEFAULT_DB_ALIAS)
+        self.assertFalse(router.allow_migrate("replica_0", "b2b_charge"))
+        self.assertTrue(router.allow_migrate(DEFAULT_DB_ALIAS, "b2b_charge"))
+
+    @override_settings(B2B_CHARGE_READ_REPLICAS=[])
+    def test_without_replicas(self):
+        """
+        tests that everything reads from the primary when no replica is configured.
+        """
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Merchant), DEFAULT_DB_ALIAS)
+        response = self.client.get(
+            reverse("merchant-get-credit", args=[self.merchant.id])
+        )
+        self.assertEqual(response.data["credit"], 1000)
+        self.assertEqual(balance_cache.get(self.merchant.id), 1000)
+
+
+@skipUnless(settings.B2B_CHARGE_READ_REPLICAS, "no read replicas configured")
+class ReplicaReadsTestCase(TransactionTestCase):
+    """
+    Reads from the configured replicas for real. In tests they mirror the default
+    database, and only committed rows are visible through another connection.
+    """
+
+    databases = "__all__"
+
+    def setUp(self):
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+        # The committed transaction published the credit.
+        balance_cache.clear()
+
+    def test_endpoints(self):
+        """
+        tests that the read-only endpoints read from a replica, without filling the
+        balance cache, while charges read from the primary.
+        """
+        replicas = read_counts()
+        primary = replicas.pop(DEFAULT_DB_ALIAS, 0)
+        for name in ("get-credit", "transactions", "export", "stats"):
+            response = self.client.get(
+                reverse("merchant-%s" % name, args=[self.merchant.id])
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            self.client.get(reverse("merchant-list")).status_code, status.HTTP_200_OK
+        )
+        self.assertIsNone(balance_cache.get(self.merchant.id))
+        counts = read_counts()
+        self.assertEqual(counts.pop(DEFAULT_DB_ALIAS, 0), primary)
+        self.assertGreater(sum(counts.values()), sum(replicas.values()))
+
+        response = self.client.post(
+            reverse("merchant-buy-charge", args=[self.merchant.id]),
+            data={"phone": 9121234567, "amount": 100},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(read_counts()[DEFAULT_DB_ALIAS], primary)
+
+
+class ShardMapTestCase(APITestCase):
+    def setUp(self):
+        shard_map.clear()
+
+    def tearDown(self):
+        shard_map.clear()
+
+    def test_ids(self):
+        """
+        tests that merchant ids carry their home shard and sort by creation time.
+        """
+        merchant_id = make_id(3, 5, EPOCH + 1000)
+        self.assertGreaterEqual(merchant_id, FIRST_SHARDED_ID)
+        self.assertEqual(home_shard(merchant_id), 3)
+        self.assertEqual(merchant_id % 1024, 5)
+        self.assertLess(merchant_id, make_id(0, 0, EPOCH + 1001))
+        self.assertEqual(home_shard(FIRST_SHARDED_ID - 1), 0)
+        last = make_id(8191, 1023, EPOCH + (1 << TIMESTAMP_BITS) - 1)
+        self.assertLess(last, 1 << 63)
+        with self.assertRaises(Exception):
+            make_id(0, 0, EPOCH + (1 << TIMESTAMP_BITS))
+
+    @override_settings(
+        B2B_CHARGE_SHARDS=[DEFAULT_DB_ALIAS, "shard_9"], B2B_CHARGE_SHARD_MAP_TTL=0
+    )
+    def test_placement(self):
+        """
+        tests that merchants live on their home shard unless the directory says
+        otherwise, and that moving merchants refuse writes.
+        """
+        self.assertEqual(shard_map.alias_for(make_id(1, 0)), "shard_9")
+        self.assertEqual(shard_map.alias_for(42), DEFAULT_DB_ALIAS)
+        moved = make_id(1, 1)
+        ShardPlacement.objects.create(
+            merchant_id=moved, alias=DEFAULT_DB_ALIAS, moving=True
+        )
+        self.assertEqual(shard_map.placement(moved), (DEFAULT_DB_ALIAS, True))
+        with self.assertRaises(Exception):
+            shard_map.check_writable(moved)
+        with using_shard("shard_9"):
+            self.assertEqual(shard_map.pick(), "shard_9")
+
+    def test_without_sharding(self):
+        """
+        tests that merchants keep the database's ids when sharding is off.
+        """
+        merchant = Merchant.create_merchant()
+        self.assertLess(merchant.id, FIRST_SHARDED_ID)
+        self.assertEqual(shard_map.placement(merchant.id), (DEFAULT_DB_ALIAS, False))
+
+
+SHARD_ALIAS = next(
+    (alias for alias in settings.DATABASES if alias.startswith("shard_")), None
+)
+
+
+@skipUnless(SHARD_ALIAS, "no shard database configured")
+@override_settings(
+    B2B_CHARGE_SHARDS=[DEFAULT_DB_ALIAS, SHARD_ALIAS], B2B_CHARGE_SHARD_MAP_TTL=0
+)
+class ShardingTestCase(TransactionTestCase):
+    """
+    Spreads merchants over the default database and the first configured shard.
+    """
+
+    databases = "__all__"
+
+    def setUp(self):
+        shard_map.clear()
+        balance_cache.clear()
+        with using_shard(DEFAULT_DB_ALIAS):
+            self.local = Merchant.create_merchant()
+        with using_shard(SHARD_ALIAS):
+            self.remote = Merchant.create_merchant()
+
+    def tearDown(self):
+        shard_map.clear()
+        balance_cache.clear()
+
+    def charge(self, merchant, name, **data):
+        response = self.client.post(
+            reverse("merchant-%s" % name, args=[merchant.id]), data=data
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def logs(self, merchant, alias):
+        return TransactionLog.objects.using(alias).filter(merchant_id=merchant.id)
+
+    def test_routing(self):
+        """
+        tests that each merchant's rows are written to its own shard, and that
+        listings and reconciliation cover every shard.
+        """
+        self.assertEqual(self.remote._state.db, SHARD_ALIAS)
+        self.assertEqual(home_shard(self.remote.id), 1)
+        for merchant in (self.local, self.remote):
+            self.charge(merchant, "add-credit", credit=1000)
+            self.charge(merchant, "buy-charge", phone=9121234567, amount=300)
+            response = self.client.get(
+                reverse("merchant-get-credit", args=[merchant.id])
+            )
+            self.assertEqual(response.data["credit"], 700)
+        self.assertEqual(self.logs(self.remote, SHARD_ALIAS).count(), 2)
+        self.assertFalse(self.logs(self.remote, DEFAULT_DB_ALIAS).exists())
+        self.assertFalse(self.logs(self.local, SHARD_ALIAS).exists())
+
+        response = self.client.get(reverse("merchant-list"))
+        self.assertEqual(
+            {merchant["id"] for merchant in response.data["results"]},
+            {self.local.id, self.remote.id},
+        )
+        report = reconcile(workers=1, safety_lag=0)
+        self.assertEqual(report["merchants"], 2)
+        self.assertEqual(report["drifted"], [])
+
+    def test_benchmark_counts_shard_queries(self):
+        """
+        tests that the benchmark counts the queries a request runs on the shards.
+        """
+        config = BenchmarkConfig(threads=1, mix={"add-credit": 1})
+        with CaptureQueriesContext(connection) as local, CaptureQueriesContext(
+            connections[SHARD_ALIAS]
+        ) as remote:
+            samples = _run_threads(config, [self.remote.id], 5, seed=0)
+        # Some backends log transaction statements without running them through the
+        # execute wrappers.
+        executed = [
+            query
+            for query in local.captured_queries + remote.captured_queries
+            if query["sql"] not in ("BEGIN", "COMMIT", "ROLLBACK")
+        ]
+        self.assertGreater(len(remote), 0)
+        self.assertGreaterEqual(
+            sum(queries for _, _, queries in samples["add-credit"]), len(executed)
+        )
+
+    def test_move(self):
+        """
+        tests that a moved merchant keeps its credit and logs, and is served from the
+        target shard afterwards.
+        """
+        self.charge(self.local, "add-credit", credit=1000)
+        for amount in (100, 200):
+            self.charge(self.local, "buy-charge", phone=9121234567, amount=amount)
+
+        report = move_merchant(self.local.id, SHARD_ALIAS, batch_size=2)
+        self.assertEqual(report["logs"], 3)
+        self.assertEqual(
+            ShardPlacement.objects.get(merchant_id=self.local.id).alias, SHARD_ALIAS
+        )
+        self.assertFalse(Merchant.objects.filter(id=self.local.id).exists())
+        self.assertFalse(self.logs(self.local, DEFAULT_DB_ALIAS).exists())
+
+        self.charge(self.local, "buy-charge", phone=9121234567, amount=50)
+        response = self.client.get(reverse("merchant-get-credit", args=[self.local.id]))
+        self.assertEqual(response.data["credit"], 650)
+        self.assertEqual(self.logs(self.local, SHARD_ALIAS).count(), 4)
+        self.assertTrue(
+            Merchant.objects.using(SHARD_ALIAS).get(id=self.local.id).is_active
+        )
+        self.assertEqual(reconcile(workers=1, safety_lag=0)["drifted"], [])
+
+
+class _FailingSink(FileSink):
+    """
+    Publishes and then fails, like a relay that dies before its commit.
+    """
+
+    def publish(self, events):
+        super().publish(events)
+        raise Exception("relay died")
+
+
+@override_settings(B2B_CHARGE_EVENTS=True)
+class TransactionEventTestCase(APITestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sink = FileSink(os.path.join(self.directory.name, "events.jsonl"))
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=1000)
+        self.merchant.transaction(
+            action="subtract_credit", phone=9121234567, amount=100
+        )
+        self.merchant.batch_transaction([(9121234568, 200), (9121234569, 300)])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_relay_and_consume(self):
+        """
+        tests that every logged transaction is published once relayed, and that
+        consumers resume from their committed offset.
+        """
+        logs = list(
+            TransactionLog.objects.filter(merchant=self.merchant)
+            .order_by("id")
+            .values_list("id", "amount")
+        )
+        self.assertEqual(TransactionEvent.objects.count(), 4)
+        self.assertEqual(relay_events(self.sink, batch_size=3), 4)
+        self.assertFalse(TransactionEvent.objects.exists())
+
+        consumer = EventConsumer("billing", self.sink)
+        events = consumer.poll(limit=3) + consumer.poll()
+        self.assertEqual([(event["log_id"], event["amount"]) for event in events], logs)
+        self.assertEqual(
+            [event["type"] for event in events], ["credit"] + ["charge"] * 3
+        )
+        self.assertEqual(events[1]["phone"], 9121234567)
+        self.assertEqual(events[-1]["balance_after"], 400)
+        consumer.commit()
+
+        self.merchant.transaction(action="add_credit", phone=None, amount=50)
+        relay_events(self.sink)
+        consumer = EventConsumer("billing", self.sink)
+        self.assertEqual([event["amount"] for event in consumer.poll()], [50])
+        consumer.seek(0)
+        self.assertEqual(len(consumer.poll()), 5)
+        self.assertEqual(EventConsumer("fraud", self.sink).position, 0)
+
+    def test_at_least_once(self):
+        """
+        tests that a batch published by a relay that failed to commit is published
+        again, and that uncommitted events are delivered again.
+        """
+        with self.assertRaises(Exception):
+            relay_events(_FailingSink(self.sink.path))
+        self.assertEqual(TransactionEvent.objects.count(), 4)
+        self.assertEqual(relay_events(self.sink), 4)
+
+        consumer = EventConsumer("billing", self.sink)
+        events = consumer.poll()
+        self.assertEqual(len(events), 8)
+        self.assertEqual(
+            len({(event["source"], event["event_id"]) for event in events}), 4
+        )
+        consumer.commit(events[1]["offset"])
+        self.assertEqual(len(EventConsumer("billing", self.sink).poll()), 6)
+
+    def test_cache_sink(self):
+        """
+        tests that the cache sink numbers events and skips the ones that expired.
+        """
+        sink = CacheSink("default")
+        start = sink.head()
+        relay_events(sink)
+        self.assertEqual(sink.head(), start + 4)
+        consumer = EventConsumer("billing", sink)
+        consumer.seek(start)
+        self.assertEqual(
+            [event["offset"] for event in consumer.poll()],
+            list(range(start + 1, start + 5)),
+        )
+        caches["default"].delete(sink._key(start + 1))
+        consumer.seek(start)
+        self.assertEqual(len(consumer.poll()), 3)
+
+    def test_replay(self):
+        """
+        tests that the log can be replayed from a log id, and that events of entries
+        written to the log outbox have no log id yet.
+        """
+        first = TransactionLog.objects.filter(merchant=self.merchant).order_by("id")[0]
+        events = list(replay_logs(first.id, merchant_id=self.merchant.id, batch_size=2))
+        self.assertEqual([event["amount"] for event in events], [-100, -200, -300])
+        self.assertIsNone(events[0]["event_id"])
+
+        with override_settings(B2B_CHARGE_LOG_OUTBOX=True):
+            self.merchant.transaction(
+                action="subtract_credit", phone=9121234567, amount=10
+            )
+        self.assertIsNone(TransactionEvent.objects.order_by("-id")[0].log_id)
+
+    def test_commands(self):
+        """
+        tests that the relay and stream commands publish and print the events.
+        """
+        sink = "file:" + self.sink.path
+        out = StringIO()
+        call_command("relay_events", sink=sink, stdout=out)
+        self.assertIn("4 transaction events published", out.getvalue())
+        out = StringIO()
+        call_command("stream_events", "billing", sink=sink, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[0])["amount"], 1000)
+        self.assertEqual(
+            EventConsumer("billing", self.sink).position,
+            os.path.getsize(self.sink.path),
+        )
+
+
+class VelocityRuleTestCase(APITestCase):
+    def setUp(self):
+        velocity_checks.clear()
+        self.merchant = Merchant.create_merchant()
+        self.merchant.transaction(action="add_credit", phone=None, amount=10000)
+        self.url = reverse("merchant-buy-charge", args=[self.merchant.id])
+
+    def tearDown(self):
+        velocity_checks.clear()
+
+    def charge(self, phone, amount, url=None):
+        return self.client.post(
+            url or self.url, data={"phone": phone, "amount": amount}
+        ).status_code
+
+    def test_sliding_window(self):
+        """
+        tests that charges leave the window once it has slid past them.
+        """
+        window = SlidingWindow(30)
+        window.add(1000, 1, 100)
+        window.add(1010, 2, 50)
+        self.assertEqual(window.totals(1020), (3, 150))
+        self.assertEqual(window.retry_after(1020), 10)
+        self.assertEqual(window.totals(1031), (2, 50))
+        window.add(1000, 1, 100)
+        self.assertEqual(window.totals(1031), (2, 50))
+        self.assertEqual(window.totals(1100), (0, 0))
+
+    def test_phone_rule(self):
+        """
+        tests that a merchant's charges to one phone are limited, without limiting
+        other phones or merchants.
+        """
+        VelocityRule.objects.create(
+            merchant_id=self.merchant.id,
+            scope=VelocityRule.PHONE,
+            window=600,
+            max_count=2,
+        )
+        codes = [self.charge(9121234567, 100) for _ in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+        response = self.client.post(self.url, data={"phone": 9121234567, "amount": 1})
+        self.assertIn("Retry-After", response)
+        self.assertEqual(self.charge(9121234568, 100), 200)
+        self.merchant.refresh_from_db()
+        self.assertEqual(self.merchant.credit, 9700)
+        self.assertEqual(velocity_checks.rejected, 2)
+
+        other = Merchant.create_merchant(initial_credit=1000)
+        url = reverse("merchant-buy-charge", args=[other.id])
+        self.assertEqual(self.charge(9121234567, 100, url), 200)
+
+    def test_global_amount_rule(self):
+        """
+        tests that rules without a merchant apply to every merchant, and that failed
+        charges are not counted.
+        """
+        VelocityRule.objects.create(
+            scope=VelocityRule.MERCHANT, window=60, max_amount=500
+        )
+        self.assertEqual(self.charge(9121234567, 300), 200)
+        self.assertEqual(self.charge(9121234568, 300), 429)
+        self.assertEqual(self.charge(9121234568, 200), 200)
+
+        other = Merchant.create_merchant(initial_credit=100)
+        url = reverse("merchant-buy-charge", args=[other.id])
+        self.assertEqual(self.charge(9121234567, 200, url), 400)
+        self.assertEqual(self.charge(9121234567, 100, url), 200)
+
+    def test_warm_up(self):
+        """
+        tests that a process counts the charges logged before it loaded the rules.
+        """
+        for _ in range(2):
+            self.merchant.transaction(
+                action="subtract_credit", phone=9121234567, amount=100
+            )
+        VelocityRule.objects.create(
+            merchant_id=self.merchant.id, window=600, max_count=2
+        )
+        self.assertEqual(self.charge(9121234567, 100), 429)
+        self.assertEqual(self.charge(9121234568, 100), 200)
+
+    def test_warm_up_counts_charges_once(self):
+        """
+        tests that the warm-up skips charges its windows already counted, and counts a
+        window shared by two rules once.
+        """
+        self.merchant.transaction(action="subtract_credit", phone=1, amount=100)
+        VelocityRule.objects.create(
+            merchant_id=self.merchant.id, window=600, max_count=3
+        )
+        VelocityRule.objects.create(window=600, max_count=10)
+        self.assertEqual(self.charge(9121234567, 100), 200)
+        # The windows outlive what the process knows it warmed.
+        velocity_checks._backend()._warmed.clear()
+        self.assertEqual(self.charge(9121234567, 100), 200)
+        self.assertEqual(self.charge(9121234567, 100), 429)
+
+    @override_settings(B2B_CHARGE_VELOCITY_MAX_KEYS=3)
+    def test_evicted_window_is_warmed_again(self):
+        """
+        tests that a window evicted by other keys is warmed from the logs again, and
+        that the merchants known to be warm are bounded as well.
+        """
+        VelocityRule.objects.create(scope=VelocityRule.PHONE, window=600, max_count=2)
+        velocity_checks._windows = None
+        self.assertEqual(self.charge(9121234567, 100), 200)
+        self.assertEqual(self.charge(9121234568, 100), 200)
+        other = Merchant.create_merchant(initial_credit=1000)
+        url = reverse("merchant-buy-charge", args=[other.id])
+        self.assertEqual(self.charge(9121234569, 100, url), 200)
+        # Evicts the first window.
+        self.assertEqual(self.charge(9121234560, 100, url), 200)
+        self.assertEqual(self.charge(9121234567, 100), 200)
+        self.assertEqual(self.charge(9121234567, 100), 429)
+
+        windows = LocalWindows(max_size=1)
+        rules = velocity_checks.rules(self.merchant.id)
+        windows.warm(rules, self.merchant.id, [])
+        windows.warm(rules, other.id, [])
+        self.assertEqual(windows.cold(rules, self.merchant.id), list(rules))
+        self.assertEqual(windows.cold(rules, other.id), [])
+        velocity_checks._windows = None
+
+    def test_batch_items_are_checked(self):
+        """
+        tests that the items of a batch over a rule fail without being charged, and
+        that items failing for credit are not counted.
+        """
+        VelocityRule.objects.create(
+            merchant_id=self.merchant.id,
+            scope=VelocityRule.PHONE,
+            window=600,
+            max_count=2,
+        )
+        url = reverse("merchant-buy-charge-batch", args=[self.merchant.id])
+        items = [{"phone": 9121234567, "amount": 100} for _ in range(3)]
+        items.append({"phone": 9121234568, "amount": 100000})
+        response = self.client.post(url, data={"items": items}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            ["success", "success", "failed", "failed"],
+        )
+        self.assertIn("Velocity limit", response.data["results"][2]["message"])
+        self.assertEqual(response.data["merchant_credit"], 9800)
+        self.assertEqual(self.charge(9121234567, 100), 429)
+        self.assertEqual(self.charge(9121234568, 100), 200)
+        self.assertEqual(self.charge(9121234568, 100), 200)
+
+    def test_holds_are_checked(self):
+        """
+        tests that reserving credit counts against the rules like a charge.
+        """
+        VelocityRule.objects.create(
+            merchant_id=self.merchant.id, window=600, max_count=2
+        )
+        url = reverse("merchant-reserve", args=[self.merchant.id])
+        data = {"phone": 9121234567, "amount": 100}
+        codes = [self.client.post(url, data=data).status_code for _ in range(2)]
+        self.assertEqual(codes, [200, 200])
+        response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(self.charge(9121234567, 100), 429)
+        self.assertEqual(CreditHold.objects.filter(merchant=self.merchant).count(), 2)
+
+    @override_settings(B2B_CHARGE_VELOCITY_BACKEND="default")
+    def test_shared_backend(self):
+        """
+        tests the windows kept in a Django cache.
+        """
+        caches["default"].clear()
+        VelocityRule.objects.create(
+            merchant_id=self.merchant.id, window=600, max_count=1, max_amount=150
+        )
+        self.assertEqual(self.charge(9121234567, 200), 429)
+        self.assertEqual(self.charge(9121234567, 100), 200)
+        self.assertEqual(self.charge(9121234567, 10), 429)
+
+    @override_settings(B2B_CHARGE_ASYNC_DB_POOL_SIZE=0)
+    async def test_async_view(self):
+        """
+        tests that the async view answers 429 as well.
+        """
+        await VelocityRule.objects.acreate(
+            merchant_id=self.merchant.id, window=600, max_count=1
+        )
+        client = AsyncClient()
+        url = reverse("async-merchant-buy-charge", args=[self.merchant.id])
+        codes = []
+        for _ in range(2):
+            response = await client.post(
+                url,
+                data={"phone": 9121234567, "amount": 100},
+                content_type="application/json",
+            )
+            codes.append(response.status_code)
+        self.assertEqual(codes, [200, 429])
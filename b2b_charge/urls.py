@@ -1,8 +1,33 @@
 # Created at 10.09.22
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
+from . import async_views, metrics
 from .views import MerchantViewSet
 
 router = DefaultRouter()
 
 router.register("merchant", MerchantViewSet, basename="merchant")
+
+# ASGI-native variants of the hot endpoints. The DRF viewset above stays available.
+async_urlpatterns = [
+    path(
+        "merchant/<int:pk>/add-credit/",
+        async_views.add_credit,
+        name="async-merchant-add-credit",
+    ),
+    path(
+        "merchant/<int:pk>/buy-charge/",
+        async_views.buy_charge,
+        name="async-merchant-buy-charge",
+    ),
+    path(
+        "merchant/<int:pk>/get-credit/",
+        async_views.get_credit,
+        name="async-merchant-get-credit",
+    ),
+]
+
+metrics_urlpatterns = [
+    path("metrics/", metrics.metrics_view, name="b2b-charge-metrics"),
+]
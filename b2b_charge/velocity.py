@@ -0,0 +1,463 @@
+"""
+Velocity checks on charges, against sliding windows counted in memory.
+
+A ``VelocityRule`` limits the number and the total amount of a merchant's charges, or of
+its charges to one phone, within the last ``window`` seconds. Rules without a merchant
+apply to every merchant. ``velocity_checks.admit`` runs before the debit of a charge or
+a credit hold and answers 429 when a rule would be broken, and a batch fails the items
+that would break one. Otherwise the charge is counted right away, so concurrent
+charges cannot all slip under a limit, and uncounted again if it fails.
+
+Windows are ring buffers of ``BUCKETS`` slots, one per key, holding the charges and the
+amount of each slot and their running totals, so a check costs a few additions. A window
+covers between ``window - window / BUCKETS`` and ``window`` seconds. Windows are kept
+for ``B2B_CHARGE_VELOCITY_MAX_KEYS`` keys at most, the least recently used dropped
+first, and idle ones are swept out every ``SWEEP_INTERVAL`` seconds.
+
+In process (``B2B_CHARGE_VELOCITY_BACKEND = "local"``) each process only sees its own
+charges. The first time a process checks a merchant's rules it warms their windows from
+the merchant's recent logs, so a restart does not reset them, and it warms them again
+once one of the merchant's windows was evicted. Each window counts the logs written
+before it was created once, and skips the later ones, as their charges were counted when
+admitted. Which merchants are warm is kept for as many merchants as there are windows.
+Entries still in the log outbox are not counted by the warm-up. With a Django cache
+alias, the windows are shared by every process instead: one counter per slot, updated
+with ``incr``.
+
+Rules are cached for ``B2B_CHARGE_VELOCITY_RULES_TTL`` seconds, for at most
+``B2B_CHARGE_VELOCITY_RULES_CACHE_SIZE`` merchants, so checks rarely query the
+database. A hold is counted when it is reserved, and stays counted if it is released.
+"""
+
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils import timezone
+
+from .admission import AdmissionRejected
+from .cache import LRUCache
+from .sharding import merchant_shard
+
+BUCKETS = 30
+SWEEP_INTERVAL = 60
+
+
+class VelocityRejected(AdmissionRejected):
+    """
+    Raised when a charge would break a velocity rule.
+    """
+
+
+class SlidingWindow:
+    """
+    The charges and the amount of one key over the last ``window`` seconds.
+    """
+
+    __slots__ = (
+        "width",
+        "counts",
+        "amounts",
+        "head",
+        "count",
+        "amount",
+        "created",
+        "warmed",
+    )
+
+    def __init__(self, window):
+        self.width = window / BUCKETS
+        # Charges from then on are counted as they are admitted.
+        self.created = time.time()
+        # Whether the logged charges before then are counted.
+        self.warmed = False
+        self.counts = array("q", bytes(8 * BUCKETS))
+        self.amounts = array("q", bytes(8 * BUCKETS))
+        # The absolute number of the newest slot.
+        self.head = 0
+        self.count = 0
+        self.amount = 0
+
+    def _advance(self, slot):
+        if slot <= self.head:
+            return
+        if slot - self.head >= BUCKETS:
+            for index in range(BUCKETS):
+                self.counts[index] = self.amounts[index] = 0
+            self.count = self.amount = 0
+        else:
+            for number in range(self.head + 1, slot + 1):
+                index = number % BUCKETS
+                self.count -= self.counts[index]
+                self.amount -= self.amounts[index]
+                self.counts[index] = self.amounts[index] = 0
+        self.head = slot
+
+    def totals(self, now):
+        """
+        Returns the charges and the amount in the window ending at ``now``.
+        """
+        self._advance(int(now / self.width))
+        return self.count, self.amount
+
+    def add(self, at, count, amount):
+        """
+        Counts charges made at ``at``, which may lie in the past, and not before the
+        window.
+        """
+        slot = int(at / self.width)
+        self._advance(slot)
+        if slot <= self.head - BUCKETS:
+            return
+        index = slot % BUCKETS
+        self.counts[index] += count
+        self.amounts[index] += amount
+        self.count += count
+        self.amount += amount
+
+    def retry_after(self, now):
+        """
+        Returns the seconds until the oldest charge in the window leaves it.
+        """
+        for number in range(self.head - BUCKETS + 1, self.head + 1):
+            if self.counts[number % BUCKETS]:
+                return (number + BUCKETS) * self.width - now
+        return 0
+
+
+def _limited(rule, count, amount):
+    _, _, max_count, max_amount = rule
+    return (max_count is not None and count > max_count) or (
+        max_amount is not None and amount > max_amount
+    )
+
+
+def _key(rule, merchant_id, phone):
+    scope, window, _, _ = rule
+    return (scope, merchant_id, phone if scope == "phone" else None, window)
+
+
+class LocalWindows:
+    """
+    Thread-safe in-process sliding windows, one per key.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._windows = OrderedDict()
+        # The (scope, window) pairs each merchant's windows were warmed for.
+        self._warmed = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept = time.time()
+
+    def _window(self, key):
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = SlidingWindow(key[3])
+            while len(self._windows) > self.max_size:
+                evicted, _ = self._windows.popitem(last=False)
+                # The charges it counted are only in the logs now.
+                self._warmed.pop(evicted[1], None)
+        else:
+            self._windows.move_to_end(key)
+        return window
+
+    def cold(self, rules, merchant_id):
+        """
+        Returns the rules whose windows of the merchant need warming.
+        """
+        with self._lock:
+            warmed = self._warmed.get(merchant_id)
+            if warmed is None:
+                return list(rules)
+            self._warmed.move_to_end(merchant_id)
+            return [rule for rule in rules if rule[:2] not in warmed]
+
+    def reserve(self, rules, merchant_id, phone, amount):
+        """
+        Counts the charge, or raises VelocityRejected without counting it. Returns a
+        token for ``cancel``.
+        """
+        now = time.time()
+        with self._lock:
+            windows = [self._window(_key(rule, merchant_id, phone)) for rule in rules]
+            for rule, window in zip(rules, windows):
+                count, total = window.totals(now)
+                if _limited(rule, count + 1, total + amount):
+                    raise VelocityRejected(
+                        "Velocity limit of the %s over %d seconds exceeded for "
+                        "merchant %s." % (rule[0], rule[1], merchant_id),
+                        retry_after=math.ceil(window.retry_after(now)),
+                    )
+            for window in windows:
+                window.add(now, 1, amount)
+            if now - self._swept > SWEEP_INTERVAL:
+                self._sweep(now)
+        return now, windows, amount
+
+    def cancel(self, token):
+        at, windows, amount = token
+        with self._lock:
+            for window in windows:
+                window.add(at, -1, -amount)
+
+    def warm(self, rules, merchant_id, charges):
+        """
+        Counts past ``(phone, amount, timestamp)`` charges in the windows of ``rules``
+        that were not warmed yet. Charges made once a window existed were counted when
+        admitted, so they are skipped, and a window shared by several rules is counted
+        once.
+        """
+        with self._lock:
+            cold = {}
+            for phone, amount, at in charges:
+                for key in {_key(rule, merchant_id, phone) for rule in rules}:
+                    window = cold.get(key)
+                    if window is None:
+                        window = self._window(key)
+                        if window.warmed:
+                            continue
+                        cold[key] = window
+                    if at < window.created:
+                        window.add(at, 1, amount)
+            for window in cold.values():
+                window.warmed = True
+            self._warmed.setdefault(merchant_id, set()).update(
+                rule[:2] for rule in rules
+            )
+            self._warmed.move_to_end(merchant_id)
+            while len(self._warmed) > self.max_size:
+                self._warmed.popitem(last=False)
+
+    def _sweep(self, now):
+        idle = [
+            key for key, window in self._windows.items() if not window.totals(now)[0]
+        ]
+        for key in idle:
+            del self._windows[key]
+        self._swept = now
+
+    def __len__(self):
+        return len(self._windows)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self._warmed.clear()
+
+
+class SharedWindows:
+    """
+    Sliding windows in a Django cache, shared by every process. Each slot of a window
+    has a charges and an amount counter.
+    """
+
+    warms = False
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def _slot_keys(self, key, slot):
+        prefix = "b2b_charge:velocity:%s:%s:%s:%d:%d" % (key + (slot,))
+        return prefix + ":count", prefix + ":amount"
+
+    def _incr(self, cache, keys, count, amount, timeout):
+        for cache_key, delta in zip(keys, (count, amount)):
+            cache.add(cache_key, 0, timeout=timeout)
+            try:
+                cache.incr(cache_key, delta)
+            except ValueError:
+                # The slot expired between add and incr.
+                cache.add(cache_key, delta, timeout=timeout)
+
+    def reserve(self, rules, merchant_id, phone, amount):
+        cache = caches[self.alias]
+        now = time.time()
+        counted = []
+        try:
+            for rule in rules:
+                key = _key(rule, merchant_id, phone)
+                width = rule[1] / BUCKETS
+                slot = int(now / width)
+                keys = self._slot_keys(key, slot)
+                self._incr(cache, keys, 1, amount, math.ceil(rule[1] + width))
+                counted.append(keys)
+                slots = [
+                    self._slot_keys(key, number)
+                    for number in range(slot - BUCKETS + 1, slot + 1)
+                ]
+                found = cache.get_many([name for pair in slots for name in pair])
+                count = sum(found.get(pair[0], 0) for pair in slots)
+                total = sum(found.get(pair[1], 0) for pair in slots)
+                if _limited(rule, count, total):
+                    raise VelocityRejected(
+                        "Velocity limit of the %s over %d seconds exceeded for "
+                        "merchant %s." % (rule[0], rule[1], merchant_id),
+                        retry_after=math.ceil(width),
+                    )
+        except VelocityRejected:
+            self.cancel((counted, amount))
+            raise
+        return counted, amount
+
+    def cancel(self, token):
+        counted, amount = token
+        cache = caches[self.alias]
+        for keys in counted:
+            for cache_key, delta in zip(keys, (1, amount)):
+                try:
+                    cache.decr(cache_key, delta)
+                except ValueError:
+                    pass
+
+    def __len__(self):
+        return 0
+
+    def clear(self):
+        pass
+
+
+class VelocityChecks:
+    """
+    The velocity rules and windows of this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self._rules = None
+        self._windows = None
+        self.rejected = 0
+
+    def _rule_cache(self):
+        if self._rules is None:
+            self._rules = LRUCache(
+                max_size=settings.B2B_CHARGE_VELOCITY_RULES_CACHE_SIZE,
+                ttl=settings.B2B_CHARGE_VELOCITY_RULES_TTL,
+            )
+        return self._rules
+
+    def _backend(self):
+        alias = settings.B2B_CHARGE_VELOCITY_BACKEND
+        if self._windows is None or getattr(self._windows, "alias", "local") != alias:
+            with self._lock:
+                if alias == "local":
+                    self._windows = LocalWindows(settings.B2B_CHARGE_VELOCITY_MAX_KEYS)
+                else:
+                    self._windows = SharedWindows(alias)
+        return self._windows
+
+    def rules(self, merchant_id):
+        """
+        Returns the active rules of the merchant, as ``(scope, window, max_count,
+        max_amount)`` tuples.
+        """
+        cache = self._rule_cache()
+        rules = cache.get(merchant_id)
+        if rules is None:
+            # Imported here so that models can import this module.
+            from .models import VelocityRule
+
+            rules = tuple(
+                VelocityRule.objects.using(DEFAULT_DB_ALIAS)
+                .filter(
+                    Q(merchant_id=merchant_id) | Q(merchant_id=None), is_active=True
+                )
+                .exclude(max_count=None, max_amount=None)
+                .order_by("id")
+                .values_list("scope", "window", "max_count", "max_amount")
+            )
+            cache.set(merchant_id, rules)
+        return rules
+
+    def _warm(self, windows, rules, merchant_id):
+        """
+        Counts the merchant's recent charges in the windows of the rules that have not
+        been warmed yet.
+        """
+        from .models import TransactionLog
+
+        cold = windows.cold(rules, merchant_id)
+        if not cold:
+            return
+        since = timezone.now() - timedelta(seconds=max(rule[1] for rule in cold))
+        with merchant_shard(merchant_id):
+            # Read before taking the windows' lock, which the checks wait on.
+            charges = [
+                (phone, -amount, at.timestamp())
+                for phone, amount, at in TransactionLog.objects.filter(
+                    merchant_id=merchant_id,
+                    created_time__gte=since,
+                    amount__lt=0,
+                    is_transfer=False,
+                ).values_list("phone", "amount", "created_time")
+            ]
+        windows.warm(cold, merchant_id, charges)
+
+    def reserve(self, merchant_id, phone, amount):
+        """
+        Checks the charge against the merchant's rules and counts it, raising
+        VelocityRejected when a rule would be broken. Returns the reservation to pass
+        to ``cancel``.
+        """
+        if not settings.B2B_CHARGE_VELOCITY_BACKEND:
+            return None
+        rules = self.rules(merchant_id)
+        if not rules:
+            return None
+        windows = self._backend()
+        if getattr(windows, "warms", True) and windows.cold(rules, merchant_id):
+            # Two threads must not count the same logs twice.
+            with self._warm_lock:
+                self._warm(windows, rules, merchant_id)
+        try:
+            return windows, windows.reserve(rules, merchant_id, phone, amount)
+        except VelocityRejected:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+    def cancel(self, reservation):
+        """
+        Uncounts a charge counted by ``reserve``. It does not query the database.
+        """
+        if reservation is not None:
+            windows, token = reservation
+            windows.cancel(token)
+
+    @contextmanager
+    def admit(self, merchant_id, phone, amount):
+        """
+        Reserves the charge for the block, which is uncounted if the block raises.
+        """
+        reservation = self.reserve(merchant_id, phone, amount)
+        try:
+            yield
+        except BaseException:
+            self.cancel(reservation)
+            raise
+
+    def stats(self):
+        return {
+            "rejected": self.rejected,
+            "windows": len(self._windows) if self._windows is not None else 0,
+        }
+
+    def clear(self):
+        if self._rules is not None:
+            self._rules.clear()
+        if self._windows is not None:
+            self._windows.clear()
+        with self._lock:
+            self.rejected = 0
+
+
+velocity_checks = VelocityChecks()
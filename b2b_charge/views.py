@@ -1,15 +1,62 @@
+from contextlib import contextmanager
+
 from rest_framework import mixins, viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import Throttled
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from django.conf import settings
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 
 from .serializers import (
     MerchantSerializer,
     TransactionLogSerializer,
-    BuyChargeSerializer,
+    BuyChargeBatchSerializer,
+    BulkCreateMerchantSerializer,
+    BulkTopUpSerializer,
+    TransactionLogFilterSerializer,
+    TransactionLogExportSerializer,
+    TransactionRollupFilterSerializer,
+    TransactionRollupSerializer,
+    validate_charge,
+    validate_credit,
+    validate_reserve,
 )
-from .models import Merchant, TransactionLog
+from .models import CreditHold, Merchant, TransactionLog, TransactionRollup
+from .admission import AdmissionRejected, charge_admission
+from .combiner import charge_combiner
+from .exports import EXPORT_FORMATS, iter_export
+from .idempotency import HEADER, run_idempotent
+from .pagination import CreatedTimeKeysetPagination, ShardedKeysetPagination
+from .provisioning import create_merchants, top_up_merchants
+from .routers import read_alias, replica_reads
+from .sharding import merchant_shard
+from .velocity import VelocityRejected, velocity_checks
+
+
+@contextmanager
+def admitted(merchant_id):
+    """
+    Runs a charge under admission control, answering 429 when it is not admitted.
+    """
+    try:
+        with charge_admission.admit(merchant_id):
+            yield
+    except AdmissionRejected as e:
+        raise Throttled(wait=e.retry_after, detail=str(e))
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    """
+    Renders a hot endpoint's response straight to JSON, without DRF's content
+    negotiation and renderers. ``data`` stays on the response, as on a DRF Response.
+    """
+    response = JsonResponse(
+        data, status=status_code, json_dumps_params={"separators": (",", ":")}
+    )
+    response.data = data
+    return response
 
 
 class MerchantViewSet(
@@ -17,6 +64,20 @@ class MerchantViewSet(
 ):
     serializer_class = MerchantSerializer
     queryset = Merchant.objects.filter(is_active=True)
+    pagination_class = ShardedKeysetPagination
+
+    def dispatch(self, request, *args, **kwargs):
+        # The detail routes run on the shard of their merchant.
+        with merchant_shard(kwargs.get("pk")):
+            return super().dispatch(request, *args, **kwargs)
+
+    @replica_reads()
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @replica_reads()
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     @action(
         methods=["POST"],
@@ -29,64 +90,290 @@ class MerchantViewSet(
         """
         The view that adds credit to merchant.
         """
-        serializer = self.serializer_class(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        validated_data = serializer.validated_data
-        merchant = get_object_or_404(Merchant, id=pk)
-        credit = validated_data["credit"]
-        if credit < 0:
-            return Response(
+        credit = validate_credit(request.data)
+
+        def execute():
+            merchant = get_object_or_404(Merchant, id=pk)
+            if credit < 0:
+                return json_response(
+                    {
+                        "message": "Cannot execute transaction due to : Cannot accept Negative credit amount."
+                    },
+                    status.HTTP_400_BAD_REQUEST,
+                )
+            try:
+                merchant.transaction(action="add_credit", amount=credit, phone=None)
+            except Exception as e:
+                return json_response(
+                    {"message": "Cannot execute transaction due to : %s" % (e)},
+                    status.HTTP_400_BAD_REQUEST,
+                )
+
+            return json_response({"message": "Successfully added credits."})
+
+        return run_idempotent(request, pk, "add_credit", {"credit": credit}, execute)
+
+    @action(
+        methods=["POST"],
+        url_path="buy-charge",
+        url_name="buy-charge",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    def buy_charge(self, request, pk):
+        """
+        The view that buys charge for a particular phonenumber using a particular merchant.
+        """
+        with admitted(pk):
+            return self._buy_charge(request, pk)
+
+    def _buy_charge(self, request, pk):
+        phone, amount = validate_charge(request.data)
+        # The combiner commits in another thread's transaction, which cannot include
+        # the idempotency key.
+        combine = settings.B2B_CHARGE_WRITE_COMBINING and HEADER not in request.META
+
+        def execute():
+            merchant = get_object_or_404(Merchant, id=pk)
+            try:
+                with velocity_checks.admit(merchant.id, phone, amount):
+                    if combine:
+                        merchant_credit = charge_combiner.charge(
+                            merchant, phone, amount
+                        )
+                    else:
+                        merchant_credit = merchant.transaction(
+                            action="subtract_credit", phone=phone, amount=amount
+                        )
+            except AdmissionRejected:
+                raise
+            except Exception as e:
+                return json_response(
+                    {"message": "Cannot execute transaction due to : %s" % (e)},
+                    status.HTTP_400_BAD_REQUEST,
+                )
+            return json_response(
                 {
-                    "message": "Cannot execute transaction due to : Cannot accept Negative credit amount."
-                },
-                status=status.HTTP_400_BAD_REQUEST,
+                    "message": "Successfully bought charge.",
+                    "amount": amount,
+                    "merchant_credit": merchant_credit,
+                }
+            )
+
+        return run_idempotent(
+            request, pk, "buy_charge", {"phone": phone, "amount": amount}, execute
+        )
+
+    @action(
+        methods=["POST"],
+        url_path="reserve",
+        url_name="reserve",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    def reserve(self, request, pk):
+        """
+        The view that holds credit for a charge that is captured or released later.
+        """
+        with admitted(pk):
+            phone, amount, ttl = validate_reserve(request.data)
+
+            def execute():
+                merchant = get_object_or_404(Merchant, id=pk)
+                try:
+                    with velocity_checks.admit(merchant.id, phone, amount):
+                        hold = merchant.reserve_credit(phone, amount, ttl)
+                except AdmissionRejected:
+                    raise
+                except Exception as e:
+                    return json_response(
+                        {"message": "Cannot execute transaction due to : %s" % (e)},
+                        status.HTTP_400_BAD_REQUEST,
+                    )
+                return json_response(
+                    {
+                        "message": "Successfully reserved credit.",
+                        "hold_id": hold.id,
+                        "amount": amount,
+                        "expires_at": hold.expires_at.isoformat(),
+                        "merchant_credit": merchant.credit,
+                    }
+                )
+
+            return run_idempotent(
+                request,
+                pk,
+                "reserve",
+                {"phone": phone, "amount": amount, "ttl": ttl},
+                execute,
             )
+
+    def _close_hold(self, pk, hold_id, close, message):
+        hold = get_object_or_404(CreditHold, id=hold_id, merchant_id=pk)
         try:
-            merchant.transaction(action="add_credit", amount=credit, phone=None)
+            merchant_credit = close(hold)
         except Exception as e:
-            return Response(
+            return json_response(
                 {"message": "Cannot execute transaction due to : %s" % (e)},
-                status=status.HTTP_400_BAD_REQUEST,
+                status.HTTP_400_BAD_REQUEST,
             )
-
-        return Response(
+        return json_response(
             {
-                "message": "Successfully added credits.",
-            },
-            status=status.HTTP_200_OK,
+                "message": message,
+                "hold_id": hold.id,
+                "amount": hold.amount,
+                "merchant_credit": merchant_credit,
+            }
         )
 
     @action(
         methods=["POST"],
-        url_path="buy-charge",
-        url_name="buy-charge",
+        url_path=r"holds/(?P<hold_id>\d+)/capture",
+        url_name="capture",
         permission_classes=[AllowAny],
         detail=True,
     )
-    def buy_charge(self, request, pk):
+    def capture(self, request, pk, hold_id):
         """
-        The view that buys charge for a particular phonenumber using a particular merchant.
+        The view that charges a credit hold and logs the charge.
         """
-        serializer = BuyChargeSerializer(data=request.data)
+        return self._close_hold(
+            pk, hold_id, CreditHold.capture, "Successfully bought charge."
+        )
+
+    @action(
+        methods=["POST"],
+        url_path=r"holds/(?P<hold_id>\d+)/release",
+        url_name="release",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    def release(self, request, pk, hold_id):
+        """
+        The view that gives the credit of a hold back to the merchant.
+        """
+        return self._close_hold(
+            pk, hold_id, CreditHold.release, "Successfully released credit."
+        )
+
+    @action(
+        methods=["POST"],
+        url_path="buy-charge-batch",
+        url_name="buy-charge-batch",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    def buy_charge_batch(self, request, pk):
+        """
+        The view that buys charge for a list of phonenumbers using a particular merchant.
+        The merchant is debited once for the whole batch and a result is returned per item.
+        """
+        with admitted(pk):
+            return self._buy_charge_batch(request, pk)
+
+    def _buy_charge_batch(self, request, pk):
+        serializer = BuyChargeBatchSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        validated_data = serializer.validated_data
+        items = serializer.validated_data["items"]
+
+        results = []
+        charges = []
+        for item in items:
+            try:
+                phone, amount = BuyChargeBatchSerializer.parse_item(item)
+            except ValueError as e:
+                results.append({"status": "failed", "message": str(e)})
+                continue
+            results.append({"phone": phone, "amount": amount})
+            charges.append((len(results) - 1, phone, amount))
 
-        phone = validated_data["phone"]
-        amount = validated_data["amount"]
         merchant = get_object_or_404(Merchant, id=pk)
+        admitted_charges = []
+        reservations = []
+        for index, phone, amount in charges:
+            try:
+                reservation = velocity_checks.reserve(merchant.id, phone, amount)
+            except VelocityRejected as e:
+                results[index]["status"] = "failed"
+                results[index]["message"] = str(e)
+                continue
+            admitted_charges.append((index, phone, amount))
+            reservations.append(reservation)
+        charges = admitted_charges
 
         try:
-            merchant.transaction(action="subtract_credit", phone=phone, amount=amount)
+            accepted = merchant.batch_transaction(
+                [(phone, amount) for _, phone, amount in charges]
+            )
         except Exception as e:
+            for reservation in reservations:
+                velocity_checks.cancel(reservation)
             return Response(
                 {"message": "Cannot execute transaction due to : %s" % (e)},
                 status=status.HTTP_400_BAD_REQUEST,
             )
+
+        for (index, _, _), reservation, ok in zip(charges, reservations, accepted):
+            if ok:
+                results[index]["status"] = "success"
+            else:
+                velocity_checks.cancel(reservation)
+                results[index]["status"] = "failed"
+                results[index]["message"] = "Insufficient merchant credit."
+        succeeded = accepted.count(True)
         return Response(
             {
-                "message": "Successfully bought charge.",
-                "amount": amount,
+                "message": "Bought charge for %d of %d items."
+                % (succeeded, len(items)),
+                "succeeded": succeeded,
+                "failed": len(items) - succeeded,
                 "merchant_credit": merchant.get_credit(),
+                "results": results,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @action(
+        methods=["POST"],
+        url_path="bulk-create",
+        url_name="bulk-create",
+        permission_classes=[AllowAny],
+        detail=False,
+    )
+    def bulk_create_merchants(self, request):
+        """
+        The view that creates many merchants, with their opening balances, at once.
+        """
+        serializer = BulkCreateMerchantSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = create_merchants(serializer.validated_data["merchants"])
+        return self.bulk_response("Created %d of %d merchants.", results)
+
+    @action(
+        methods=["POST"],
+        url_path="bulk-top-up",
+        url_name="bulk-top-up",
+        permission_classes=[AllowAny],
+        detail=False,
+    )
+    def bulk_top_up(self, request):
+        """
+        The view that adds credit to many merchants at once.
+        """
+        serializer = BulkTopUpSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = top_up_merchants(serializer.validated_data["items"])
+        return self.bulk_response("Added credit for %d of %d rows.", results)
+
+    @staticmethod
+    def bulk_response(message, results):
+        succeeded = sum(result["status"] == "success" for result in results)
+        return Response(
+            {
+                "message": message % (succeeded, len(results)),
+                "succeeded": succeeded,
+                "failed": len(results) - succeeded,
+                "results": results,
             },
             status=status.HTTP_200_OK,
         )
@@ -98,19 +385,110 @@ class MerchantViewSet(
         permission_classes=[AllowAny],
         detail=True,
     )
+    @replica_reads()
     def get_credit(self, request, pk):
         """
         The view that returns overall credit for a particular merchant.
         """
-        serializer = self.serializer_class(data=request.data)
+        try:
+            merchant_id = int(pk)
+        except ValueError:
+            raise Http404
+        credit = Merchant.get_cached_credit(merchant_id)
+        if credit is None:
+            raise Http404
+        return json_response({"merchant_id": merchant_id, "credit": credit})
+
+    @action(
+        methods=["GET"],
+        url_path="transactions",
+        url_name="transactions",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    @replica_reads()
+    def transactions(self, request, pk):
+        """
+        The view that lists a merchant's transactions, newest first.
+        Accepts ``phone``, ``since`` and ``until`` filters.
+        """
+        serializer = TransactionLogFilterSerializer(data=request.query_params)
         serializer.is_valid(raise_exception=True)
-        validated_data = serializer.validated_data
+        merchant = get_object_or_404(Merchant, id=pk)
+
+        logs = TransactionLog.filter_history(merchant.id, **serializer.validated_data)
+        paginator = CreatedTimeKeysetPagination()
+        page = paginator.paginate_queryset(logs, request, view=self)
+        return paginator.get_paginated_response(
+            TransactionLogSerializer(page, many=True).data
+        )
 
+    @action(
+        methods=["GET"],
+        url_path="export",
+        url_name="export",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    @replica_reads()
+    def export(self, request, pk):
+        """
+        The view that streams a merchant's whole transaction log as CSV or NDJSON.
+        Accepts the ``output`` format and the ``phone``, ``since`` and ``until`` filters.
+        """
+        serializer = TransactionLogExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        filters = dict(serializer.validated_data)
+        output = filters.pop("output")
         merchant = get_object_or_404(Merchant, id=pk)
+
+        # The rows are streamed after the view returns, outside of replica_reads().
+        logs = TransactionLog.filter_history(merchant.id, **filters).using(read_alias())
+        response = StreamingHttpResponse(
+            iter_export(logs, output), content_type=EXPORT_FORMATS[output]
+        )
+        response["Content-Disposition"] = (
+            'attachment; filename="merchant-%d-transactions.%s"' % (merchant.id, output)
+        )
+        return response
+
+    @action(
+        methods=["GET"],
+        url_path="stats",
+        url_name="stats",
+        permission_classes=[AllowAny],
+        detail=True,
+    )
+    @replica_reads()
+    def stats(self, request, pk):
+        """
+        The view that returns a merchant's hourly or daily transaction totals from the
+        rollups, oldest first, and their sum. Accepts ``period``, ``since`` and ``until``.
+        """
+        serializer = TransactionRollupFilterSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        filters = serializer.validated_data
+        merchant = get_object_or_404(Merchant, id=pk)
+
+        rollups = TransactionRollup.objects.filter(
+            merchant_id=merchant.id, period=filters["period"]
+        )
+        if "since" in filters:
+            rollups = rollups.filter(start__gte=filters["since"])
+        if "until" in filters:
+            rollups = rollups.filter(start__lt=filters["until"])
+        # The newest buckets when the range holds more than a page.
+        rollups = list(rollups.order_by("-start")[: settings.B2B_CHARGE_MAX_PAGE_SIZE])
+        rollups.reverse()
         return Response(
             {
                 "merchant_id": merchant.id,
-                "credit": merchant.get_credit(),
+                "period": filters["period"],
+                "results": TransactionRollupSerializer(rollups, many=True).data,
+                "totals": {
+                    field: sum(getattr(rollup, field) for rollup in rollups)
+                    for field in ("count", "credit", "debit")
+                },
             },
             status=status.HTTP_200_OK,
         )
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "b2b_charge.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -87,14 +88,156 @@ DATABASES = {
         "PASSWORD": os.getenv("POSTGRES_PASSWORD"),
         "HOST": os.getenv("POSTGRES_HOST"),
         "PORT": os.getenv("POSTGRES_PORT"),
+        # Keep connections open between requests instead of reconnecting every time.
+        "CONN_MAX_AGE": int(os.getenv("POSTGRES_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
     },
 }
 
+# Read replicas of the default database, as a comma-separated list of host[:port].
+# Each one becomes a "replica_<n>" alias with the same credentials.
+for index, replica in enumerate(
+    filter(None, os.getenv("POSTGRES_REPLICA_HOSTS", "").split(","))
+):
+    host, _, port = replica.partition(":")
+    DATABASES["replica_%d" % index] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+        "TEST": {"MIRROR": "default"},
+    }
+
+# More databases merchants can be sharded over, as a comma-separated list of
+# host[:port]/name. Each one becomes a "shard_<n>" alias, numbered from 1, with the same
+# credentials as the default database.
+for index, shard in enumerate(
+    filter(None, os.getenv("POSTGRES_SHARDS", "").split(",")), 1
+):
+    address, _, name = shard.partition("/")
+    host, _, port = address.partition(":")
+    DATABASES["shard_%d" % index] = {
+        **DATABASES["default"],
+        "NAME": name or DATABASES["default"]["NAME"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+    }
+
+DATABASE_ROUTERS = ["b2b_charge.routers.ReplicaRouter"]
+
 REST_FRAMEWORK = {
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": int(os.getenv("PAGE_SIZE", 1)),
 }
 
+# b2b_charge
+# Rows per INSERT when transaction logs are written in bulk.
+B2B_CHARGE_LOG_BATCH_SIZE = int(os.getenv("B2B_CHARGE_LOG_BATCH_SIZE", 1000))
+# Write transaction logs to an outbox table that flush_transaction_logs moves to the
+# log table in batches, and how many entries it moves per transaction.
+B2B_CHARGE_LOG_OUTBOX = os.getenv("B2B_CHARGE_LOG_OUTBOX", "0") == "1"
+B2B_CHARGE_LOG_FLUSH_BATCH_SIZE = int(
+    os.getenv("B2B_CHARGE_LOG_FLUSH_BATCH_SIZE", 10000)
+)
+# Write a change feed event for every transaction log entry, in the same transaction.
+# relay_events publishes the events to B2B_CHARGE_EVENT_SINK, one of "file:<path>"
+# (JSON lines), "unix:<socket path>" or "cache:<CACHES alias>", in batches.
+B2B_CHARGE_EVENTS = os.getenv("B2B_CHARGE_EVENTS", "0") == "1"
+B2B_CHARGE_EVENT_SINK = os.getenv(
+    "B2B_CHARGE_EVENT_SINK", "file:%s" % (BASE_DIR / "transaction_events.jsonl")
+)
+B2B_CHARGE_EVENT_BATCH_SIZE = int(os.getenv("B2B_CHARGE_EVENT_BATCH_SIZE", 1000))
+# Seconds events are kept by the cache sink. Consumers further behind replay the log.
+B2B_CHARGE_EVENT_RETENTION = int(os.getenv("B2B_CHARGE_EVENT_RETENTION", 604800))
+# Maximum number of items accepted by the buy-charge-batch endpoint.
+B2B_CHARGE_MAX_BATCH_ITEMS = int(os.getenv("B2B_CHARGE_MAX_BATCH_ITEMS", 20000))
+# Maximum number of rows accepted by the bulk-create and bulk-top-up endpoints.
+B2B_CHARGE_MAX_BULK_ROWS = int(os.getenv("B2B_CHARGE_MAX_BULK_ROWS", 50000))
+# Coalesce concurrent buy-charge calls for the same merchant into one debit.
+B2B_CHARGE_WRITE_COMBINING = os.getenv("B2B_CHARGE_WRITE_COMBINING", "0") == "1"
+B2B_CHARGE_WRITE_COMBINING_WINDOW_MS = float(
+    os.getenv("B2B_CHARGE_WRITE_COMBINING_WINDOW_MS", 2)
+)
+B2B_CHARGE_WRITE_COMBINING_MAX_BATCH = int(
+    os.getenv("B2B_CHARGE_WRITE_COMBINING_MAX_BATCH", 500)
+)
+# Default and maximum page sizes of the cursor-paginated listings.
+B2B_CHARGE_PAGE_SIZE = int(os.getenv("B2B_CHARGE_PAGE_SIZE", 100))
+B2B_CHARGE_MAX_PAGE_SIZE = int(os.getenv("B2B_CHARGE_MAX_PAGE_SIZE", 10000))
+# Rows fetched per round trip by the streaming exports.
+B2B_CHARGE_EXPORT_CHUNK_SIZE = int(os.getenv("B2B_CHARGE_EXPORT_CHUNK_SIZE", 2000))
+# Seconds an Idempotency-Key is remembered, and how often prune_idempotency_keys
+# deletes expired keys when left running (0 prunes once and exits, e.g. from cron).
+B2B_CHARGE_IDEMPOTENCY_TTL = int(os.getenv("B2B_CHARGE_IDEMPOTENCY_TTL", 86400))
+B2B_CHARGE_IDEMPOTENCY_PRUNE_INTERVAL = int(
+    os.getenv("B2B_CHARGE_IDEMPOTENCY_PRUNE_INTERVAL", 0)
+)
+# Processes used by reconcile_balances, and how old (in seconds) a log row must be
+# before a balance snapshot may cover it.
+B2B_CHARGE_RECONCILE_WORKERS = int(os.getenv("B2B_CHARGE_RECONCILE_WORKERS", 4))
+B2B_CHARGE_RECONCILE_SAFETY_LAG = int(os.getenv("B2B_CHARGE_RECONCILE_SAFETY_LAG", 300))
+# How old (in seconds) a log row must be before rollup_transactions counts it, and how
+# many log rows it processes per transaction.
+B2B_CHARGE_ROLLUP_SAFETY_LAG = int(os.getenv("B2B_CHARGE_ROLLUP_SAFETY_LAG", 60))
+B2B_CHARGE_ROLLUP_BATCH_SIZE = int(os.getenv("B2B_CHARGE_ROLLUP_BATCH_SIZE", 100000))
+# Default charges per second admitted per merchant (0 disables the limit) and the burst
+# above it (0 means the rate), overridable per merchant. Limits are cached for
+# B2B_CHARGE_RATE_LIMIT_TTL seconds for at most B2B_CHARGE_RATE_LIMIT_CACHE_SIZE
+# merchants, and counted in process ("local"), in a CACHES alias shared by every
+# process, or not at all when the backend is empty.
+B2B_CHARGE_RATE_LIMIT = int(os.getenv("B2B_CHARGE_RATE_LIMIT", 0))
+B2B_CHARGE_RATE_BURST = int(os.getenv("B2B_CHARGE_RATE_BURST", 0))
+B2B_CHARGE_RATE_LIMIT_TTL = float(os.getenv("B2B_CHARGE_RATE_LIMIT_TTL", 30))
+B2B_CHARGE_RATE_LIMIT_BACKEND = os.getenv("B2B_CHARGE_RATE_LIMIT_BACKEND", "local")
+B2B_CHARGE_RATE_LIMIT_CACHE_SIZE = int(
+    os.getenv("B2B_CHARGE_RATE_LIMIT_CACHE_SIZE", 100000)
+)
+# Charges running at once per process before new ones get 429 (0 disables the cap).
+B2B_CHARGE_MAX_CONCURRENT_CHARGES = int(
+    os.getenv("B2B_CHARGE_MAX_CONCURRENT_CHARGES", 0)
+)
+# Where the velocity rules count charges: "local" (in-process ring buffers, warmed
+# from the recent logs), a CACHES alias shared by every process, or empty to disable
+# the rules. Rules are cached for B2B_CHARGE_VELOCITY_RULES_TTL seconds for at most
+# B2B_CHARGE_VELOCITY_RULES_CACHE_SIZE merchants, and at most
+# B2B_CHARGE_VELOCITY_MAX_KEYS windows are kept in process.
+B2B_CHARGE_VELOCITY_BACKEND = os.getenv("B2B_CHARGE_VELOCITY_BACKEND", "local")
+B2B_CHARGE_VELOCITY_RULES_TTL = float(os.getenv("B2B_CHARGE_VELOCITY_RULES_TTL", 30))
+B2B_CHARGE_VELOCITY_RULES_CACHE_SIZE = int(
+    os.getenv("B2B_CHARGE_VELOCITY_RULES_CACHE_SIZE", 100000)
+)
+B2B_CHARGE_VELOCITY_MAX_KEYS = int(os.getenv("B2B_CHARGE_VELOCITY_MAX_KEYS", 100000))
+# Seconds a credit hold stays open by default and at most, before expire_credit_holds
+# gives the credit back.
+B2B_CHARGE_HOLD_TTL = int(os.getenv("B2B_CHARGE_HOLD_TTL", 300))
+B2B_CHARGE_HOLD_MAX_TTL = int(os.getenv("B2B_CHARGE_HOLD_MAX_TTL", 86400))
+# Aliases the read-only endpoints read from. A request that writes is pinned to the
+# primary from then on.
+B2B_CHARGE_READ_REPLICAS = [
+    alias for alias in DATABASES if alias.startswith("replica_")
+]
+# Aliases merchants are sharded over, comma-separated, e.g. "default,shard_1". Empty
+# keeps every merchant in the default database. Only ever append to the list: merchant
+# ids encode the position of their shard in it.
+B2B_CHARGE_SHARDS = list(filter(None, os.getenv("B2B_CHARGE_SHARDS", "").split(",")))
+# Seconds processes cache where a merchant lives. Moving a merchant pauses its writes
+# for this long.
+B2B_CHARGE_SHARD_MAP_TTL = float(os.getenv("B2B_CHARGE_SHARD_MAP_TTL", 5))
+# Cache in front of <get-credit>: "local" (in-process LRU), a CACHES alias, or empty
+# to disable.
+B2B_CHARGE_BALANCE_CACHE_BACKEND = os.getenv(
+    "B2B_CHARGE_BALANCE_CACHE_BACKEND", "local"
+)
+B2B_CHARGE_BALANCE_CACHE_TTL = float(os.getenv("B2B_CHARGE_BALANCE_CACHE_TTL", 5))
+B2B_CHARGE_BALANCE_CACHE_MAX_SIZE = int(
+    os.getenv("B2B_CHARGE_BALANCE_CACHE_MAX_SIZE", 100000)
+)
+# Threads (and so persistent connections) used by the async views for database work.
+# 0 runs the database work through sync_to_async instead.
+B2B_CHARGE_ASYNC_DB_POOL_SIZE = int(os.getenv("B2B_CHARGE_ASYNC_DB_POOL_SIZE", 20))
+# Share of requests whose query count, DB time and lock wait are recorded by
+# MetricsMiddleware. Wall time is recorded for every request.
+B2B_CHARGE_METRICS_SAMPLE_RATE = float(os.getenv("B2B_CHARGE_METRICS_SAMPLE_RATE", 0.1))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -14,6 +14,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
@@ -21,6 +22,8 @@ from django.shortcuts import redirect
 from rest_framework import routers
 
 from b2b_charge.urls import router as b2b_charge_router
+from b2b_charge.urls import async_urlpatterns as b2b_charge_async_urlpatterns
+from b2b_charge.urls import metrics_urlpatterns as b2b_charge_metrics_urlpatterns
 
 router = routers.DefaultRouter()
 router.registry.extend(b2b_charge_router.registry)
@@ -29,4 +32,6 @@ urlpatterns = [
     path("", lambda request: redirect("admin/", permanent=True)),
     path("admin/", admin.site.urls),
     path("api/v1/", include(router.urls)),
+    path("api/v1/async/", include(b2b_charge_async_urlpatterns)),
+    path("", include(b2b_charge_metrics_urlpatterns)),
 ]